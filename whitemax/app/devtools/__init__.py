@@ -0,0 +1,6 @@
+"""
+Инструменты разработчика для max_client_wrapper (не попадают в app bundle:
+BuildScripts/copy_python_libs.sh копирует только max_client_wrapper.py).
+
+Тесты лежат здесь же (test_*.py) и запускаются из whitemax/app: python -m pytest devtools
+"""
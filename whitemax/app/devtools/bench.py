@@ -0,0 +1,313 @@
+"""
+Бенчмарки горячих путей max_client_wrapper на фейковом клиенте (devtools.fake_max).
+
+Что меряется:
+  message_to_dict     — конвертация реалистичных сообщений (реакции, reply, фото, файлы)
+  message_record      — то же в компактную запись (_MessageRecord) + байт на сообщение в кеше: dict vs запись
+  get_chats_<N>       — сборка get_chats для N диалогов+групп (100 / 1k / 10k), без паузы после get_users
+  emit_event          — запись событий в events dir
+  run_async_roundtrip — накладные расходы _run_async (пустая корутина)
+  json_dumps_*        — сериализация полных ответов get_messages / get_chats
+
+Для каждого: ops/sec, мкс/операцию, пик памяти (tracemalloc) и чистый прирост аллокаций.
+
+Запуск (из whitemax/app):
+    python -m devtools.bench                          # вывести результаты
+    python -m devtools.bench --save-baseline          # сохранить devtools/bench_baseline.json
+    python -m devtools.bench --compare                # сравнить с baseline, exit 1 при регрессии
+    python -m devtools.bench --only get_chats --quick
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import max_client_wrapper as mcw  # noqa: E402
+from devtools.fake_max import FakeScenario, fake_client_factory, generate_dataset  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def measure(fn: Callable[[], Any], number: int, repeat: int = 3) -> Dict[str, Any]:
+    """Лучшее из `repeat` прогонов по `number` вызовов + отдельный прогон под tracemalloc."""
+    fn()  # warm-up
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - t0)
+
+    gc.collect()
+    gc.disable()
+    try:
+        blocks0 = sys.getallocatedblocks()
+        tracemalloc.start()
+        base, _ = tracemalloc.get_traced_memory()
+        for _ in range(number):
+            fn()
+        cur, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        blocks1 = sys.getallocatedblocks()
+    finally:
+        gc.enable()
+
+    per_op = best / number
+    return {
+        "ops_per_s": round(1.0 / per_op, 1) if per_op > 0 else None,
+        "us_per_op": round(per_op * 1e6, 2),
+        "peak_kib": round((peak - base) / 1024.0, 1),
+        "retained_kib": round((cur - base) / 1024.0, 1),
+        "net_blocks_per_op": round((blocks1 - blocks0) / number, 2),
+        "number": number,
+    }
+
+
+def realistic_messages(count: int, chat_id: int = 1001) -> List[Any]:
+    """Смесь сообщений: текст, reply, реакции, фото, файлы (как приходят из pymax)."""
+    out = []
+    for i in range(count):
+        attaches: List[Any] = []
+        if i % 4 == 1:
+            attaches.append(
+                SimpleNamespace(type="PHOTO", photo_id=5_000 + i, base_url=f"https://i.fake/p/{i}?sig=abc", width=1280, height=960)
+            )
+        if i % 7 == 3:
+            attaches.append(SimpleNamespace(type="FILE", file_id=9_000 + i, name=f"report_{i}.pdf", size=123_456 + i))
+        reaction_info = None
+        if i % 3 == 0:
+            reaction_info = SimpleNamespace(
+                counters=[SimpleNamespace(reaction="👍", count=3), SimpleNamespace(reaction="❤️", count=1)],
+                total_count=4,
+            )
+        link = SimpleNamespace(type="REPLY", message_id=100_000 + i - 1) if i % 5 == 2 else None
+        out.append(
+            SimpleNamespace(
+                id=100_000 + i,
+                chat_id=chat_id,
+                sender=1000 + (i % 17),
+                time=1_760_000_000_000 + i * 1000,
+                text="Привет! Это тестовое сообщение номер %d с небольшим текстом." % i,
+                type="USER",
+                attaches=attaches,
+                link=link,
+                reactionInfo=reaction_info,
+            )
+        )
+    return out
+
+
+class Suite:
+    def __init__(self, quick: bool = False):
+        self.quick = quick
+        self.tmp = tempfile.mkdtemp(prefix="whitemax-bench-")
+        self._wrappers: List[mcw.MaxClientWrapper] = []
+
+    def wrapper(self, dialogs: int = 20, groups: int = 5) -> mcw.MaxClientWrapper:
+        ds = generate_dataset(dialogs=dialogs, groups=groups, channels=0, messages_per_chat=0, seed=1)
+        work_dir = tempfile.mkdtemp(dir=self.tmp)
+        w = mcw.MaxClientWrapper(
+            "+70000000000", work_dir=work_dir, client_factory=fake_client_factory(ds, FakeScenario())
+        )
+        w.create_client()
+        # Без сетевой подгрузки миниатюр: меряем только сборку ответа.
+        w.configure_thumbnails(prefetch_count=0)
+        self._wrappers.append(w)
+        return w
+
+    def close(self) -> None:
+        for w in self._wrappers:
+            try:
+                w.stop_client()
+            except Exception:
+                pass
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def n(self, full: int) -> int:
+        return max(1, full // 10) if self.quick else full
+
+    # --- бенчмарки ---
+
+    def bench_message_to_dict(self) -> Dict[str, Any]:
+        w = self.wrapper()
+        msgs = realistic_messages(200)
+
+        def run() -> None:
+            for m in msgs:
+                w._message_to_dict(m)
+
+        r = measure(run, number=self.n(50))
+        # нормируем на одно сообщение
+        r["msgs_per_s"] = round(r["ops_per_s"] * len(msgs), 1)
+        return r
+
+    def bench_message_record(self) -> Dict[str, Any]:
+        w = self.wrapper()
+        msgs = realistic_messages(200)
+
+        def run() -> None:
+            for m in msgs:
+                w._message_record(m)
+
+        r = measure(run, number=self.n(50))
+        r["msgs_per_s"] = round(r["ops_per_s"] * len(msgs), 1)
+
+        def held_bytes(convert: Callable[[Any], Any]) -> float:
+            gc.collect()
+            tracemalloc.start()
+            base, _ = tracemalloc.get_traced_memory()
+            kept = [convert(m) for m in msgs]
+            cur, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del kept
+            return (cur - base) / len(msgs)
+
+        r["dict_bytes_per_msg"] = round(held_bytes(w._message_to_dict), 1)
+        r["record_bytes_per_msg"] = round(held_bytes(w._message_record), 1)
+        return r
+
+    def bench_get_chats(self, total: int) -> Dict[str, Any]:
+        w = self.wrapper(dialogs=total // 2, groups=total - total // 2)
+        # Фиксированная пауза после get_users (0.1 с) иначе съедает всё время и прячет регрессии сборки.
+        w._USERS_SETTLE_S = 0.0
+        res = w.get_chats()
+        if not res.get("success"):
+            raise RuntimeError(res.get("error"))
+        return measure(w.get_chats, number=self.n(10) if total < 10_000 else self.n(3), repeat=2)
+
+    def bench_emit_event(self) -> Dict[str, Any]:
+        w = self.wrapper()
+        event = {"type": "message_new", "message": w._message_to_dict(realistic_messages(2)[1])}
+
+        def run() -> None:
+            w._emit_event(dict(event))
+
+        r = measure(run, number=self.n(500))
+        shutil.rmtree(w._events_dir, ignore_errors=True)
+        return r
+
+    def bench_run_async_roundtrip(self) -> Dict[str, Any]:
+        w = self.wrapper()
+
+        async def noop() -> None:
+            return None
+
+        return measure(lambda: w._run_async(noop()), number=self.n(2000))
+
+    def bench_json_dumps_messages(self) -> Dict[str, Any]:
+        w = self.wrapper()
+        resp = {"success": True, "messages": [w._message_to_dict(m) for m in realistic_messages(200)]}
+        return measure(lambda: json.dumps(resp), number=self.n(200))
+
+    def bench_json_dumps_chats(self) -> Dict[str, Any]:
+        w = self.wrapper(dialogs=500, groups=500)
+        resp = w.get_chats()
+        return measure(lambda: json.dumps(resp), number=self.n(100))
+
+    def all(self) -> Dict[str, Callable[[], Dict[str, Any]]]:
+        return {
+            "message_to_dict": self.bench_message_to_dict,
+            "message_record": self.bench_message_record,
+            "get_chats_100": lambda: self.bench_get_chats(100),
+            "get_chats_1000": lambda: self.bench_get_chats(1_000),
+            "get_chats_10000": lambda: self.bench_get_chats(10_000),
+            "emit_event": self.bench_emit_event,
+            "run_async_roundtrip": self.bench_run_async_roundtrip,
+            "json_dumps_messages_200": self.bench_json_dumps_messages,
+            "json_dumps_chats_1000": self.bench_json_dumps_chats,
+        }
+
+
+def run_suite(only: Optional[str] = None, quick: bool = False) -> Dict[str, Any]:
+    suite = Suite(quick=quick)
+    results: Dict[str, Any] = {}
+    try:
+        for name, fn in suite.all().items():
+            if only and only not in name:
+                continue
+            try:
+                results[name] = fn()
+            except Exception as e:
+                results[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{name:28s} {json.dumps(results[name], ensure_ascii=False)}", flush=True)
+    finally:
+        suite.close()
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+            "ts": int(time.time()),
+        },
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Регрессия: ops/sec упал больше чем на threshold или пик памяти вырос больше чем на threshold."""
+    problems = []
+    for name, cur in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or "error" in base:
+            continue
+        if "error" in cur:
+            problems.append(f"{name}: {cur['error']}")
+            continue
+        if base.get("ops_per_s") and cur.get("ops_per_s") is not None:
+            ratio = cur["ops_per_s"] / base["ops_per_s"]
+            if ratio < 1.0 - threshold:
+                problems.append(f"{name}: ops/sec {cur['ops_per_s']} vs baseline {base['ops_per_s']} ({ratio:.2f}x)")
+        if base.get("peak_kib", 0) > 64 and cur.get("peak_kib", 0) > base["peak_kib"] * (1.0 + threshold):
+            problems.append(f"{name}: peak {cur['peak_kib']} KiB vs baseline {base['peak_kib']} KiB")
+    return problems
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="max_client_wrapper hot-path benchmarks")
+    parser.add_argument("--only", help="run benchmarks whose name contains this substring")
+    parser.add_argument("--quick", action="store_true", help="10x fewer iterations (smoke run)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON path")
+    parser.add_argument("--save-baseline", action="store_true", help="write results to --baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with --baseline; exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    parser.add_argument("--output", help="also write results JSON here")
+    args = parser.parse_args(argv)
+
+    current = run_suite(args.only, args.quick)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+        print(f"baseline saved to {args.baseline}")
+    if args.compare:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(current, baseline, args.threshold)
+        if problems:
+            print("REGRESSIONS:")
+            for p in problems:
+                print("  " + p)
+            return 1
+        print("no regressions vs baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
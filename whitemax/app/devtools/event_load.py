@@ -0,0 +1,287 @@
+"""
+Нагрузочный генератор realtime-событий: всплески message_new / message_edit через обработчики
+register_event_callbacks (фейковый клиент devtools.fake_max) и сравнение event sink'ов.
+
+Для каждого sink (files / batched / memory):
+  * продюсер на asyncio loop обёртки шлёт N событий по C чатам с заданной частотой
+    (push_message / push_edit — как будто их прислал сервер);
+  * потребитель в отдельном потоке ведёт себя как Swift: читает и удаляет файлы из events dir
+    (или зовёт poll_events для memory sink);
+  * меряются end-to-end латентность (push -> событие прочитано), доставлено / схлопнуто / потеряно,
+    отставание продюсера от графика (обработчики выполняются на loop) и прирост памяти (tracemalloc).
+
+Запуск (из whitemax/app):
+    python -m devtools.event_load                                   # 10k message_new по 200 чатам, 2000/с
+    python -m devtools.event_load --events 20000 --rate 0 --edit-ratio 0.3 --sinks files,batched
+    python -m devtools.event_load --json > report.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import max_client_wrapper as mcw  # noqa: E402
+from devtools.fake_max import FakeScenario, fake_client_factory, generate_dataset  # noqa: E402
+
+SINKS = ("files", "batched", "memory")
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    s = sorted(values)
+
+    def q(p: float) -> float:
+        return round(s[min(len(s) - 1, int(p * len(s)))], 3)
+
+    return {"p50_ms": q(0.50), "p95_ms": q(0.95), "p99_ms": q(0.99), "max_ms": round(s[-1], 3)}
+
+
+class Consumer(threading.Thread):
+    """Читатель событий "как Swift": разбирает маркер load:<seq>:<perf_ns> из текста сообщения."""
+
+    def __init__(self, wrapper: mcw.MaxClientWrapper, kind: str, interval_s: float):
+        super().__init__(name="event-load-consumer", daemon=True)
+        self.w = wrapper
+        self.kind = kind
+        self.interval_s = interval_s
+        self.latencies_ms: List[float] = []
+        self.seen: set = set()
+        self.duplicates = 0
+        self.files = 0
+        self.gaps = 0
+        self.last_recv = time.perf_counter()
+        self._halt = threading.Event()
+        self._after_seq = 0
+
+    def _record(self, event: Dict[str, Any], now_ns: int) -> None:
+        text = ((event.get("message") or {}).get("text") or "")
+        if not text.startswith("load:"):
+            return
+        _, seq, sent_ns = text.split(":", 2)
+        if seq in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(seq)
+        self.latencies_ms.append((now_ns - int(sent_ns)) / 1e6)
+        self.last_recv = time.perf_counter()
+
+    def _drain_dir(self) -> None:
+        d = self.w._events_dir
+        try:
+            names = sorted(n for n in os.listdir(d) if n.endswith(".json") and not n.startswith("."))
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(d, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    payload = json.load(f)
+                os.unlink(path)
+            except (OSError, ValueError):
+                continue
+            self.files += 1
+            now_ns = time.perf_counter_ns()
+            for event in payload["events"] if payload.get("type") == "batch" else [payload]:
+                self._record(event, now_ns)
+
+    def _drain_memory(self) -> None:
+        while True:
+            res = self.w.poll_events(self._after_seq, 1000)
+            events = res.get("events") or []
+            if res.get("gap"):
+                self.gaps += 1
+            if not events:
+                return
+            now_ns = time.perf_counter_ns()
+            for event in events:
+                self._record(event, now_ns)
+            self._after_seq = res["last_seq"]
+
+    def drain(self) -> None:
+        if self.kind == "memory":
+            self._drain_memory()
+        else:
+            self._drain_dir()
+
+    def run(self) -> None:
+        while not self._halt.is_set():
+            self.drain()
+            self._halt.wait(self.interval_s)
+        self.drain()
+
+    def stop(self) -> None:
+        self._halt.set()
+        self.join(timeout=5.0)
+
+
+def run_sink(kind: str, args: argparse.Namespace) -> Dict[str, Any]:
+    tmp = tempfile.mkdtemp(prefix="whitemax-event-load-")
+    ds = generate_dataset(dialogs=args.chats, groups=0, channels=0, messages_per_chat=0, seed=1)
+    w = mcw.MaxClientWrapper("+70000000000", work_dir=tmp, client_factory=fake_client_factory(ds, FakeScenario()))
+    try:
+        w.create_client()
+        reg = w.register_event_callbacks()
+        if not reg.get("success"):
+            raise RuntimeError(reg.get("error"))
+        res = w.configure_event_sink(kind, window_ms=args.window_ms, max_batch=args.max_batch, capacity=args.capacity)
+        if not res.get("success"):
+            raise RuntimeError(res.get("error"))
+        w.reset_metrics()
+        client = w.client
+        chat_ids = [c.id for c in ds.dialogs]
+        rng = random.Random(args.seed)
+
+        consumer = Consumer(w, kind, args.consumer_interval_ms / 1000.0)
+        gc.collect()
+        if args.tracemalloc:
+            tracemalloc.start()
+        mem0 = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+        consumer.start()
+
+        async def produce() -> Dict[str, Any]:
+            recent: Dict[int, List[Any]] = {}
+            edits = 0
+            max_lag = 0.0
+            start = time.perf_counter()
+            for i in range(args.events):
+                if args.rate > 0:
+                    due = start + i / args.rate
+                    lag = time.perf_counter() - due
+                    if lag < -0.001:
+                        await mcw.asyncio.sleep(-lag)
+                    elif lag > max_lag:
+                        max_lag = lag
+                elif i % 100 == 0:
+                    await mcw.asyncio.sleep(0)
+                chat_id = chat_ids[i % len(chat_ids)]
+                text = f"load:{i}:{time.perf_counter_ns()}"
+                own = recent.get(chat_id)
+                if own and rng.random() < args.edit_ratio:
+                    await client.push_edit(chat_id, rng.choice(own).id, text)
+                    edits += 1
+                else:
+                    msg = await client.push_message(chat_id, text, sender=chat_id)
+                    own = recent.setdefault(chat_id, [])
+                    own.append(msg)
+                    # Правим недавние сообщения — как в живом чате.
+                    if len(own) > 4:
+                        own.pop(0)
+            return {"elapsed_s": time.perf_counter() - start, "edits": edits, "max_lag_ms": max_lag * 1000.0}
+
+        prod = w._run_async(produce(), timeout=max(60.0, args.events / max(args.rate, 1) * 4))
+        w._event_sink.flush()
+        # Ждём, пока потребитель заберёт хвост (или пока поток событий не затихнет).
+        deadline = time.perf_counter() + args.drain_timeout_s
+        while len(consumer.seen) < args.events and time.perf_counter() < deadline:
+            if time.perf_counter() - consumer.last_recv > 1.0 and consumer.seen:
+                break
+            time.sleep(0.01)
+        consumer.stop()
+        if args.tracemalloc:
+            gc.collect()
+            cur, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            cur = peak = 0
+
+        sink = w.get_event_sink_stats()["sink"]
+        emit_hist = w.get_metrics()["metrics"]["histograms"].get("emit_event", {})
+        delivered = len(consumer.seen)
+        coalesced = int(sink.get("coalesced", 0))
+        return {
+            "sink": kind,
+            "sent": args.events,
+            "edits": prod["edits"],
+            "delivered": delivered,
+            "coalesced": coalesced,
+            "lost": max(0, args.events - delivered - coalesced),
+            "duplicates": consumer.duplicates,
+            "files_read": consumer.files,
+            "gaps": consumer.gaps,
+            "achieved_rate": round(args.events / prod["elapsed_s"], 1) if prod["elapsed_s"] > 0 else None,
+            "producer_max_lag_ms": round(prod["max_lag_ms"], 3),
+            "e2e_latency": _percentiles(consumer.latencies_ms),
+            "emit_event": {k: emit_hist.get(k) for k in ("count", "p50_ms", "p95_ms", "max_ms")},
+            "mem_peak_kib": round((peak - mem0) / 1024.0, 1) if args.tracemalloc else None,
+            "mem_retained_kib": round((cur - mem0) / 1024.0, 1) if args.tracemalloc else None,
+            "sink_stats": sink,
+        }
+    finally:
+        try:
+            w.stop_client()
+        except Exception:
+            pass
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def print_report(results: List[Dict[str, Any]], args: argparse.Namespace) -> None:
+    print(
+        f"events={args.events} chats={args.chats} rate={args.rate or 'max'}/s edit_ratio={args.edit_ratio} "
+        f"consumer_interval={args.consumer_interval_ms}ms"
+    )
+    header = (
+        f"{'sink':8s} {'delivered':>9s} {'coalesc':>7s} {'lost':>6s} {'files':>6s} {'rate/s':>9s} "
+        f"{'lag ms':>8s} {'e2e p50':>8s} {'p95':>8s} {'p99':>8s} {'max':>8s} {'emit p95':>8s} {'peak KiB':>9s} {'kept KiB':>9s}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['sink']:8s} ERROR {r['error']}")
+            continue
+        lat = r["e2e_latency"]
+        print(
+            f"{r['sink']:8s} {r['delivered']:9d} {r['coalesced']:7d} {r['lost']:6d} {r['files_read']:6d} "
+            f"{r['achieved_rate'] or 0:9.1f} {r['producer_max_lag_ms']:8.1f} {lat['p50_ms']:8.2f} {lat['p95_ms']:8.2f} "
+            f"{lat['p99_ms']:8.2f} {lat['max_ms']:8.2f} {r['emit_event'].get('p95_ms') or 0:8.3f} "
+            f"{r['mem_peak_kib'] if r['mem_peak_kib'] is not None else '-':>9} "
+            f"{r['mem_retained_kib'] if r['mem_retained_kib'] is not None else '-':>9}"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="realtime event burst load generator")
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=2000.0, help="events per second (0 = as fast as possible)")
+    parser.add_argument("--edit-ratio", type=float, default=0.0, help="share of message_edit among events")
+    parser.add_argument("--sinks", default=",".join(SINKS), help="comma-separated: " + ", ".join(SINKS))
+    parser.add_argument("--window-ms", type=float, default=50.0, help="batched sink window")
+    parser.add_argument("--max-batch", type=int, default=500, help="batched sink max events per file")
+    parser.add_argument("--capacity", type=int, default=10_000, help="memory sink ring size")
+    parser.add_argument("--consumer-interval-ms", type=float, default=5.0, help="how often the reader polls")
+    parser.add_argument("--drain-timeout-s", type=float, default=10.0)
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false", help="skip memory tracking (less overhead)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    args = parser.parse_args(argv)
+
+    results = []
+    for kind in [s.strip() for s in args.sinks.split(",") if s.strip()]:
+        try:
+            results.append(run_sink(kind, args))
+        except Exception as e:
+            results.append({"sink": kind, "error": f"{type(e).__name__}: {e}"})
+    if args.json:
+        print(json.dumps({"params": vars(args), "results": results}, indent=2, ensure_ascii=False))
+    else:
+        print_report(results, args)
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,852 @@
+"""
+Локальная замена Max для офлайн-тестов и бенчмарков max_client_wrapper.
+
+Две части:
+  * FakeSocketMaxClient — объект с той поверхностью SocketMaxClient, которой пользуется обёртка
+    (connect/_sync/fetch_history/get_users/get_chats/send_message/... + on_* callbacks,
+    dialogs/chats/channels/_users/me). Подключается через MaxClientWrapper(client_factory=...).
+  * FakeMaxServer — опциональный локальный TCP/TLS сервер с фреймингом как у pymax
+    SocketMaxClient (10-байтный заголовок + msgpack). Из коробки отвечает на handshake, sync,
+    историю, отправку сообщений и запросы контактов/чатов данными того же generate_dataset().
+
+Оба управляются FakeScenario: задержки (база + jitter, по методам), вероятность ошибок,
+обрывы соединения и сценарные отказы "следующих N вызовов". Данные — generate_dataset().
+
+Пример:
+    from devtools.fake_max import FakeScenario, fake_client_factory, generate_dataset
+    ds = generate_dataset(dialogs=200, groups=50, channels=20, messages_per_chat=500, seed=1)
+    w = MaxClientWrapper("+70000000000", work_dir=tmp, client_factory=fake_client_factory(ds, FakeScenario(latency_ms=30)))
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import ssl
+import struct
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class FakeServerError(Exception):
+    """Инъецированная серверная ошибка (аналог pymax Error с кодом)."""
+
+
+class FakeNotConnectedError(ConnectionError):
+    """Инъецированный обрыв соединения; текст совпадает с тем, что ищут ретраи обёртки."""
+
+    def __init__(self, method: str):
+        super().__init__(f"Socket not connected (fake drop in {method})")
+
+
+@dataclass
+class FakeScenario:
+    """
+    Сценарий поведения фейка.
+
+    latency_ms/jitter_ms — задержка каждого вызова; method_latency_ms переопределяет по имени метода.
+    fail_rate/method_fail_rate — вероятность FakeServerError; disconnect_rate — вероятность обрыва
+    (is_connected=False + FakeNotConnectedError). fail_next() — детерминированные отказы.
+    """
+
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    method_latency_ms: Dict[str, float] = field(default_factory=dict)
+    fail_rate: float = 0.0
+    method_fail_rate: Dict[str, float] = field(default_factory=dict)
+    disconnect_rate: float = 0.0
+    seed: Optional[int] = None
+    _scripted: Dict[str, List[BaseException]] = field(default_factory=dict, repr=False)
+    _rng: random.Random = field(default=None, repr=False)  # type: ignore[assignment]
+
+    def __post_init__(self) -> None:
+        self._rng = random.Random(self.seed)
+
+    def fail_next(self, method: str, error: Optional[BaseException] = None, times: int = 1) -> None:
+        """Следующие `times` вызовов `method` завершатся ошибкой (по умолчанию — обрывом соединения)."""
+        for _ in range(times):
+            self._scripted.setdefault(method, []).append(error or FakeNotConnectedError(method))
+
+    def delay_s(self, method: str) -> float:
+        base = self.method_latency_ms.get(method, self.latency_ms)
+        if self.jitter_ms:
+            base += self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, base) / 1000.0
+
+    def pick_failure(self, method: str) -> Optional[BaseException]:
+        queued = self._scripted.get(method)
+        if queued:
+            return queued.pop(0)
+        if self.disconnect_rate and self._rng.random() < self.disconnect_rate:
+            return FakeNotConnectedError(method)
+        rate = self.method_fail_rate.get(method, self.fail_rate)
+        if rate and self._rng.random() < rate:
+            return FakeServerError(f"fake.error: injected failure in {method}")
+        return None
+
+
+@dataclass
+class FakeDataset:
+    me: Any
+    users: Dict[int, Any]
+    dialogs: List[Any]
+    chats: List[Any]
+    channels: List[Any]
+    history: Dict[int, List[Any]]
+    phones: Dict[str, int]
+    channel_names: Dict[str, int]
+
+
+_FIRST_NAMES = ["Алексей", "Мария", "Иван", "Ольга", "Sasha", "Dmitry", "Екатерина", "Пётр", "Anna", "Сергей"]
+_LAST_NAMES = ["Иванов", "Петрова", "Smith", "Кузнецов", "Orlova", "Соколов", "Lee", "Попова"]
+_WORDS = (
+    "привет как дела сегодня завтра встреча созвон отчёт проект ёлка фото документ "
+    "hello meeting report deploy release ok thanks спасибо договорились ссылка"
+).split()
+
+
+def _message(msg_id: int, chat_id: int, sender: int, time_ms: int, text: str) -> Any:
+    return SimpleNamespace(
+        id=msg_id,
+        chat_id=chat_id,
+        sender=sender,
+        time=time_ms,
+        text=text,
+        type="USER",
+        attaches=[],
+        link=None,
+        reactionInfo=None,
+    )
+
+
+def _user(user_id: int, name: str, phone: str) -> Any:
+    return SimpleNamespace(
+        id=user_id,
+        names=[SimpleNamespace(name=name, first_name=name.split(" ")[0])],
+        photo_id=user_id * 10,
+        base_url=f"https://fake.max.local/avatar/{user_id}",
+        base_raw_url=None,
+        phone=phone,
+    )
+
+
+def generate_dataset(
+    dialogs: int = 50,
+    groups: int = 20,
+    channels: int = 5,
+    messages_per_chat: int = 200,
+    seed: int = 0,
+    me_id: int = 1,
+) -> FakeDataset:
+    """Детерминированно сгенерировать аккаунт: пользователи, диалоги, группы, каналы и история."""
+    rng = random.Random(seed)
+    me = _user(me_id, "Я Тестовый", "+70000000000")
+    users: Dict[int, Any] = {me_id: me}
+    phones: Dict[str, int] = {}
+    history: Dict[int, List[Any]] = {}
+    msg_ids = itertools.count(10_000)
+    now_ms = int(time.time() * 1000)
+
+    def _history(chat_id: int, members: List[int]) -> List[Any]:
+        t = now_ms - messages_per_chat * 60_000
+        out = []
+        for _ in range(messages_per_chat):
+            t += rng.randint(1_000, 120_000)
+            text = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 12)))
+            out.append(_message(next(msg_ids), chat_id, rng.choice(members), min(t, now_ms), text))
+        return out
+
+    dialog_objs = []
+    for i in range(dialogs):
+        uid = 1000 + i
+        phone = f"+7900{uid:07d}"
+        users[uid] = _user(uid, f"{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)}", phone)
+        phones[phone] = uid
+        chat_id = me_id ^ uid if (me_id ^ uid) > 0 else uid
+        dialog_objs.append(SimpleNamespace(id=chat_id, cid=uid, participants={str(me_id): 0, str(uid): 0}))
+        history[chat_id] = _history(chat_id, [me_id, uid])
+
+    group_objs = []
+    user_ids = [u for u in users if u != me_id] or [me_id]
+    for i in range(groups):
+        chat_id = -(100_000 + i)
+        group_objs.append(
+            SimpleNamespace(
+                id=chat_id,
+                title=f"Группа {rng.choice(_WORDS)} #{i}",
+                type="CHAT",
+                base_icon_url=f"https://fake.max.local/chat/{chat_id}",
+            )
+        )
+        members = [me_id] + rng.sample(user_ids, k=min(len(user_ids), 5))
+        history[chat_id] = _history(chat_id, members)
+
+    channel_objs = []
+    channel_names: Dict[str, int] = {}
+    for i in range(channels):
+        chat_id = -(200_000 + i)
+        name = f"channel{i}"
+        channel_names[name] = chat_id
+        channel_objs.append(
+            SimpleNamespace(
+                id=chat_id,
+                title=f"Канал {name}",
+                type="CHANNEL",
+                base_icon_url=f"https://fake.max.local/chat/{chat_id}",
+            )
+        )
+        history[chat_id] = _history(chat_id, [user_ids[0]])
+
+    return FakeDataset(
+        me=me,
+        users=users,
+        dialogs=dialog_objs,
+        chats=group_objs,
+        channels=channel_objs,
+        history=history,
+        phones=phones,
+        channel_names=channel_names,
+    )
+
+
+class FakeSocketMaxClient:
+    """
+    Фейковый SocketMaxClient. Конструктор совместим с вызовом из MaxClientWrapper.create_client
+    (phone/work_dir/headers/token/reconnect); dataset и scenario передаются через fake_client_factory.
+    Счётчики вызовов — в self.calls; события можно "прислать с сервера" через push_* методы.
+    """
+
+    def __init__(
+        self,
+        phone: Optional[str] = None,
+        work_dir: Optional[str] = None,
+        headers: Any = None,
+        token: Optional[str] = None,
+        reconnect: bool = False,
+        dataset: Optional[FakeDataset] = None,
+        scenario: Optional[FakeScenario] = None,
+    ):
+        self.phone = phone
+        self.work_dir = work_dir
+        self.user_agent = headers
+        self._token = token
+        self.reconnect = reconnect
+        self.dataset = dataset or generate_dataset()
+        self.scenario = scenario or FakeScenario()
+        self.is_connected = False
+        self.me: Any = None
+        self._socket: Any = None
+        self._users: Dict[int, Any] = {}
+        self._file_upload_waiters: Dict[int, Any] = {}
+        self.dialogs: List[Any] = []
+        self.chats: List[Any] = []
+        self.channels: List[Any] = []
+        self.calls: Dict[str, int] = {}
+        self._msg_ids = itertools.count(10_000_000)
+        self._handlers: Dict[str, List[Callable[..., Awaitable[Any]]]] = {
+            "message": [],
+            "message_edit": [],
+            "message_delete": [],
+            "reaction_change": [],
+            "chat_update": [],
+        }
+
+    # --- инфраструктура ---
+
+    async def _io(self, method: str, needs_connection: bool = True) -> None:
+        """Общая точка для всех "сетевых" вызовов: счётчик, задержка, инъекция отказов."""
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if needs_connection and not self.is_connected:
+            raise FakeNotConnectedError(method)
+        delay = self.scenario.delay_s(method)
+        if delay:
+            await asyncio.sleep(delay)
+        err = self.scenario.pick_failure(method)
+        if err is not None:
+            if isinstance(err, ConnectionError):
+                self.is_connected = False
+            raise err
+
+    def _history(self, chat_id: int) -> List[Any]:
+        return self.dataset.history.setdefault(int(chat_id), [])
+
+    def _find_message(self, chat_id: int, message_id: Any) -> Any:
+        for m in self._history(chat_id):
+            if str(m.id) == str(message_id):
+                return m
+        raise FakeServerError(f"message.not.found: {message_id}")
+
+    # --- соединение/сессия ---
+
+    async def connect(self, user_agent: Any = None) -> None:
+        await self._io("connect", needs_connection=False)
+        self.is_connected = True
+        self._socket = SimpleNamespace(close=lambda: None)
+
+    async def _cleanup_client(self) -> None:
+        self.is_connected = False
+        self._socket = None
+
+    async def close(self) -> None:
+        self.calls["close"] = self.calls.get("close", 0) + 1
+        self.is_connected = False
+
+    async def request_code(self, phone: str, language: str = "ru") -> str:
+        await self._io("request_code")
+        return f"temp_{phone}"
+
+    async def login_with_code(self, temp_token: str, code: str, start: bool = False) -> None:
+        await self._io("login_with_code")
+        if code != "000000":
+            raise FakeServerError("login.cred: invalid code")
+        self._token = f"token_{temp_token}"
+        await self._sync(self.user_agent)
+
+    async def _sync(self, user_agent: Any = None) -> None:
+        await self._io("_sync")
+        if not self._token:
+            raise FakeServerError("login.token: no token")
+        ds = self.dataset
+        self.me = ds.me
+        self._users[ds.me.id] = ds.me
+        self.dialogs = list(ds.dialogs)
+        self.chats = list(ds.chats)
+        self.channels = list(ds.channels)
+
+    async def _post_login_tasks(self, sync: bool = False) -> None:
+        await self._io("_post_login_tasks")
+
+    # --- чтение ---
+
+    async def fetch_history(
+        self, chat_id: int, from_time: Optional[int] = None, forward: int = 0, backward: int = 200
+    ) -> List[Any]:
+        await self._io("fetch_history")
+        hist = self._history(chat_id)
+        if from_time is None:
+            older = hist
+        else:
+            older = [m for m in hist if m.time <= from_time]
+        return list(older[-backward:]) if backward else []
+
+    async def get_users(self, user_ids: List[int]) -> List[Any]:
+        await self._io("get_users")
+        out = []
+        for uid in user_ids:
+            u = self.dataset.users.get(int(uid))
+            if u is not None:
+                self._users[int(uid)] = u
+                out.append(u)
+        return out
+
+    async def get_chats(self, chat_ids: List[int]) -> List[Any]:
+        await self._io("get_chats")
+        by_id = {c.id: c for c in self.dataset.chats + self.dataset.channels}
+        return [by_id[int(c)] for c in chat_ids if int(c) in by_id]
+
+    async def fetch_chats(self, marker: Optional[int] = None) -> List[Any]:
+        await self._io("fetch_chats")
+        return list(self.dataset.chats)
+
+    async def search_by_phone(self, phone: str) -> Any:
+        await self._io("search_by_phone")
+        uid = self.dataset.phones.get(phone) or self.dataset.phones.get("+" + "".join(c for c in phone if c.isdigit()))
+        if uid is None:
+            raise FakeServerError("not.found: user not found")
+        return self.dataset.users[uid]
+
+    async def resolve_channel_by_name(self, name: str) -> Any:
+        await self._io("resolve_channel_by_name")
+        cid = self.dataset.channel_names.get(name.lower())
+        if cid is None:
+            return None
+        return next(c for c in self.dataset.channels if c.id == cid)
+
+    async def get_file_by_id(self, chat_id: int, message_id: Any, file_id: int) -> Any:
+        await self._io("get_file_by_id")
+        return SimpleNamespace(url=f"https://fake.max.local/file/{file_id}", unsafe=False)
+
+    async def get_video_by_id(self, chat_id: int, message_id: Any, video_id: int) -> Any:
+        await self._io("get_video_by_id")
+        return SimpleNamespace(url=f"https://fake.max.local/video/{video_id}", cache=False)
+
+    async def get_folders(self, folder_sync: int = 0) -> Any:
+        await self._io("get_folders")
+        return SimpleNamespace(folders=[], folder_sync=folder_sync)
+
+    # --- запись ---
+
+    async def send_message(
+        self, text: str, chat_id: int, reply_to: Optional[int] = None, notify: bool = True, attachment: Any = None
+    ) -> Any:
+        await self._io("send_message")
+        msg = _message(next(self._msg_ids), int(chat_id), self.dataset.me.id, int(time.time() * 1000), text)
+        if reply_to is not None:
+            msg.link = SimpleNamespace(type="REPLY", message_id=reply_to)
+        self._history(chat_id).append(msg)
+        # Как и настоящий сервер, присылаем эхо собственного сообщения.
+        asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._dispatch("message", msg)))
+        return msg
+
+    async def edit_message(self, chat_id: int, message_id: int, text: str) -> Any:
+        await self._io("edit_message")
+        msg = self._find_message(chat_id, message_id)
+        msg.text = text
+        return msg
+
+    async def delete_message(self, chat_id: int, message_ids: List[int], for_me: bool = True) -> bool:
+        await self._io("delete_message")
+        ids = {str(i) for i in message_ids}
+        hist = self._history(chat_id)
+        hist[:] = [m for m in hist if str(m.id) not in ids]
+        return True
+
+    async def pin_message(self, chat_id: int, message_id: int, notify_pin: bool = True) -> bool:
+        await self._io("pin_message")
+        return True
+
+    async def read_message(self, message_id: int, chat_id: int) -> Any:
+        await self._io("read_message")
+        return SimpleNamespace(unread=0, mark=int(time.time() * 1000))
+
+    async def add_reaction(self, chat_id: int, message_id: str, reaction: str) -> Any:
+        await self._io("add_reaction")
+        return SimpleNamespace(
+            counters=[SimpleNamespace(reaction=reaction, count=1)], your_reaction=reaction, total_count=1
+        )
+
+    async def remove_reaction(self, chat_id: int, message_id: str) -> Any:
+        await self._io("remove_reaction")
+        return SimpleNamespace(counters=[], your_reaction=None, total_count=0)
+
+    async def join_group(self, link: str) -> Any:
+        await self._io("join_group")
+        if "invalid" in link:
+            raise FakeServerError("not.found: link not found")
+        return self.dataset.chats[0] if self.dataset.chats else None
+
+    async def join_channel(self, link: str) -> Any:
+        await self._io("join_channel")
+        name = link.rstrip("/").rsplit("/", 1)[-1].lstrip("@").lower()
+        return await self.resolve_channel_by_name(name)
+
+    async def leave_group(self, chat_id: int) -> None:
+        await self._io("leave_group")
+
+    async def leave_channel(self, chat_id: int) -> None:
+        await self._io("leave_channel")
+
+    async def change_profile(self, *args: Any, **kwargs: Any) -> bool:
+        await self._io("change_profile")
+        return True
+
+    # --- callbacks ---
+
+    def on_message(self, *args: Any, **kwargs: Any) -> Callable[[Callable[..., Awaitable[Any]]], Any]:
+        def decorator(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self._handlers["message"].append(fn)
+            return fn
+
+        return decorator
+
+    def on_message_edit(self, *args: Any, **kwargs: Any) -> Callable[[Callable[..., Awaitable[Any]]], Any]:
+        def decorator(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self._handlers["message_edit"].append(fn)
+            return fn
+
+        return decorator
+
+    def on_message_delete(self, *args: Any, **kwargs: Any) -> Callable[[Callable[..., Awaitable[Any]]], Any]:
+        def decorator(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self._handlers["message_delete"].append(fn)
+            return fn
+
+        return decorator
+
+    def on_reaction_change(self, fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        self._handlers["reaction_change"].append(fn)
+        return fn
+
+    def on_chat_update(self, fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        self._handlers["chat_update"].append(fn)
+        return fn
+
+    async def _dispatch(self, kind: str, *args: Any) -> None:
+        for fn in list(self._handlers[kind]):
+            await fn(*args)
+
+    # --- "сервер прислал" (для нагрузочных сценариев событий) ---
+
+    async def push_message(self, chat_id: int, text: str, sender: Optional[int] = None) -> Any:
+        msg = _message(next(self._msg_ids), int(chat_id), sender or 0, int(time.time() * 1000), text)
+        self._history(chat_id).append(msg)
+        await self._dispatch("message", msg)
+        return msg
+
+    async def push_edit(self, chat_id: int, message_id: Any, text: str) -> Any:
+        msg = self._find_message(chat_id, message_id)
+        msg.text = text
+        await self._dispatch("message_edit", msg)
+        return msg
+
+    async def push_delete(self, chat_id: int, message_id: Any) -> None:
+        msg = self._find_message(chat_id, message_id)
+        self._history(chat_id).remove(msg)
+        await self._dispatch("message_delete", msg)
+
+    async def push_reaction(self, chat_id: int, message_id: Any, reaction: str, count: int = 1) -> None:
+        info = SimpleNamespace(counters=[SimpleNamespace(reaction=reaction, count=count)], total_count=count)
+        await self._dispatch("reaction_change", str(message_id), int(chat_id), info)
+
+    async def push_chat_update(self, chat_id: int, title: str) -> None:
+        for c in self.dataset.chats + self.dataset.channels:
+            if c.id == chat_id:
+                c.title = title
+                await self._dispatch("chat_update", c)
+                return
+        raise FakeServerError(f"chat.not.found: {chat_id}")
+
+
+def fake_client_factory(
+    dataset: Optional[FakeDataset] = None,
+    scenario: Optional[FakeScenario] = None,
+    token: Optional[str] = "fake-token",
+) -> Callable[..., FakeSocketMaxClient]:
+    """Фабрика для MaxClientWrapper(client_factory=...): один dataset/scenario на все создаваемые клиенты."""
+    ds = dataset or generate_dataset()
+    sc = scenario or FakeScenario()
+
+    def factory(**kwargs: Any) -> FakeSocketMaxClient:
+        kwargs.setdefault("token", None)
+        if kwargs["token"] is None:
+            kwargs["token"] = token
+        return FakeSocketMaxClient(dataset=ds, scenario=sc, **kwargs)
+
+    return factory
+
+
+# --- Опциональный TCP/TLS сервер ---
+
+# Заголовок кадра pymax SocketMaxClient: ver(1) cmd(2) seq(1) opcode(2) flags|len(4), big-endian.
+_HEADER = struct.Struct(">BHBHI")
+
+# Номера опкодов, если pymax не установлен (с ним берутся из pymax.static.enum.Opcode).
+_DEFAULT_OPCODES: Dict[str, int] = {
+    "PING": 1,
+    "SESSION_INIT": 6,
+    "LOGIN": 19,
+    "SYNC": 21,
+    "CONTACT_INFO": 32,
+    "CHAT_INFO": 48,
+    "CHAT_HISTORY": 49,
+    "MSG_SEND": 64,
+    "NOTIF_MESSAGE": 128,
+}
+
+
+def _load_msgpack() -> Any:
+    try:
+        import msgpack
+
+        return msgpack
+    except Exception as e:
+        raise RuntimeError("FakeMaxServer requires msgpack (pip install msgpack)") from e
+
+
+def opcode_value(name: str, default: Optional[int] = None) -> Optional[int]:
+    """Номер опкода из pymax.static.enum.Opcode, если pymax установлен; иначе default."""
+    try:
+        from pymax.static.enum import Opcode
+
+        return int(getattr(Opcode, name))
+    except Exception:
+        return default
+
+
+def _wire_message(m: Any) -> Dict[str, Any]:
+    out: Dict[str, Any] = {
+        "id": m.id,
+        "time": m.time,
+        "sender": m.sender,
+        "text": m.text,
+        "type": m.type,
+        "attaches": list(m.attaches or []),
+    }
+    link = getattr(m, "link", None)
+    if link is not None:
+        out["link"] = {"type": link.type, "messageId": link.message_id}
+    return out
+
+
+def _wire_user(u: Any) -> Dict[str, Any]:
+    return {
+        "id": u.id,
+        "names": [{"name": n.name, "firstName": n.first_name, "type": "ONEME"} for n in u.names],
+        "photoId": u.photo_id,
+        "baseUrl": u.base_url,
+        "baseRawUrl": u.base_raw_url,
+        "phone": u.phone,
+    }
+
+
+class FakeMaxServer:
+    """
+    Локальный сервер с кадрами как у SocketMaxClient. Ответ на кадр: тот же seq/opcode, cmd=1,
+    payload от обработчика. Обработчики регистрируются по номеру опкода (route, см. opcode_value);
+    встроенные (install_default_handlers) отвечают данными dataset: PING, SESSION_INIT, LOGIN/SYNC,
+    CONTACT_INFO, CHAT_INFO, CHAT_HISTORY, MSG_SEND (+ эхо NOTIF_MESSAGE всем соединениям).
+    Без обработчика отвечает пустым payload.
+
+    Задержки/ошибки/обрывы — из FakeScenario по тем же именам методов, что у FakeSocketMaxClient
+    ("_sync", "fetch_history", "send_message", ...; для прочих опкодов — "op<N>"), так что один
+    сценарий годится для обоих фейков. FakeServerError превращается в payload
+    {"error": ..., "message": ...}, обрыв — в закрытие сокета.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        scenario: Optional[FakeScenario] = None,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        dataset: Optional[FakeDataset] = None,
+        default_handlers: bool = True,
+    ):
+        self.host = host
+        self.port = port
+        self.scenario = scenario or FakeScenario()
+        self.ssl_context = ssl_context
+        self.dataset = dataset or generate_dataset()
+        self.handlers: Dict[int, Callable[[Dict[str, Any]], Any]] = {}
+        self.methods: Dict[int, str] = {}
+        self.stats: Dict[str, int] = {"connections": 0, "frames": 0, "errors": 0, "drops": 0, "pushes": 0}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._conns: set = set()
+        self._writers: set = set()
+        self._msg_ids = itertools.count(20_000_000)
+        self._msgpack = _load_msgpack()
+        if default_handlers:
+            self.install_default_handlers()
+
+    @staticmethod
+    def tls_context(certfile: str, keyfile: str) -> ssl.SSLContext:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certfile, keyfile)
+        return ctx
+
+    def route(
+        self, opcode: int, method: Optional[str] = None
+    ) -> Callable[[Callable[[Dict[str, Any]], Any]], Callable[[Dict[str, Any]], Any]]:
+        def decorator(fn: Callable[[Dict[str, Any]], Any]) -> Callable[[Dict[str, Any]], Any]:
+            self.handlers[int(opcode)] = fn
+            if method:
+                self.methods[int(opcode)] = method
+            return fn
+
+        return decorator
+
+    # --- встроенные обработчики на данных dataset ---
+
+    def install_default_handlers(self) -> None:
+        def op(name: str) -> int:
+            return int(opcode_value(name, _DEFAULT_OPCODES[name]))
+
+        self.route(op("PING"), "ping")(lambda payload: {})
+        self.route(op("SESSION_INIT"), "connect")(self._on_session_init)
+        self.route(op("LOGIN"), "_sync")(self._on_sync)
+        self.route(op("SYNC"), "_sync")(self._on_sync)
+        self.route(op("CONTACT_INFO"), "get_users")(self._on_contact_info)
+        self.route(op("CHAT_INFO"), "get_chats")(self._on_chat_info)
+        self.route(op("CHAT_HISTORY"), "fetch_history")(self._on_history)
+        self.route(op("MSG_SEND"), "send_message")(self._on_send)
+
+    def _chat_peer(self, dialog: Any) -> int:
+        me_id = self.dataset.me.id
+        return next((int(u) for u in dialog.participants if int(u) != me_id), me_id)
+
+    def _wire_chat(self, chat: Any) -> Dict[str, Any]:
+        hist = self.dataset.history.get(chat.id) or []
+        out: Dict[str, Any] = {"id": chat.id, "lastMessage": _wire_message(hist[-1]) if hist else None}
+        if hasattr(chat, "participants"):
+            out.update(type="DIALOG", cid=chat.cid, participants=dict(chat.participants))
+        else:
+            out.update(type=chat.type, title=chat.title, baseIconUrl=chat.base_icon_url)
+        return out
+
+    def _on_session_init(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return {"location": "RU", "app-update-type": 0, "reg-country-code": ["RU"], "phone-auto-complete-enabled": False}
+
+    def _on_sync(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if not payload.get("token"):
+            raise FakeServerError("login.token: no token")
+        ds = self.dataset
+        contacts = [ds.users[self._chat_peer(d)] for d in ds.dialogs if self._chat_peer(d) in ds.users]
+        return {
+            "token": payload["token"],
+            "profile": {"contact": _wire_user(ds.me)},
+            "chats": [self._wire_chat(c) for c in ds.dialogs + ds.chats + ds.channels],
+            "contacts": [_wire_user(u) for u in contacts],
+            "time": int(time.time() * 1000),
+        }
+
+    def _on_contact_info(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        users = self.dataset.users
+        ids = [int(u) for u in payload.get("contactIds") or []]
+        return {"contacts": [_wire_user(users[u]) for u in ids if u in users]}
+
+    def _on_chat_info(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        ds = self.dataset
+        by_id = {c.id: c for c in ds.dialogs + ds.chats + ds.channels}
+        ids = [int(c) for c in payload.get("chatIds") or []]
+        return {"chats": [self._wire_chat(by_id[c]) for c in ids if c in by_id]}
+
+    def _on_history(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        hist = self.dataset.history.get(int(payload.get("chatId") or 0)) or []
+        from_time = payload.get("from")
+        backward = int(payload.get("backward") or 0)
+        forward = int(payload.get("forward") or 0)
+        if from_time is None:
+            older, newer = hist, []
+        else:
+            older = [m for m in hist if m.time <= from_time]
+            newer = [m for m in hist if m.time > from_time]
+        picked = (older[-backward:] if backward else []) + newer[:forward]
+        return {"messages": [_wire_message(m) for m in picked]}
+
+    def _on_send(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(payload.get("chatId") or 0)
+        body = payload.get("message") or {}
+        msg = _message(next(self._msg_ids), chat_id, self.dataset.me.id, int(time.time() * 1000), body.get("text") or "")
+        msg.attaches = list(body.get("attaches") or [])
+        link = body.get("link")
+        if isinstance(link, dict) and link.get("messageId") is not None:
+            msg.link = SimpleNamespace(type=link.get("type", "REPLY"), message_id=link["messageId"])
+        self.dataset.history.setdefault(chat_id, []).append(msg)
+        out = {"chatId": chat_id, "message": dict(_wire_message(msg), cid=body.get("cid"))}
+        # Как и настоящий сервер, присылаем эхо собственного сообщения (после ответа на запрос).
+        notif = int(opcode_value("NOTIF_MESSAGE", _DEFAULT_OPCODES["NOTIF_MESSAGE"]))
+        asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self.push(notif, out)))
+        return out
+
+    # --- транспорт ---
+
+    def _pack(self, ver: int, cmd: int, seq: int, opcode: int, payload: Any) -> bytes:
+        body = self._msgpack.packb(payload)
+        return _HEADER.pack(ver, cmd, seq & 0xFF, opcode, len(body) & 0xFFFFFF) + body
+
+    async def push(self, opcode: int, payload: Any) -> None:
+        """Серверное уведомление (cmd=0, seq=0) во все открытые соединения."""
+        frame = self._pack(10, 0, 0, opcode, payload)
+        for writer in list(self._writers):
+            try:
+                writer.write(frame)
+                await writer.drain()
+                self.stats["pushes"] += 1
+            except (ConnectionError, RuntimeError):
+                self._writers.discard(writer)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.stats["connections"] += 1
+        task = asyncio.current_task()
+        self._conns.add(task)
+        self._writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                ver, cmd, seq, opcode, packed_len = _HEADER.unpack(header)
+                body = await reader.readexactly(packed_len & 0xFFFFFF)
+                if packed_len >> 24:
+                    import lz4.block
+
+                    body = lz4.block.decompress(body, uncompressed_size=1 << 22)
+                payload = self._msgpack.unpackb(body, raw=False, strict_map_key=False) if body else None
+                self.stats["frames"] += 1
+                method = self.methods.get(opcode, f"op{opcode}")
+                delay = self.scenario.delay_s(method)
+                if delay:
+                    await asyncio.sleep(delay)
+                err = self.scenario.pick_failure(method)
+                if isinstance(err, ConnectionError):
+                    self.stats["drops"] += 1
+                    return
+                out: Any
+                if err is None:
+                    handler = self.handlers.get(opcode)
+                    try:
+                        out = handler(payload or {}) if handler is not None else {}
+                        if asyncio.iscoroutine(out):
+                            out = await out
+                    except FakeServerError as e:
+                        err = e
+                if err is not None:
+                    self.stats["errors"] += 1
+                    out = {"error": "fake.error", "message": str(err)}
+                writer.write(self._pack(ver, 1, seq, opcode, out))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._conns.discard(task)
+            self._writers.discard(writer)
+            writer.close()
+
+    async def start(self) -> "FakeMaxServer":
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, ssl=self.ssl_context)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._conns):
+                task.cancel()
+            await asyncio.gather(*self._conns, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description="Run a local fake Max socket server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--cert", help="PEM certificate (enables TLS together with --key)")
+    parser.add_argument("--key", help="PEM private key")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--dialogs", type=int, default=50)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--messages-per-chat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scenario = FakeScenario(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        fail_rate=args.fail_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+    dataset = generate_dataset(
+        dialogs=args.dialogs,
+        groups=args.groups,
+        channels=args.channels,
+        messages_per_chat=args.messages_per_chat,
+        seed=args.seed,
+    )
+    ctx = FakeMaxServer.tls_context(args.cert, args.key) if args.cert and args.key else None
+
+    async def _run() -> None:
+        server = await FakeMaxServer(args.host, args.port, scenario, ctx, dataset=dataset).start()
+        print(f"fake Max server on {args.host}:{server.port} ({'TLS' if ctx else 'plain'})")
+        await asyncio.Event().wait()
+
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,144 @@
+"""
+Отчёт о времени импорта max_client_wrapper (по `python -X importtime`) с проверкой бюджета.
+
+Каждый сценарий запускается в отдельном процессе несколько раз (берётся медиана), из stderr
+разбираются строки importtime. Кроме общего времени проверяется, что тяжёлые модули
+(pymax, pydantic_core, asyncio, ssl, ...) НЕ загружаются на путях, где они не нужны.
+
+Запуск (из whitemax/app):
+    python -m devtools.importtime_report                 # отчёт + проверка бюджета (exit 1 при превышении)
+    python -m devtools.importtime_report --budget-ms 40 --top 15
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули, которых не должно быть в sys.modules после сценария.
+HEAVY = ["pymax", "pydantic_core", "pydantic", "asyncio", "ssl", "aiohttp", "concurrent.futures", "sqlite3", "uuid"]
+
+SCENARIOS: Dict[str, Tuple[str, List[str]]] = {
+    # имя: (код после import, запрещённые модули)
+    "import": ("", HEAVY),
+    "create_wrapper+get_events_dir": (
+        "m.create_wrapper('+70000000000', {work_dir!r}); m.get_events_dir()",
+        HEAVY,
+    ),
+    "filter_chats": (
+        "m.create_wrapper('+70000000000', {work_dir!r}); m.filter_chats('abc', 10)",
+        HEAVY,
+    ),
+    "get_pymax_status": ("m.get_pymax_status()", HEAVY),
+    # Поиск по локальному индексу: sqlite3 и пул потоков допустимы, pymax — нет.
+    "search_messages": (
+        "m.create_wrapper('+70000000000', {work_dir!r}); m.search_messages('abc')",
+        ["pymax", "pydantic_core", "pydantic", "asyncio", "ssl", "aiohttp"],
+    ),
+}
+
+_PROBE = """
+import sys, json
+sys.path.insert(0, {app_dir!r})
+import max_client_wrapper as m
+{body}
+print(json.dumps(sorted(k for k in {heavy!r} if k in sys.modules)))
+"""
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """module -> (self_us, cumulative_us) из вывода -X importtime."""
+    out: Dict[str, Tuple[int, int]] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            _, rest = line.split(":", 1)
+            self_us, cum_us, name = rest.split("|", 2)
+            out[name.strip()] = (int(self_us), int(cum_us))
+        except ValueError:
+            continue
+    return out
+
+
+def run_scenario(name: str, runs: int) -> Dict[str, Any]:
+    body, forbidden = SCENARIOS[name]
+    work_dir = tempfile.mkdtemp(prefix="whitemax-importtime-")
+    code = _PROBE.format(app_dir=APP_DIR, body=body.format(work_dir=work_dir), heavy=HEAVY)
+    totals: List[int] = []
+    last: Dict[str, Tuple[int, int]] = {}
+    loaded: List[str] = []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            cwd=APP_DIR,
+            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "0"},
+        )
+        if proc.returncode != 0:
+            return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"}
+        last = parse_importtime(proc.stderr)
+        totals.append(last.get("max_client_wrapper", (0, 0))[1])
+        loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+    return {
+        "import_ms": round(statistics.median(totals) / 1000.0, 2),
+        "loaded_heavy": loaded,
+        "forbidden_loaded": [m for m in loaded if m in forbidden],
+        "modules": last,
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="max_client_wrapper import-time report")
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="max median import time of max_client_wrapper")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="show N slowest modules (cumulative) for 'import'")
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    args = parser.parse_args(argv)
+
+    report: Dict[str, Any] = {}
+    failures: List[str] = []
+    for name in SCENARIOS:
+        r = run_scenario(name, args.runs)
+        report[name] = r
+        if "error" in r:
+            failures.append(f"{name}: {r['error']}")
+            continue
+        if r["forbidden_loaded"]:
+            failures.append(f"{name}: loaded {', '.join(r['forbidden_loaded'])}")
+    imp = report.get("import", {})
+    if "import_ms" in imp and imp["import_ms"] > args.budget_ms:
+        failures.append(f"import: {imp['import_ms']} ms > budget {args.budget_ms} ms")
+
+    if args.json:
+        print(json.dumps({k: {kk: vv for kk, vv in v.items() if kk != "modules"} for k, v in report.items()}, indent=2))
+    else:
+        for name, r in report.items():
+            if "error" in r:
+                print(f"{name:32s} ERROR {r['error']}")
+                continue
+            print(f"{name:32s} {r['import_ms']:8.2f} ms   heavy loaded: {', '.join(r['loaded_heavy']) or '-'}")
+        mods = imp.get("modules") or {}
+        if mods:
+            print(f"\nslowest modules during 'import' (cumulative):")
+            for mod, (self_us, cum_us) in sorted(mods.items(), key=lambda kv: -kv[1][1])[: args.top]:
+                print(f"  {cum_us / 1000.0:8.2f} ms  (self {self_us / 1000.0:6.2f})  {mod}")
+
+    if failures:
+        print("\nBUDGET CHECK FAILED:")
+        for f in failures:
+            print("  " + f)
+        return 1
+    print(f"\nbudget ok (import <= {args.budget_ms} ms, no forbidden modules)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
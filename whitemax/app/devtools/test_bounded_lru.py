@@ -0,0 +1,39 @@
+import copy
+import pickle
+
+from max_client_wrapper import _BoundedLRU
+
+
+def test_evicts_least_recently_used():
+    lru = _BoundedLRU(3)
+    for i in range(3):
+        lru[i] = i
+    assert lru.get(0) == 0  # 0 снова свежий
+    lru[3] = 3
+    assert list(lru) == [2, 0, 3]
+    assert 1 not in lru
+    assert lru.evictions == 1
+
+
+def test_pinned_keys_stay_and_only_present_ones_extend_the_bound():
+    lru = _BoundedLRU(3, pinned={1, 2, 99})
+    for i in range(10):
+        lru[i] = i
+    # 99 отсутствует в словаре и предел не расширяет: 3 обычных + 2 закреплённых.
+    assert {1, 2} <= set(lru)
+    assert len(lru) == 5
+    assert lru.snapshot()["evictions"] == 5
+
+
+def test_init_items_use_the_given_limits():
+    lru = _BoundedLRU(2, items={i: i for i in range(6)}, pinned={0, 1})
+    assert set(lru) == {0, 1, 4, 5}
+
+
+def test_copies_keep_limits_and_entries():
+    lru = _BoundedLRU(10_000, items={i: i for i in range(8_000)}, pinned={5})
+    lru.evictions = 3
+    for dup in (lru.copy(), copy.copy(lru), copy.deepcopy(lru), pickle.loads(pickle.dumps(lru))):
+        assert type(dup) is _BoundedLRU
+        assert len(dup) == 8_000
+        assert (dup.max_entries, dup.pinned, dup.evictions) == (10_000, {5}, 3)
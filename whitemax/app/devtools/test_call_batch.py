@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+import max_client_wrapper
+from devtools.fake_max import FakeScenario, FakeServerError, fake_client_factory, generate_dataset
+
+
+@pytest.fixture
+def batch_env(tmp_path):
+    ds = generate_dataset(dialogs=3, groups=0, channels=0, messages_per_chat=10, seed=1)
+    scenario = FakeScenario()
+    w = max_client_wrapper.MaxClientWrapper(
+        "+70000000000", work_dir=str(tmp_path), client_factory=fake_client_factory(ds, scenario)
+    )
+    assert w.create_client()["success"]
+    w.configure_thumbnails(prefetch_count=0)
+    yield w, ds, scenario
+    w.stop_client()
+
+
+def _results(batch):
+    return [e["result"] for e in batch["results"]]
+
+
+def test_sequential_keeps_order_and_reports_per_op(batch_env):
+    w, ds, _ = batch_env
+    cid = ds.dialogs[0].id
+    ops = [
+        {"op": "send_message", "args": {"chat_id": cid, "text": "первое"}, "id": "a"},
+        {"op": "send_message", "args": {"chat_id": cid, "text": "второе"}, "id": "b"},
+        {"op": "get_messages", "args": {"chat_id": cid, "limit": 5}, "id": "m"},
+    ]
+    batch = w.call_batch(ops, sequential=True)
+    assert batch["success"] and batch["failed"] == 0
+    assert [e["id"] for e in batch["results"]] == ["a", "b", "m"]
+    assert [m.text for m in ds.history[cid][-2:]] == ["первое", "второе"]
+    assert all(e["ms"] >= 0 for e in batch["results"])
+
+
+def test_isolated_failure_does_not_affect_other_ops(batch_env):
+    w, ds, scenario = batch_env
+    cid = ds.dialogs[0].id
+    scenario.fail_next("get_folders", FakeServerError("boom"))
+    batch = w.call_batch(
+        [
+            {"op": "get_folders"},
+            {"op": "nope"},
+            {"op": "get_messages", "args": {"chat_id": cid, "limit": 3}},
+        ]
+    )
+    results = _results(batch)
+    # В режиме isolate батч успешен, ошибки — в результатах операций и в счётчике failed.
+    assert batch["success"] and batch["failed"] == 2
+    assert "boom" in results[0]["error"]
+    assert results[1]["error"] == "Unsupported op: nope"
+    assert results[2]["success"] and len(results[2]["messages"]) == 3
+
+
+def test_not_isolated_validates_all_specs_before_running(batch_env):
+    w, _, _ = batch_env
+    batch = w.call_batch([{"op": "get_folders"}, {"op": "nope"}], isolate=False)
+    assert batch["error"] == "Unsupported op: nope"
+    assert _results(batch)[0].get("skipped")
+    assert not w.client.calls.get("get_folders")
+
+
+def test_not_isolated_marks_pool_ops_running_and_cancels_the_rest(batch_env):
+    w, ds, scenario = batch_env
+    cid = ds.dialogs[0].id
+    scenario.method_latency_ms.update({"read_message": 300, "get_folders": 300})
+    batch = w.call_batch(
+        [
+            {"op": "read_message", "args": [cid, 5, False]},
+            {"op": "get_folders"},
+            {"op": "get_messages", "args": {"chat_id": cid, "bogus": 1}},
+        ],
+        isolate=False,
+    )
+    results = _results(batch)
+    assert "bogus" in batch["error"]
+    assert results[0].get("running") and results[0]["error"] == "outcome unknown: still running"
+    assert results[1].get("skipped")
+    time.sleep(0.4)
+
+
+def test_timeout_status(batch_env):
+    w, ds, scenario = batch_env
+    cid = ds.dialogs[0].id
+    scenario.method_latency_ms.update({"send_message": 300, "get_folders": 300})
+    batch = w.call_batch(
+        [{"op": "send_message", "args": {"chat_id": cid, "text": "x"}}, {"op": "get_folders"}], timeout=0.05
+    )
+    sync_op, async_op = _results(batch)
+    assert sync_op == {"success": False, "error": "timeout", "running": True}
+    assert async_op["error"] == "timeout" and not async_op.get("running")
+    assert batch["error"] == "timeout"
+    time.sleep(0.4)
+
+
+def test_invalid_arguments(batch_env):
+    w, _, _ = batch_env
+    assert w.call_batch([], timeout="abc")["error"].startswith("Invalid timeout:")
+    assert w.call_batch("{not json")["error"].startswith("Invalid ops:")
+    assert w.call_batch("{}")["error"] == "ops must be a list"
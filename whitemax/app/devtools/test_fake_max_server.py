@@ -0,0 +1,91 @@
+import asyncio
+import struct
+
+import pytest
+
+msgpack = pytest.importorskip("msgpack")
+
+from devtools.fake_max import FakeMaxServer, FakeScenario, FakeServerError, generate_dataset  # noqa: E402
+
+_HEADER = struct.Struct(">BHBHI")
+PING, LOGIN, CONTACT_INFO, CHAT_HISTORY, MSG_SEND, NOTIF_MESSAGE = 1, 19, 32, 49, 64, 128
+
+
+class _Conn:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.seq = 0
+        self.pushes = []
+
+    async def call(self, opcode, payload):
+        self.seq += 1
+        body = msgpack.packb(payload)
+        self.writer.write(_HEADER.pack(10, 0, self.seq, opcode, len(body)) + body)
+        await self.writer.drain()
+        while True:
+            _, cmd, seq, op, length = _HEADER.unpack(await self.reader.readexactly(_HEADER.size))
+            out = msgpack.unpackb(await self.reader.readexactly(length), raw=False, strict_map_key=False)
+            if cmd == 1:
+                assert (seq, op) == (self.seq, opcode)
+                return out
+            self.pushes.append((op, out))
+
+
+def _run(scenario, body):
+    ds = generate_dataset(dialogs=3, groups=2, channels=1, messages_per_chat=30, seed=1)
+
+    async def main():
+        server = await FakeMaxServer(scenario=scenario, dataset=ds).start()
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        try:
+            return await body(_Conn(reader, writer), ds, server)
+        finally:
+            writer.close()
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_sync_history_and_send_use_dataset():
+    async def body(conn, ds, server):
+        assert await conn.call(PING, {}) == {}
+        assert "error" in await conn.call(LOGIN, {})
+        sync = await conn.call(LOGIN, {"token": "t"})
+        assert len(sync["chats"]) == 6
+        assert sync["profile"]["contact"]["id"] == ds.me.id
+
+        chat_id = ds.dialogs[0].id
+        page = await conn.call(CHAT_HISTORY, {"chatId": chat_id, "from": None, "forward": 0, "backward": 10})
+        assert [m["id"] for m in page["messages"]] == [m.id for m in ds.history[chat_id][-10:]]
+        boundary = page["messages"][0]["time"]
+        older = await conn.call(CHAT_HISTORY, {"chatId": chat_id, "from": boundary, "forward": 0, "backward": 5})
+        assert older["messages"][-1]["time"] == boundary
+
+        sent = await conn.call(MSG_SEND, {"chatId": chat_id, "message": {"text": "hello", "cid": 7}})
+        assert sent["message"]["text"] == "hello" and sent["message"]["cid"] == 7
+        assert ds.history[chat_id][-1].text == "hello"
+        await conn.call(PING, {})
+        assert conn.pushes and conn.pushes[0][0] == NOTIF_MESSAGE
+
+        contacts = await conn.call(CONTACT_INFO, {"contactIds": [ds.dialogs[0].cid, 999_999]})
+        assert [u["id"] for u in contacts["contacts"]] == [ds.dialogs[0].cid]
+
+    _run(FakeScenario(), body)
+
+
+def test_scenario_failures_apply_by_method_name():
+    scenario = FakeScenario()
+
+    async def body(conn, ds, server):
+        scenario.fail_next("send_message", FakeServerError("boom"))
+        out = await conn.call(MSG_SEND, {"chatId": ds.dialogs[0].id, "message": {"text": "x"}})
+        assert out == {"error": "fake.error", "message": "boom"}
+
+        scenario.fail_next("fetch_history")
+        with pytest.raises(asyncio.IncompleteReadError):
+            await conn.call(CHAT_HISTORY, {"chatId": ds.dialogs[0].id, "backward": 1})
+        return server.stats
+
+    stats = _run(scenario, body)
+    assert stats["errors"] == 1 and stats["drops"] == 1
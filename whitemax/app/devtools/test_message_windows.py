@@ -0,0 +1,76 @@
+from max_client_wrapper import _WINDOW_MAX_KEY, _WINDOW_MIN_KEY, _ChatWindow, _MessageRecord, _MessageWindows
+
+
+def _rec(message_id, chat_id=1, time_ms=None):
+    t = 1000 * message_id if time_ms is None else time_ms
+    return _MessageRecord(str(message_id), chat_id, f"m{message_id}", 7, t, "USER", None, None, None)
+
+
+def _recs(ids, chat_id=1):
+    return [_rec(i, chat_id) for i in ids]
+
+
+def test_overlapping_runs_merge_and_disjoint_runs_stay_apart():
+    win = _ChatWindow()
+    assert win.add_run(_recs(range(10, 20)), False, False) == 10
+    assert win.add_run(_recs(range(30, 40)), False, False) == 10
+    assert len(win.runs) == 2
+    # Отрезок 18..32 перекрывает оба — три диапазона сливаются в один.
+    assert win.add_run(_recs(range(18, 33)), False, False) == 10
+    assert len(win.runs) == 1
+    assert win.runs[0][0][2] == "10" and win.runs[0][1][2] == "39"
+    assert [k[2] for k in win.keys] == [str(i) for i in range(10, 40)]
+
+
+def test_around_stops_at_gaps_and_reports_completeness():
+    win = _ChatWindow()
+    win.add_run(_recs(range(10, 20)), True, False)
+    win.add_run(_recs(range(30, 40)), False, True)
+    near_gap = win.around("18", before=3, after=5)
+    assert [r.id for r in near_gap["records"]] == ["15", "16", "17", "18", "19"]
+    assert near_gap["complete_before"] and not near_gap["complete_after"]
+    oldest = win.around("11", before=5, after=0)
+    assert [r.id for r in oldest["records"]] == ["10", "11"]
+    assert oldest["complete_before"] and oldest["has_oldest"]
+    assert win.around("38", before=0, after=5)["complete_after"]
+    assert win.around("25", 1, 1) is None
+
+
+def test_live_messages_only_extend_a_live_end():
+    win = _ChatWindow()
+    win.add_run(_recs(range(1, 5)), False, False)
+    assert not win.add_live(_rec(10))
+    win.add_run(_recs(range(4, 8)), False, True)
+    assert win.live and win.add_live(_rec(10))
+    win.mark_stale()
+    assert not win.live and win.runs[-1][1][2] == "10"
+    assert not win.add_live(_rec(11))
+
+
+def test_trim_oldest_drops_history_start():
+    win = _ChatWindow()
+    win.add_run(_recs(range(1, 11)), True, True)
+    assert win.trim_oldest(4) == 4
+    assert [k[2] for k in win.keys] == [str(i) for i in range(5, 11)]
+    assert win.runs[0][0] is not _WINDOW_MIN_KEY and win.runs[0][1] is _WINDOW_MAX_KEY
+    assert set(win.by_id) == {str(i) for i in range(5, 11)}
+
+
+def test_windows_budget_evicts_idle_chats_then_trims_current():
+    windows = _MessageWindows(max_messages=25)
+    windows.add_run(1, _recs(range(1, 11), chat_id=1), False, False)
+    windows.add_run(2, _recs(range(1, 11), chat_id=2), False, False)
+    windows.get(1)  # чат 1 открыт недавно — вытесняется чат 2
+    windows.add_run(3, _recs(range(1, 11), chat_id=3), False, False)
+    assert windows.get(2) is None and windows.get(1) is not None
+    assert windows.snapshot()["evicted_chats"] == 1
+
+    windows.add_run(3, _recs(range(11, 31), chat_id=3), False, False)
+    snap = windows.snapshot()
+    assert snap["messages"] <= 25 and windows.get(1) is None
+    assert len(windows.get(3)) == 25
+
+    windows.configure(max_messages=10)
+    assert windows.snapshot()["messages"] == 10
+    windows.delete(3, ["30", "missing"])
+    assert windows.snapshot()["messages"] == 9
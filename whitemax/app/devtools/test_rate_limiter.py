@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from max_client_wrapper import _RateLimiter, _TokenBucket
+
+
+def test_token_bucket_burst_then_debt():
+    bucket = _TokenBucket(rate=2.0, burst=2.0)
+    now = bucket._updated
+    assert bucket.reserve(now) == 0.0
+    assert bucket.reserve(now) == 0.0
+    # Сверх burst токен берётся "в долг": ждать 1/rate, затем 2/rate (FIFO).
+    assert bucket.reserve(now) == pytest.approx(0.5)
+    assert bucket.reserve(now) == pytest.approx(1.0)
+    # Через 2 с долг погашен, но ёмкость не выше burst.
+    assert bucket.reserve(now + 2.0) == 0.0
+    assert bucket.reserve(now + 100.0) == 0.0
+    assert bucket._tokens == pytest.approx(1.0)
+
+
+def test_token_bucket_zero_rate_is_unlimited():
+    bucket = _TokenBucket(rate=0.0, burst=1.0)
+    assert all(bucket.reserve(0.0) == 0.0 for _ in range(10))
+
+
+def test_queued_class_does_not_hold_global_tokens():
+    limiter = _RateLimiter()
+    limiter.configure({"global": {"rate": 10.0, "burst": 2.0}, "classes": {"upload": {"rate": 10.0, "burst": 1.0}}})
+
+    async def main():
+        uploads = [asyncio.ensure_future(limiter.acquire("upload")) for _ in range(3)]
+        await asyncio.sleep(0)
+        # Пока upload ждёт свой класс, глобальный бюджет свободен для других классов.
+        fetch_wait = await limiter.acquire("fetch")
+        return fetch_wait, await asyncio.gather(*uploads)
+
+    fetch_wait, upload_waits = asyncio.run(main())
+    assert fetch_wait == 0.0
+    assert upload_waits[0] == 0.0
+    assert upload_waits[2] >= upload_waits[1] > 0.0
+    stats = limiter.snapshot()["stats"]
+    assert stats["upload"]["count"] == 3 and stats["upload"]["queued"] == 2
+    assert stats["fetch"]["queued"] == 0
+    assert limiter.snapshot()["waiting"] == 0
+
+
+def test_disabled_limiter_never_waits():
+    limiter = _RateLimiter()
+    limiter.configure({"enabled": False, "classes": {"send": {"rate": 0.001, "burst": 1.0}}})
+
+    async def main():
+        return [await limiter.acquire("send") for _ in range(5)]
+
+    assert asyncio.run(main()) == [0.0] * 5
+    assert limiter.snapshot()["stats"] == {}
@@ -0,0 +1,64 @@
+import pytest
+
+from max_client_wrapper import _MessageSearchIndex
+
+
+@pytest.fixture(params=["fts5", "like"])
+def index(request, tmp_path):
+    idx = _MessageSearchIndex(str(tmp_path / "search" / "messages.sqlite3"))
+    idx._db()
+    if request.param == "like":
+        # Сборка SQLite без FTS5: тот же индекс через LIKE по norm.
+        idx.fts5 = False
+    elif not idx.fts5:
+        pytest.skip("SQLite built without FTS5")
+    yield idx
+    idx.close()
+
+
+def _msg(chat_id, message_id, text, time_ms=1000, **extra):
+    return dict({"chat_id": chat_id, "id": message_id, "text": text, "time": time_ms, "sender_id": 7}, **extra)
+
+
+def _ids(results):
+    return [(r["chat_id"], r["message_id"]) for r in results]
+
+
+def test_search_is_prefix_and_case_insensitive(index):
+    index.upsert_many(
+        [
+            _msg(1, "a", "Ёлка в офисе", 1000),
+            _msg(1, "b", "созвон по проекту", 2000),
+            _msg(2, "c", "ЁЛКИ-палки, проект готов", 3000),
+        ]
+    )
+    assert set(_ids(index.search("елк", None, 10, 0))) == {(1, "a"), (2, "c")}
+    # Несколько слов — AND.
+    assert _ids(index.search("елк проект", None, 10, 0)) == [(2, "c")]
+    assert _ids(index.search("проект", 1, 10, 0)) == [(1, "b")]
+    assert index.search("   ", None, 10, 0) == []
+
+
+def test_edit_replaces_text_and_pending_is_skipped(index):
+    assert index.upsert_many([_msg(1, "a", "старый текст"), _msg(1, "p", "черновик", pending=True)]) == 1
+    index.upsert_many([_msg(1, "a", "новый текст", time_ms=None)])
+    assert index.search("старый", None, 10, 0) == []
+    assert _ids(index.search("новый", None, 10, 0)) == [(1, "a")]
+    assert index.search("черновик", None, 10, 0) == []
+    # time=None в правке не затирает исходное время.
+    assert index.message_time(1, "a") == 1000
+
+
+def test_empty_edit_deletes_row(index):
+    index.upsert_many([_msg(1, "a", "фото с отпуска"), _msg(1, "b", "фото документа")])
+    index.upsert_many([_msg(1, "a", "")])
+    assert _ids(index.search("фото", None, 10, 0)) == [(1, "b")]
+    assert index.message_time(1, "a") is None
+    assert index.stats()["messages"] == 1
+
+
+def test_delete(index):
+    index.upsert_many([_msg(1, "a", "раз"), _msg(1, "b", "два"), _msg(2, "a", "раз")])
+    assert index.delete(1, ["a", "missing"]) == 1
+    assert _ids(index.search("раз", None, 10, 0)) == [(2, "a")]
+    assert index.stats()["chats"] == 2
@@ -3,17 +3,20 @@ Python обертка для Swift для работы с pymax.
 Обеспечивает синхронный интерфейс для асинхронного pymax клиента.
 """
 
-import asyncio
-import concurrent.futures
-import datetime
+from __future__ import annotations
+
+import bisect
+import contextvars
+import heapq
+import importlib
 import json
 import os
-import ssl
+import re
 import sys
 import time
-import uuid
 import threading
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # Добавляем текущую директорию в sys.path для поиска модулей
 _current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -30,60 +33,1820 @@ def _dprint(*args: Any, **kwargs: Any) -> None:
         print(*args, **kwargs)
 
 
+class _LazyModule:
+    """
+    Заглушка модуля, который импортируется при первом обращении к атрибуту; после этого
+    глобальное имя в этом модуле указывает уже на настоящий модуль (без накладных расходов).
+    Так импорт max_client_wrapper не тянет asyncio/ssl/sqlite3/... до первого реального вызова.
+    """
+
+    def __init__(self, name: str, alias: str):
+        self._name = name
+        self._alias = alias
+
+    def _load(self) -> Any:
+        importlib.import_module(self._name)
+        mod = sys.modules[self._alias]
+        globals()[self._alias] = mod
+        return mod
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+
+asyncio = _LazyModule("asyncio", "asyncio")
+concurrent = _LazyModule("concurrent.futures", "concurrent")
+datetime = _LazyModule("datetime", "datetime")
+hashlib = _LazyModule("hashlib", "hashlib")
+mimetypes = _LazyModule("mimetypes", "mimetypes")
+mmap = _LazyModule("mmap", "mmap")
+random = _LazyModule("random", "random")
+sqlite3 = _LazyModule("sqlite3", "sqlite3")
+ssl = _LazyModule("ssl", "ssl")
+tracemalloc = _LazyModule("tracemalloc", "tracemalloc")
+uuid = _LazyModule("uuid", "uuid")
+
+
 def _set_import_error(prefix: str, err: Exception) -> None:
     global _PYMAX_IMPORT_ERROR
     if _PYMAX_IMPORT_ERROR is None:
         _PYMAX_IMPORT_ERROR = f"{prefix}: {type(err).__name__}: {err}"
-try:
-    # pydantic-core is required by pydantic v2 (pymax dependencies).
-    # On-device failures are often OSError/dlopen (not just ImportError).
-    import pydantic_core  # noqa: F401
-
-    # Пытаемся импортировать pymax
-    # Для iOS используем SocketMaxClient вместо MaxClient
-    from pymax import SocketMaxClient
-    from pymax.files import File, Photo
-    from pymax.payloads import UserAgentPayload
-    from pymax.types import Chat, Message
-    from pymax.exceptions import SocketNotConnectedError, SocketSendError
-    PYMAX_AVAILABLE = True
-    _dprint("✓ pymax imported successfully")
-except Exception as e:
-    # Если импорт не удался, создаем заглушки для типов
-    import sys
-    import os
-    import traceback
-    
-    _set_import_error("Failed to import pymax/pydantic_core", e)
-    _dprint(f"Warning: Failed to import pymax: {e}")
-    _dprint(f"Error type: {type(e).__name__}")
-    _dprint(f"Python path: {sys.path}")
-    
-    # Проверяем наличие pymax
-    app_dir = os.path.dirname(os.path.abspath(__file__))
-    pymax_dir = os.path.join(app_dir, "pymax")
-    _dprint(f"Looking for pymax at: {pymax_dir}")
-    _dprint(f"pymax exists: {os.path.exists(pymax_dir)}")
-    
-    # Проверяем наличие __init__.py
-    pymax_init = os.path.join(pymax_dir, "__init__.py")
-    if os.path.exists(pymax_init):
-        _dprint("✓ pymax/__init__.py exists")
-    else:
-        _dprint("✗ pymax/__init__.py NOT found")
-    
-    # Выводим полный traceback для диагностики
-    if _DEBUG:
-        print("Full traceback:")
-        traceback.print_exc()
-    
-    # Устанавливаем заглушки
-    SocketMaxClient = None
-    UserAgentPayload = None
-    Chat = None
-    Message = None
-    Photo = None
-    File = None
+
+
+def _load_aiohttp() -> Any:
+    """aiohttp (зависимость pymax для загрузок) — импортируем по требованию; None, если недоступен."""
+    try:
+        import aiohttp
+
+        return aiohttp
+    except Exception:
+        return None
+
+# pymax (и pydantic_core) импортируются лениво — при создании клиента, см. _ensure_pymax().
+SocketMaxClient = None
+UserAgentPayload = None
+Chat = None
+Message = None
+Photo = None
+File = None
+Opcode = None
+SocketNotConnectedError = None
+SocketSendError = None
+_PYMAX_IMPORT_ATTEMPTED = False
+_pymax_import_lock = threading.Lock()
+
+
+def _ensure_pymax() -> bool:
+    """
+    Импортировать pymax по требованию (один раз). Возвращает PYMAX_AVAILABLE;
+    при ошибке причина сохраняется в _PYMAX_IMPORT_ERROR.
+    """
+    global PYMAX_AVAILABLE, _PYMAX_IMPORT_ATTEMPTED
+    global SocketMaxClient, UserAgentPayload, Chat, Message, Photo, File, Opcode
+    global SocketNotConnectedError, SocketSendError
+    if _PYMAX_IMPORT_ATTEMPTED:
+        return PYMAX_AVAILABLE
+    with _pymax_import_lock:
+        if _PYMAX_IMPORT_ATTEMPTED:
+            return PYMAX_AVAILABLE
+        try:
+            # pydantic-core is required by pydantic v2 (pymax dependencies).
+            # On-device failures are often OSError/dlopen (not just ImportError).
+            import pydantic_core  # noqa: F401
+
+            # Пытаемся импортировать pymax
+            # Для iOS используем SocketMaxClient вместо MaxClient
+            from pymax import SocketMaxClient as _SocketMaxClient
+            from pymax.files import File as _File, Photo as _Photo
+            from pymax.payloads import UserAgentPayload as _UserAgentPayload
+            from pymax.types import Chat as _Chat, Message as _Message
+            from pymax.exceptions import SocketNotConnectedError as _SNCE, SocketSendError as _SSE
+
+            SocketMaxClient, File, Photo = _SocketMaxClient, _File, _Photo
+            UserAgentPayload, Chat, Message = _UserAgentPayload, _Chat, _Message
+            SocketNotConnectedError, SocketSendError = _SNCE, _SSE
+            try:
+                # Нужен только для отправки уже загруженных вложений (send_attachments).
+                from pymax.static.enum import Opcode as _Opcode
+
+                Opcode = _Opcode
+            except Exception:
+                Opcode = None
+            PYMAX_AVAILABLE = True
+            _dprint("✓ pymax imported successfully")
+        except Exception as e:
+            _set_import_error("Failed to import pymax/pydantic_core", e)
+            _dprint(f"Warning: Failed to import pymax: {e}")
+            _dprint(f"Error type: {type(e).__name__}")
+            _dprint(f"Python path: {sys.path}")
+
+            # Проверяем наличие pymax
+            app_dir = os.path.dirname(os.path.abspath(__file__))
+            pymax_dir = os.path.join(app_dir, "pymax")
+            _dprint(f"Looking for pymax at: {pymax_dir}")
+            _dprint(f"pymax exists: {os.path.exists(pymax_dir)}")
+
+            # Проверяем наличие __init__.py
+            pymax_init = os.path.join(pymax_dir, "__init__.py")
+            if os.path.exists(pymax_init):
+                _dprint("✓ pymax/__init__.py exists")
+            else:
+                _dprint("✗ pymax/__init__.py NOT found")
+
+            # Выводим полный traceback для диагностики
+            if _DEBUG:
+                import traceback
+
+                print("Full traceback:")
+                traceback.print_exc()
+            PYMAX_AVAILABLE = False
+        _PYMAX_IMPORT_ATTEMPTED = True
+    return PYMAX_AVAILABLE
+
+
+def _pymax_unavailable_result() -> Dict[str, Any]:
+    return {
+        "success": False,
+        "error": "pymax not available - missing dependencies",
+        "details": _PYMAX_IMPORT_ERROR,
+    }
+
+
+_SEARCH_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _normalize_search_text(text: str) -> str:
+    """Нормализация для поиска: casefold + ё→е (unicode61 в SQLite их не склеивает)."""
+    return (text or "").casefold().replace("ё", "е")
+
+
+_TRANSLIT = str.maketrans(
+    {
+        "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z",
+        "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p",
+        "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch",
+        "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+    }
+)
+
+
+def _fold_chat_title(text: str) -> str:
+    """Ключ фильтрации: casefold, ё→е и транслитерация кириллицы в латиницу ("Саша" ~ "sasha")."""
+    return _normalize_search_text(text).translate(_TRANSLIT)
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+def _split_url(url: Optional[str]) -> tuple:
+    """URL -> (общий префикс до '?' или последнего '/', интернированный; уникальный хвост)."""
+    if not url:
+        return None, url
+    url = str(url)
+    cut = url.find("?")
+    if cut < 0:
+        cut = url.rfind("/")
+    if cut < 0:
+        return None, url
+    return sys.intern(url[: cut + 1]), url[cut + 1 :]
+
+
+def _json_default(obj: Any) -> Any:
+    """json.dumps(default=...): компактные записи превращаются в dict только при сериализации."""
+    to_dict = getattr(obj, "to_dict", None)
+    if to_dict is None:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return to_dict()
+
+
+class _AttachmentRecord:
+    __slots__ = ("id", "type", "url_prefix", "url_rest", "thumbnail_url", "file_name", "file_size")
+
+    def __init__(
+        self,
+        att_id: int,
+        a_type: str,
+        url: Optional[str] = None,
+        thumbnail_url: Optional[str] = None,
+        file_name: Optional[str] = None,
+        file_size: Optional[int] = None,
+    ):
+        self.id = att_id
+        self.type = sys.intern(a_type)
+        self.url_prefix, self.url_rest = _split_url(url)
+        self.thumbnail_url = thumbnail_url
+        self.file_name = file_name
+        self.file_size = file_size
+
+    @property
+    def url(self) -> Optional[str]:
+        if self.url_prefix is None:
+            return self.url_rest
+        return self.url_prefix + self.url_rest
+
+    def to_dict(self) -> Dict[str, Any]:
+        url = self.url
+        return {
+            "id": self.id,
+            "type": self.type,
+            "url": url,
+            # У фото превью — тот же URL (не храним второй раз).
+            "thumbnail_url": url if self.type == "PHOTO" else self.thumbnail_url,
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+        }
+
+
+class _MessageRecord:
+    """
+    Компактное сообщение для кешей и буферов событий: __slots__ вместо dict на 10 ключей,
+    реакции — кортеж пар, повторяющиеся строки (type, эмодзи, префиксы URL) интернированы.
+    Читается как dict (get / []) по ключам формата Swift; dict/JSON строится только в to_dict().
+    """
+
+    __slots__ = ("id", "chat_id", "text", "sender_id", "time", "type", "reply_to", "reactions", "attachments")
+
+    _KEYS = ("id", "chat_id", "text", "sender_id", "date", "time", "type", "reply_to", "reactions", "attachments")
+
+    def __init__(
+        self,
+        msg_id: str,
+        chat_id: int,
+        text: str,
+        sender_id: Any,
+        time_ms: Optional[int],
+        msg_type: Any,
+        reply_to: Optional[str],
+        reactions: Optional[tuple],
+        attachments: Optional[tuple],
+    ):
+        self.id = msg_id
+        self.chat_id = chat_id
+        self.text = text
+        self.sender_id = sender_id
+        self.time = time_ms
+        self.type = _intern(msg_type)
+        self.reply_to = reply_to
+        self.reactions = reactions
+        self.attachments = attachments
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "reactions":
+            return dict(self.reactions) if self.reactions else default
+        if key == "attachments":
+            return [a.to_dict() for a in self.attachments] if self.attachments else default
+        if key == "date":
+            key = "time"
+        if key not in self.__slots__:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._KEYS
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "chat_id": self.chat_id,
+            "text": self.text,
+            "sender_id": self.sender_id,
+            "date": self.time,
+            "time": self.time,
+            "type": self.type,
+            "reply_to": self.reply_to,
+            "reactions": dict(self.reactions) if self.reactions else None,
+            "attachments": [a.to_dict() for a in self.attachments] if self.attachments else None,
+        }
+
+
+class _ChatFilterIndex:
+    """
+    Индекс названий чатов для мгновенной фильтрации списка: триграммы слов + префиксы из 1–2 символов.
+    Обновляется из get_chats (rebuild) и событий chat_update (upsert); читается из Swift-потока.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[int, tuple] = {}  # id -> (folded title, words, order)
+        self._grams: Dict[str, set] = {}
+        self._order = 0
+
+    @staticmethod
+    def _keys(words: List[str]) -> set:
+        keys = set()
+        for w in words:
+            keys.add("^" + w[:1])
+            keys.add("^" + w[:2])
+            for i in range(len(w) - 2):
+                keys.add(w[i : i + 3])
+        return keys
+
+    def _remove_locked(self, chat_id: int) -> None:
+        old = self._entries.pop(chat_id, None)
+        if old is None:
+            return
+        for k in self._keys(old[1]):
+            ids = self._grams.get(k)
+            if ids is not None:
+                ids.discard(chat_id)
+                if not ids:
+                    del self._grams[k]
+
+    def _add_locked(self, chat_id: int, title: str, order: int) -> None:
+        folded = _fold_chat_title(title)
+        words = _SEARCH_TOKEN_RE.findall(folded)
+        if not words:
+            return
+        self._entries[chat_id] = (folded, words, order)
+        for k in self._keys(words):
+            self._grams.setdefault(k, set()).add(chat_id)
+
+    def rebuild(self, chats: List[Dict[str, Any]]) -> None:
+        """Полная перестройка; порядок get_chats сохраняется как tie-break ранжирования."""
+        with self._lock:
+            self._entries.clear()
+            self._grams.clear()
+            for i, cd in enumerate(chats):
+                try:
+                    self._add_locked(int(cd["id"]), cd.get("title") or "", i)
+                except Exception:
+                    continue
+            self._order = len(chats)
+
+    def upsert(self, chat_id: int, title: str) -> None:
+        with self._lock:
+            old = self._entries.get(chat_id)
+            order = old[2] if old is not None else self._order
+            if old is None:
+                self._order += 1
+            self._remove_locked(chat_id)
+            self._add_locked(chat_id, title, order)
+
+    def remove(self, chat_id: int) -> None:
+        with self._lock:
+            self._remove_locked(chat_id)
+
+    def query(self, query: str, limit: int) -> List[int]:
+        qwords = _SEARCH_TOKEN_RE.findall(_fold_chat_title(query))
+        if not qwords:
+            return []
+        with self._lock:
+            candidates: Optional[set] = None
+            for qw in qwords:
+                keys = ["^" + qw] if len(qw) < 3 else [qw[i : i + 3] for i in range(len(qw) - 2)]
+                for k in keys:
+                    ids = self._grams.get(k)
+                    if not ids:
+                        return []
+                    candidates = set(ids) if candidates is None else candidates & ids
+                    if not candidates:
+                        return []
+            phrase = " ".join(qwords)
+            ranked = []
+            for cid in candidates or ():
+                folded, words, order = self._entries[cid]
+                # Триграммы дают кандидатов; подтверждаем подстрокой и ранжируем.
+                if folded == phrase:
+                    score = 0
+                elif folded.startswith(phrase):
+                    score = 1
+                elif all(any(w.startswith(qw) for w in words) for qw in qwords):
+                    score = 2
+                elif all(len(qw) >= 3 and qw in folded for qw in qwords):
+                    score = 3
+                else:
+                    continue
+                ranked.append((score, order, cid))
+        return [cid for _, _, cid in heapq.nsmallest(limit, ranked)]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _MessageSearchIndex:
+    """
+    Полнотекстовый индекс сообщений в SQLite (FTS5, tokenizer unicode61) в work_dir.
+    Если FTS5 в сборке SQLite нет — деградирует до LIKE по нормализованному тексту.
+    Не потокобезопасен: все вызовы идут через один поток (см. MaxClientWrapper._search_pool()).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fts5 = False
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " chat_id INTEGER NOT NULL, message_id TEXT NOT NULL, time INTEGER, sender_id INTEGER,"
+            " text TEXT NOT NULL, norm TEXT NOT NULL, PRIMARY KEY (chat_id, message_id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat_id, time)")
+        try:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                " norm, tokenize='unicode61 remove_diacritics 2')"
+            )
+            self.fts5 = True
+        except sqlite3.OperationalError:
+            self.fts5 = False
+        conn.commit()
+        self._conn = conn
+        return conn
+
+    def upsert_many(self, messages: List[Dict[str, Any]]) -> int:
+        db = self._db()
+        n = 0
+        with db:
+            for m in messages:
+                if m.get("pending"):
+                    continue
+                text = m.get("text") or ""
+                try:
+                    chat_id = int(m["chat_id"])
+                    message_id = str(m["id"])
+                except Exception:
+                    continue
+                if not text:
+                    # Правка стёрла текст (осталось только вложение) — старый текст не должен находиться.
+                    self._delete_row(db, chat_id, message_id)
+                    continue
+                norm = _normalize_search_text(text)
+                row = db.execute(
+                    "SELECT rowid FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+                ).fetchone()
+                if row is None:
+                    cur = db.execute(
+                        "INSERT INTO messages (chat_id, message_id, time, sender_id, text, norm)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (chat_id, message_id, m.get("time"), m.get("sender_id"), text, norm),
+                    )
+                    rowid = cur.lastrowid
+                else:
+                    rowid = row[0]
+                    db.execute(
+                        "UPDATE messages SET time = COALESCE(?, time), text = ?, norm = ? WHERE rowid = ?",
+                        (m.get("time"), text, norm, rowid),
+                    )
+                    if self.fts5:
+                        db.execute("DELETE FROM messages_fts WHERE rowid = ?", (rowid,))
+                if self.fts5:
+                    db.execute("INSERT INTO messages_fts (rowid, norm) VALUES (?, ?)", (rowid, norm))
+                n += 1
+        return n
+
+    def _delete_row(self, db: sqlite3.Connection, chat_id: int, message_id: str) -> bool:
+        row = db.execute(
+            "SELECT rowid FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+        ).fetchone()
+        if row is None:
+            return False
+        db.execute("DELETE FROM messages WHERE rowid = ?", (row[0],))
+        if self.fts5:
+            db.execute("DELETE FROM messages_fts WHERE rowid = ?", (row[0],))
+        return True
+
+    def delete(self, chat_id: int, message_ids: List[str]) -> int:
+        db = self._db()
+        n = 0
+        with db:
+            for mid in message_ids:
+                if self._delete_row(db, int(chat_id), str(mid)):
+                    n += 1
+        return n
+
+    def search(self, query: str, chat_id: Optional[int], limit: int, offset: int) -> List[Dict[str, Any]]:
+        tokens = _SEARCH_TOKEN_RE.findall(_normalize_search_text(query))
+        if not tokens:
+            return []
+        db = self._db()
+        chat_filter = " AND m.chat_id = ?" if chat_id is not None else ""
+        if self.fts5:
+            # Каждое слово — префиксный терм; пробел = AND. Кавычки экранируем удвоением.
+            match = " ".join('"{}"*'.format(t.replace('"', '""')) for t in tokens)
+            params: List[Any] = [match]
+            if chat_id is not None:
+                params.append(int(chat_id))
+            params += [int(limit), int(offset)]
+            rows = db.execute(
+                "SELECT m.chat_id, m.message_id, m.time, m.sender_id, m.text, bm25(messages_fts) AS rank"
+                " FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid"
+                f" WHERE messages_fts MATCH ?{chat_filter}"
+                " ORDER BY rank, m.time DESC LIMIT ? OFFSET ?",
+                params,
+            ).fetchall()
+        else:
+            where = " AND ".join("m.norm LIKE ?" for _ in tokens)
+            params = [f"%{t}%" for t in tokens]
+            if chat_id is not None:
+                params.append(int(chat_id))
+            params += [int(limit), int(offset)]
+            rows = db.execute(
+                "SELECT m.chat_id, m.message_id, m.time, m.sender_id, m.text, 0.0 AS rank"
+                f" FROM messages m WHERE {where}{chat_filter}"
+                " ORDER BY m.time DESC LIMIT ? OFFSET ?",
+                params,
+            ).fetchall()
+        return [
+            {
+                "chat_id": r[0],
+                "message_id": r[1],
+                "time": r[2],
+                "sender_id": r[3],
+                "text": r[4],
+                "rank": r[5],
+            }
+            for r in rows
+        ]
+
+    def message_time(self, chat_id: int, message_id: str) -> Optional[int]:
+        row = self._db().execute(
+            "SELECT time FROM messages WHERE chat_id = ? AND message_id = ?", (int(chat_id), str(message_id))
+        ).fetchone()
+        return row[0] if row else None
+
+    def stats(self) -> Dict[str, Any]:
+        db = self._db()
+        count = db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        chats = db.execute("SELECT COUNT(DISTINCT chat_id) FROM messages").fetchone()[0]
+        return {"path": self.path, "fts5": self.fts5, "messages": count, "chats": chats}
+
+    def close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+# Имя текущей публичной операции (для retry-счётчиков внутри корутин), задаётся в _run_async.
+_current_op: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("whitemax_op", default=None)
+
+
+# Границы "до начала истории" / "до самого нового сообщения" для диапазонов окна.
+_WINDOW_MIN_KEY: tuple = (-1, -1, "")
+_WINDOW_MAX_KEY: tuple = (float("inf"), float("inf"), "")
+
+
+def _window_key(rec: _MessageRecord) -> tuple:
+    mid = rec.id
+    return (rec.time or 0, int(mid) if mid.isdigit() else 0, mid)
+
+
+class _ChatWindow:
+    """
+    Окно сообщений одного чата: ключи (time, id) в отсортированном списке (bisect) + id -> запись.
+    runs — непересекающиеся диапазоны ключей [lo, hi], про которые известно, что внутри нет пропусков
+    (результаты fetch_history и события поверх "живого" конца). Только для asyncio loop thread.
+    """
+
+    __slots__ = ("keys", "by_id", "runs")
+
+    def __init__(self):
+        self.keys: List[tuple] = []
+        self.by_id: Dict[str, _MessageRecord] = {}
+        self.runs: List[List[tuple]] = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def live(self) -> bool:
+        return bool(self.runs) and self.runs[-1][1] is _WINDOW_MAX_KEY
+
+    def upsert(self, rec: _MessageRecord) -> bool:
+        """Вставить/заменить запись; True — если сообщение новое."""
+        key = _window_key(rec)
+        old = self.by_id.get(rec.id)
+        self.by_id[rec.id] = rec
+        if old is not None:
+            old_key = _window_key(old)
+            if old_key == key:
+                return False
+            del self.keys[bisect.bisect_left(self.keys, old_key)]
+        bisect.insort(self.keys, key)
+        return old is None
+
+    def delete(self, message_id: str) -> bool:
+        rec = self.by_id.pop(message_id, None)
+        if rec is None:
+            return False
+        i = bisect.bisect_left(self.keys, _window_key(rec))
+        if i < len(self.keys) and self.keys[i][2] == message_id:
+            del self.keys[i]
+        return True
+
+    def add_run(self, records: List[_MessageRecord], reached_oldest: bool, reached_newest: bool) -> int:
+        """Добавить непрерывный отрезок истории; вернуть число новых сообщений."""
+        if not records and not (reached_oldest and reached_newest):
+            return 0
+        added = sum(1 for r in records if self.upsert(r))
+        keys = sorted(_window_key(r) for r in records)
+        lo = _WINDOW_MIN_KEY if reached_oldest else keys[0]
+        hi = _WINDOW_MAX_KEY if reached_newest else keys[-1]
+        merged = [lo, hi]
+        rest = []
+        for run in self.runs:
+            if run[0] <= merged[1] and merged[0] <= run[1]:
+                merged = [min(run[0], merged[0]), max(run[1], merged[1])]
+            else:
+                rest.append(run)
+        rest.append(merged)
+        rest.sort()
+        self.runs = rest
+        return added
+
+    def add_live(self, rec: _MessageRecord) -> bool:
+        """Новое сообщение из события: сохраняем только поверх живого конца (иначе была бы дыра)."""
+        if rec.id in self.by_id or self.live:
+            return self.upsert(rec)
+        return False
+
+    def mark_stale(self) -> None:
+        """После переподключения события могли потеряться: конец окна больше не "живой"."""
+        if self.live:
+            self.runs[-1][1] = self.keys[-1] if self.keys and self.keys[-1] >= self.runs[-1][0] else self.runs[-1][0]
+
+    def trim_oldest(self, count: int) -> int:
+        """Вытеснить count самых старых сообщений (начало окна перестаёт быть "началом истории")."""
+        count = min(count, len(self.keys))
+        if count <= 0:
+            return 0
+        for key in self.keys[:count]:
+            self.by_id.pop(key[2], None)
+        del self.keys[:count]
+        if self.keys:
+            first = self.keys[0]
+            self.runs = [run for run in self.runs if run[1] >= first]
+            if self.runs and self.runs[0][0] < first:
+                self.runs[0][0] = first
+        else:
+            self.runs = []
+        return count
+
+    def around(self, message_id: str, before: int, after: int) -> Optional[Dict[str, Any]]:
+        """До before более старых и after более новых сообщений вокруг message_id в пределах непрерывного отрезка."""
+        rec = self.by_id.get(message_id)
+        if rec is None:
+            return None
+        key = _window_key(rec)
+        run = next((r for r in self.runs if r[0] <= key <= r[1]), None)
+        if run is None:
+            return None
+        keys = self.keys
+        i = bisect.bisect_left(keys, key)
+        lo = bisect.bisect_left(keys, run[0])
+        hi = bisect.bisect_right(keys, run[1])
+        start = max(lo, i - before)
+        end = min(hi, i + 1 + after)
+        return {
+            "records": [self.by_id[k[2]] for k in keys[start:end]],
+            "complete_before": i - start == before or run[0] is _WINDOW_MIN_KEY,
+            "complete_after": end - i - 1 == after or run[1] is _WINDOW_MAX_KEY,
+            "has_oldest": run[0] is _WINDOW_MIN_KEY and start == lo,
+        }
+
+
+class _MessageWindows:
+    """Окна по чатам с общим бюджетом (число сообщений): вытесняются давно не открытые чаты целиком."""
+
+    def __init__(self, max_messages: int = 20_000):
+        self.max_messages = max_messages
+        self._chats: "OrderedDict[int, _ChatWindow]" = OrderedDict()
+        self._total = 0
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evicted_messages": 0, "evicted_chats": 0}
+
+    def get(self, chat_id: int, create: bool = False) -> Optional[_ChatWindow]:
+        win = self._chats.get(chat_id)
+        if win is None and create:
+            win = self._chats[chat_id] = _ChatWindow()
+        if win is not None:
+            self._chats.move_to_end(chat_id)
+        return win
+
+    def _recount(self, chat_id: int, delta: int) -> None:
+        self._total += delta
+        self._enforce(keep=chat_id)
+
+    def add_run(self, chat_id: int, records: List[_MessageRecord], reached_oldest: bool, reached_newest: bool) -> None:
+        win = self.get(chat_id, create=True)
+        self._recount(chat_id, win.add_run(records, reached_oldest, reached_newest))
+
+    def on_message(self, rec: _MessageRecord) -> None:
+        win = self._chats.get(rec.chat_id)
+        if win is not None and win.add_live(rec):
+            self._recount(rec.chat_id, 1)
+
+    def on_edit(self, rec: _MessageRecord) -> None:
+        win = self._chats.get(rec.chat_id)
+        if win is not None and rec.id in win.by_id:
+            win.upsert(rec)
+
+    def delete(self, chat_id: int, message_ids: List[str]) -> None:
+        win = self._chats.get(chat_id)
+        if win is not None:
+            self._total -= sum(1 for mid in message_ids if win.delete(str(mid)))
+
+    def around(self, chat_id: int, message_id: str, before: int, after: int) -> Optional[Dict[str, Any]]:
+        win = self.get(chat_id)
+        return win.around(str(message_id), before, after) if win is not None else None
+
+    def mark_stale(self) -> None:
+        for win in self._chats.values():
+            win.mark_stale()
+
+    def _enforce(self, keep: int) -> None:
+        while self._total > self.max_messages and len(self._chats) > 1:
+            chat_id, win = next(iter(self._chats.items()))
+            if chat_id == keep:
+                self._chats.move_to_end(chat_id)
+                continue
+            del self._chats[chat_id]
+            self._total -= len(win)
+            self.stats["evicted_messages"] += len(win)
+            self.stats["evicted_chats"] += 1
+        if self._total > self.max_messages and self._chats:
+            win = next(iter(self._chats.values()))
+            n = win.trim_oldest(self._total - self.max_messages)
+            self._total -= n
+            self.stats["evicted_messages"] += n
+
+    def configure(self, max_messages: Optional[int] = None, clear: bool = False) -> None:
+        if clear:
+            self._chats.clear()
+            self._total = 0
+        if max_messages is not None:
+            self.max_messages = max(1, int(max_messages))
+            self._enforce(keep=next(reversed(self._chats)) if self._chats else 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "chats": len(self._chats),
+            "messages": self._total,
+            "max_messages": self.max_messages,
+            "live_chats": sum(1 for w in self._chats.values() if w.live),
+            **self.stats,
+        }
+
+
+def _classify_error(error: Any) -> str:
+    """Грубая классификация ошибки для метрик: timeout / connection / not_found / cancelled / <Type> / server."""
+    if isinstance(error, BaseException):
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError)):
+            return "timeout"
+        if isinstance(error, (ConnectionError, ssl.SSLError)):
+            return "connection"
+        return type(error).__name__
+    s = str(error or "").lower()
+    if "timed out" in s or "timeout" in s:
+        return "timeout"
+    if "not connected" in s or "connection" in s or "socket" in s or "eof" in s:
+        return "connection"
+    if "not found" in s or "not.found" in s:
+        return "not_found"
+    if "cancel" in s or "superseded" in s:
+        return "cancelled"
+    return "server"
+
+
+class _Histogram:
+    """Гистограмма латентности с фиксированными (лог-шкала) корзинами в мс; перцентили — по верхней границе."""
+
+    BOUNDS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+    __slots__ = ("counts", "count", "sum_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        i = 0
+        bounds = self.BOUNDS_MS
+        while i < len(bounds) and ms > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return min(self.BOUNDS_MS[i], self.max_ms) if i < len(self.BOUNDS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.50), 3),
+            "p95_ms": round(self.percentile(0.95), 3),
+            "p99_ms": round(self.percentile(0.99), 3),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+class _Metrics:
+    """
+    Реестр метрик: по операциям (латентность, ошибки по классам, retries, in-flight)
+    + общие гистограммы/счётчики (ожидание _conn_lock, запись событий, reconnects).
+    Пишется и из Swift-потока, и из loop thread, поэтому под threading.Lock.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._ops: Dict[str, Dict[str, Any]] = {}
+        self._hists: Dict[str, _Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._since = time.time()
+
+    def _op_locked(self, op: str) -> Dict[str, Any]:
+        st = self._ops.get(op)
+        if st is None:
+            st = {"latency": _Histogram(), "errors": {}, "retries": 0, "in_flight": 0, "calls": 0}
+            self._ops[op] = st
+        return st
+
+    def op_start(self, op: str) -> None:
+        with self._lock:
+            self._op_locked(op)["in_flight"] += 1
+
+    def op_end(self, op: str, ms: float, error_class: Optional[str] = None) -> None:
+        with self._lock:
+            st = self._op_locked(op)
+            st["in_flight"] -= 1
+            st["calls"] += 1
+            st["latency"].observe(ms)
+            if error_class:
+                st["errors"][error_class] = st["errors"].get(error_class, 0) + 1
+
+    def retry(self, op: Optional[str] = None) -> None:
+        if not self.enabled:
+            return
+        op = op or _current_op.get() or "background"
+        with self._lock:
+            self._op_locked(op)["retries"] += 1
+
+    def observe(self, name: str, ms: float) -> None:
+        with self._lock:
+            h = self._hists.get(name)
+            if h is None:
+                h = self._hists[name] = _Histogram()
+            h.observe(ms)
+
+    def inc(self, name: str, n: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            ops = {
+                name: {
+                    "calls": st["calls"],
+                    "in_flight": st["in_flight"],
+                    "retries": st["retries"],
+                    "errors": dict(st["errors"]),
+                    "latency": st["latency"].snapshot(),
+                }
+                for name, st in sorted(self._ops.items())
+            }
+            return {
+                "enabled": self.enabled,
+                "since": self._since,
+                "operations": ops,
+                "histograms": {k: h.snapshot() for k, h in sorted(self._hists.items())},
+                "counters": dict(self._counters),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            # in-flight операции продолжают считаться после сброса
+            inflight = {k: v["in_flight"] for k, v in self._ops.items() if v["in_flight"]}
+            self._ops = {}
+            for k, n in inflight.items():
+                self._op_locked(k)["in_flight"] = n
+            self._hists = {}
+            self._counters = {}
+            self._since = time.time()
+
+
+class _Span:
+    """Фаза трассировки: контекстный менеджер, делает себя текущим родителем на время with."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attrs", "t0", "_token")
+
+    def __init__(self, trace: "_Trace", name: str, parent_id: Optional[str], attrs: Optional[Dict[str, Any]] = None):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs or {}
+        self.t0 = time.perf_counter()
+        self._token = None
+
+    def set_attr(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+    def end(self, error: Optional[BaseException] = None, t1: Optional[float] = None) -> None:
+        t1 = time.perf_counter() if t1 is None else t1
+        rec = {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.t0 - self.trace.t0) * 1000.0, 3),
+            "dur_ms": round((t1 - self.t0) * 1000.0, 3),
+        }
+        if error is not None:
+            self.attrs["error"] = f"{type(error).__name__}: {error}"
+        if self.attrs:
+            rec["attrs"] = self.attrs
+        self.trace.spans.append(rec)
+
+    def __enter__(self) -> "_Span":
+        self.t0 = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end(exc if isinstance(exc, Exception) else None)
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # exit в другом контексте (не должно случаться) — просто не восстанавливаем родителя
+            pass
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set_attr(self, key: str, value: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+_current_span: "contextvars.ContextVar[Optional[_Span]]" = contextvars.ContextVar("whitemax_span", default=None)
+
+
+class _Trace:
+    __slots__ = ("trace_id", "op", "ts", "t0", "spans", "root")
+
+    def __init__(self, op: str):
+        self.trace_id = uuid.uuid4().hex
+        self.op = op
+        self.ts = time.time()
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.root = _Span(self, op, None)
+
+
+class _Tracer:
+    """
+    Трассировка фаз публичных операций. Сэмплинг — в начале операции (sample_rate);
+    операции дольше slow_ms пишутся всегда (если slow_ms задан, трейс ведётся для каждого вызова).
+    Готовые трейсы — по строке JSONL в work_dir/traces/traces.jsonl с ротацией по размеру.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.sample_rate = 0.0
+        self.slow_ms: Optional[float] = None
+        self.max_bytes = 2 * 1024 * 1024
+        self.keep_files = 3
+        self.stats: Dict[str, int] = {"written": 0, "dropped": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms is not None
+
+    def start(self, op: str) -> Optional[_Trace]:
+        if not self.active:
+            return None
+        sampled = self.sample_rate >= 1 or (self.sample_rate > 0 and random.random() < self.sample_rate)
+        if not sampled and self.slow_ms is None:
+            return None
+        trace = _Trace(op)
+        trace.root.attrs["sampled"] = sampled
+        return trace
+
+    def finish(self, trace: _Trace, error: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Закрыть корневой span; вернуть запись, если её нужно сохранить."""
+        if error:
+            trace.root.attrs["error"] = error
+        trace.root.end()
+        dur_ms = trace.spans[-1]["dur_ms"]
+        if not trace.root.attrs.get("sampled") and (self.slow_ms is None or dur_ms < self.slow_ms):
+            self.stats["dropped"] += 1
+            return None
+        return {
+            "trace_id": trace.trace_id,
+            "op": trace.op,
+            "ts": trace.ts,
+            "dur_ms": dur_ms,
+            "error": error,
+            "spans": sorted(trace.spans, key=lambda sp: sp["start_ms"]),
+        }
+
+    def write(self, record: Dict[str, Any]) -> None:
+        path = os.path.join(self.root, "traces.jsonl")
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = 0
+                if size and size + len(line) > self.max_bytes:
+                    for i in range(self.keep_files - 1, 0, -1):
+                        src = path if i == 1 else f"{path}.{i - 1}"
+                        if os.path.exists(src):
+                            os.replace(src, f"{path}.{i}")
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                self.stats["written"] += 1
+            except Exception:
+                self.stats["errors"] += 1
+
+
+def _event_file_name(ts_ms: int) -> str:
+    return f"{ts_ms}_{uuid.uuid4().hex}.json"
+
+
+def _write_event_file(directory: str, payload: Dict[str, Any], ts_ms: int) -> None:
+    """Атомарная запись: .tmp + os.replace, чтобы Swift никогда не увидел недописанный файл."""
+    os.makedirs(directory, exist_ok=True)
+    filename = _event_file_name(ts_ms)
+    tmp_path = os.path.join(directory, f".{filename}.tmp")
+    # dumps + одна запись: json.dump пишет мелкими кусками и на больших пачках отдаёт GIL на каждом.
+    data = json.dumps(payload, ensure_ascii=False, default=_json_default)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(directory, filename))
+
+
+class _FileEventSink:
+    """Одно событие — один JSON-файл в events dir. Формат по умолчанию (его мониторит Swift)."""
+
+    kind = "files"
+
+    def __init__(self, directory: Callable[[], str]):
+        self._directory = directory
+        self.stats: Dict[str, int] = {"emitted": 0, "written": 0, "errors": 0}
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        self.stats["emitted"] += 1
+        try:
+            _write_event_file(self._directory(), event, event["ts_ms"])
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        self.stats["written"] += 1
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"kind": self.kind, **self.stats}
+
+
+class _BatchedEventSink:
+    """
+    События копятся в буфере и пишутся одним файлом {"type": "batch", "events": [...]}
+    раз в window_ms или по max_batch событий (фоновый поток, emit не делает I/O).
+    Обновления состояния (edit / reaction / chat_update) одного объекта внутри окна схлопываются:
+    остаётся последнее, на месте первого.
+    """
+
+    kind = "batched"
+    _COALESCE_KEYS: Dict[str, Callable[[Dict[str, Any]], Tuple[Any, ...]]] = {
+        "message_edit": lambda e: ((e.get("message") or {}).get("chat_id"), (e.get("message") or {}).get("id")),
+        "reaction_change": lambda e: (e.get("chat_id"), e.get("message_id")),
+        "chat_update": lambda e: ((e.get("chat") or {}).get("id"),),
+    }
+
+    def __init__(self, directory: Callable[[], str], window_ms: float = 50.0, max_batch: int = 500):
+        self._directory = directory
+        self.window_s = max(0.001, float(window_ms) / 1000.0)
+        self.max_batch = max(1, int(max_batch))
+        self.stats: Dict[str, int] = {"emitted": 0, "written": 0, "coalesced": 0, "batches": 0, "errors": 0}
+        self._buf: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _key(self, event: Dict[str, Any]) -> Any:
+        keyfn = self._COALESCE_KEYS.get(event.get("type"))
+        if keyfn is not None:
+            key = keyfn(event)
+            if None not in key:
+                return (event["type"],) + key
+        self._seq += 1
+        return self._seq
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        with self._cond:
+            self.stats["emitted"] += 1
+            key = self._key(event)
+            if key in self._buf:
+                self.stats["coalesced"] += 1
+            self._buf[key] = event
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="whitemax-events", daemon=True)
+                self._thread.start()
+            if len(self._buf) == 1 or len(self._buf) >= self.max_batch:
+                self._cond.notify()
+
+    def _take(self) -> List[Dict[str, Any]]:
+        events = list(self._buf.values())
+        self._buf = OrderedDict()
+        return events
+
+    def _write(self, events: List[Dict[str, Any]]) -> None:
+        if not events:
+            return
+        try:
+            ts_ms = int(time.time() * 1000)
+            _write_event_file(self._directory(), {"type": "batch", "ts_ms": ts_ms, "events": events}, ts_ms)
+            self.stats["batches"] += 1
+            self.stats["written"] += len(events)
+        except Exception:
+            self.stats["errors"] += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._buf and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._buf:
+                    return
+                if len(self._buf) < self.max_batch and not self._closed:
+                    # Окно отсчитывается от первого события в буфере.
+                    self._cond.wait(self.window_s)
+                events = self._take()
+            self._write(events)
+
+    def flush(self) -> None:
+        with self._cond:
+            events = self._take()
+        self._write(events)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.flush()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "kind": self.kind,
+                "window_ms": self.window_s * 1000.0,
+                "max_batch": self.max_batch,
+                "pending": len(self._buf),
+                **self.stats,
+            }
+
+
+class _MemoryEventSink:
+    """
+    Кольцевой буфер в памяти; Swift забирает события через poll_events(after_seq) вместо чтения папки.
+    При переполнении вытесняются самые старые — ещё не прочитанные считаются потерянными (lost).
+    """
+
+    kind = "memory"
+
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = max(1, int(capacity))
+        self.stats: Dict[str, int] = {"emitted": 0, "lost": 0, "polled": 0}
+        self._events: "deque[Tuple[int, Dict[str, Any]]]" = deque()
+        self._seq = 0
+        self._read_seq = 0
+        self._lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            self._seq += 1
+            self.stats["emitted"] += 1
+            self._events.append((self._seq, event))
+            if len(self._events) > self.capacity:
+                seq, _ = self._events.popleft()
+                if seq > self._read_seq:
+                    self.stats["lost"] += 1
+
+    def poll(self, after_seq: int = 0, limit: int = 500) -> Dict[str, Any]:
+        with self._lock:
+            out = []
+            for seq, event in self._events:
+                if seq <= after_seq:
+                    continue
+                plain = {k: v.to_dict() if isinstance(v, _MessageRecord) else v for k, v in event.items()}
+                plain["seq"] = seq
+                out.append(plain)
+                if len(out) >= limit:
+                    break
+            if out:
+                self._read_seq = max(self._read_seq, out[-1]["seq"])
+                self.stats["polled"] += len(out)
+            # Прочитанное больше не нужно держать.
+            while self._events and self._events[0][0] <= self._read_seq:
+                self._events.popleft()
+            return {
+                "events": out,
+                "last_seq": out[-1]["seq"] if out else max(after_seq, self._read_seq),
+                # True: часть событий после after_seq уже вытеснена — UI стоит перечитать состояние.
+                "gap": bool(out) and out[0]["seq"] > after_seq + 1,
+            }
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"kind": self.kind, "capacity": self.capacity, "buffered": len(self._events), "last_seq": self._seq, **self.stats}
+
+
+class _TokenBucket:
+    """
+    Token bucket: `rate` токенов в секунду, ёмкость `burst`.
+    Запрос сверх лимита не отклоняется, а резервирует токен "в долг" и ждёт своей очереди (FIFO).
+    Используется только на asyncio loop thread, поэтому без блокировок.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """Зарезервировать один токен; вернуть задержку (сек) до момента, когда он станет доступен."""
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1.0
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+
+class _RateLimiter:
+    """Глобальный + по классам операций rate limiter для исходящих запросов wrapper'а."""
+
+    DEFAULT_GLOBAL = {"rate": 20.0, "burst": 30.0}
+    DEFAULT_CLASSES: Dict[str, Dict[str, float]] = {
+        "fetch": {"rate": 10.0, "burst": 20.0},
+        "send": {"rate": 5.0, "burst": 10.0},
+        "edit": {"rate": 3.0, "burst": 6.0},
+        "delete": {"rate": 2.0, "burst": 4.0},
+        "read": {"rate": 5.0, "burst": 10.0},
+        "reaction": {"rate": 3.0, "burst": 6.0},
+        "folder": {"rate": 2.0, "burst": 4.0},
+        "membership": {"rate": 1.0, "burst": 3.0},
+        "lookup": {"rate": 3.0, "burst": 5.0},
+        "upload": {"rate": 4.0, "burst": 8.0},
+    }
+
+    def __init__(self) -> None:
+        self.enabled = True
+        self._global = _TokenBucket(**self.DEFAULT_GLOBAL)
+        self._classes: Dict[str, _TokenBucket] = {
+            name: _TokenBucket(**cfg) for name, cfg in self.DEFAULT_CLASSES.items()
+        }
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._waiting = 0
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        if "enabled" in config:
+            self.enabled = bool(config["enabled"])
+        g = config.get("global")
+        if isinstance(g, dict):
+            self._global = _TokenBucket(
+                g.get("rate", self._global.rate), g.get("burst", self._global.burst)
+            )
+        for name, cfg in (config.get("classes") or {}).items():
+            if not isinstance(cfg, dict):
+                continue
+            cur = self._classes.get(name)
+            self._classes[name] = _TokenBucket(
+                cfg.get("rate", cur.rate if cur else 0.0),
+                cfg.get("burst", cur.burst if cur else 1.0),
+            )
+
+    async def acquire(self, op_class: str) -> float:
+        """
+        Дождаться разрешения на запрос класса `op_class`; вернуть задержку в очереди (сек).
+
+        Глобальный токен берётся только после того, как класс выдал слот: иначе всплеск медленного
+        класса (upload) заранее выбирал бы глобальный бюджет и задерживал все остальные классы.
+        """
+        if not self.enabled:
+            return 0.0
+        st = self._stats.setdefault(
+            op_class, {"count": 0, "queued": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0, "last_wait_ms": 0.0}
+        )
+        bucket = self._classes.get(op_class)
+        class_wait = bucket.reserve(time.monotonic()) if bucket is not None else 0.0
+        global_wait = 0.0
+        self._waiting += 1
+        try:
+            if class_wait > 0:
+                await asyncio.sleep(class_wait)
+            global_wait = self._global.reserve(time.monotonic())
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+        finally:
+            self._waiting -= 1
+        wait = class_wait + global_wait
+        wait_ms = wait * 1000.0
+        st["count"] += 1
+        st["last_wait_ms"] = wait_ms
+        if wait > 0:
+            st["queued"] += 1
+            st["total_wait_ms"] += wait_ms
+            st["max_wait_ms"] = max(st["max_wait_ms"], wait_ms)
+        return wait
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "waiting": self._waiting,
+            "global": {"rate": self._global.rate, "burst": self._global.burst},
+            "classes": {n: {"rate": b.rate, "burst": b.burst} for n, b in self._classes.items()},
+            "stats": {n: dict(st) for n, st in list(self._stats.items())},
+        }
+
+    def reset_stats(self) -> None:
+        self._stats = {}
+
+
+class _LookupCache:
+    """
+    In-memory LRU+TTL для lookup-запросов (телефон, @канал, ссылки приглашений).
+    "Не найдено" кешируется отдельно, с коротким TTL. Используется только на asyncio loop thread.
+    """
+
+    # kind -> (ttl положительного ответа, ttl "не найдено"), сек. 0 = не кешировать.
+    DEFAULT_TTLS: Dict[str, tuple] = {
+        "phone": (600.0, 60.0),
+        "channel": (600.0, 60.0),
+        # join меняет состояние на сервере: успех не кешируем, только невалидные ссылки
+        "join": (0.0, 60.0),
+    }
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self.ttls: Dict[str, tuple] = dict(self.DEFAULT_TTLS)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "cancelled": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def is_not_found(result: Dict[str, Any]) -> bool:
+        err = str(result.get("error") or "").lower()
+        return "not found" in err or "not.found" in err or "not_found" in err
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._entries.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, result = item
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        if result.get("success"):
+            self.stats["hits"] += 1
+        else:
+            self.stats["negative_hits"] += 1
+        return result
+
+    def put(self, key: str, kind: str, result: Dict[str, Any]) -> None:
+        ttl_ok, ttl_neg = self.ttls.get(kind, (0.0, 0.0))
+        if result.get("success"):
+            ttl = ttl_ok
+        elif self.is_not_found(result):
+            ttl = ttl_neg
+        else:
+            # Сетевые/прочие ошибки не кешируем.
+            return
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttls": {k: {"ttl_s": v[0], "negative_ttl_s": v[1]} for k, v in self.ttls.items()},
+            **self.stats,
+        }
+
+
+class _BoundedLRU(OrderedDict):
+    """
+    dict с LRU-вытеснением сверх max_entries (свежесть обновляют запись и get()).
+    Подставляется и вместо client._users: pymax складывает туда всех встреченных пользователей
+    и никогда не чистит. Ключи из pinned не вытесняются и в max_entries не входят.
+    Используется только на asyncio loop thread.
+
+    copy()/copy.copy()/pickle работают как у dict (pymax может копировать client._users).
+    """
+
+    def __init__(self, max_entries: int = 5000, items: Any = None, pinned: Any = None):
+        super().__init__()
+        # Пределы задаются до вставки: иначе trim() при наполнении вытеснял бы по умолчаниям.
+        self.max_entries = max(1, int(max_entries))
+        self.pinned: set = set(pinned or ())
+        self.evictions = 0
+        if items:
+            for key, value in dict(items).items():
+                OrderedDict.__setitem__(self, key, value)
+            self.trim()
+
+    def __reduce__(self) -> Any:
+        # OrderedDict восстанавливает элементы до __dict__ — передаём пределы через конструктор.
+        state = {"evictions": self.evictions}
+        return (type(self), (self.max_entries, None, self.pinned), state, None, iter(self.items()))
+
+    def copy(self) -> "_BoundedLRU":
+        out = _BoundedLRU(self.max_entries, pinned=self.pinned)
+        for key, value in self.items():
+            OrderedDict.__setitem__(out, key, value)
+        out.evictions = self.evictions
+        return out
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key in self:
+            self.move_to_end(key)
+            return super().__getitem__(key)
+        return default
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self.trim()
+
+    def trim(self) -> None:
+        if len(self) <= self.max_entries:
+            return
+        pinned = self.pinned
+        # В предел входят только закреплённые ключи, которые реально лежат в словаре.
+        limit = self.max_entries + (sum(1 for key in pinned if key in self) if pinned else 0)
+        while len(self) > limit:
+            key = next(iter(self))
+            if key in pinned:
+                # Закреплённые уходят в конец, чтобы следующий проход не перебирал их заново.
+                self.move_to_end(key)
+                continue
+            self.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "pinned": len(self.pinned),
+            "evictions": self.evictions,
+        }
+
+
+class _UploadDedupCache:
+    """
+    Кеш загрузок по содержимому: "<kind>:<sha256>:<size>" -> attach payload (photoToken/fileId).
+    Хранится в work_dir/upload_cache.json; записи живут не дольше серверного срока жизни токена.
+    get/put/invalidate — только на asyncio loop thread и работают с индексом в памяти: файл читается
+    один раз (ensure_loaded, из пула I/O), а перезапись уходит в executor.
+    """
+
+    MAX_ENTRIES = 2000
+
+    def __init__(self, path: str, executor: Optional[Callable[[], Any]] = None):
+        self.path = path
+        self.enabled = True
+        self.ttl_s: Dict[str, float] = {"photo": 24 * 3600.0, "file": 7 * 24 * 3600.0}
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "bytes_saved": 0, "invalidated": 0}
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self._executor = executor
+        self._load_lock = threading.Lock()
+        # Поколение снимка: запись из пула не перетирает файл более старым снимком.
+        self._write_lock = threading.Lock()
+        self._gen = 0
+        self._written_gen = 0
+
+    @staticmethod
+    def file_key(file_path: str, kind: str, chunk_size: int = 1024 * 1024) -> str:
+        """Потоковый SHA-256 файла (без чтения целиком в память) + размер."""
+        h = hashlib.sha256()
+        size = 0
+        with open(file_path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                h.update(chunk)
+                size += len(chunk)
+        return f"{kind}:{h.hexdigest()}:{size}"
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        entries = self._entries
+        if entries is not None:
+            return entries
+        with self._load_lock:
+            if self._entries is None:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    self._entries = data if isinstance(data, dict) else {}
+                except Exception:
+                    self._entries = {}
+            return self._entries
+
+    def ensure_loaded(self) -> None:
+        """Прочитать файл кеша (вызывается из пула I/O до первого get на loop)."""
+        self._load()
+
+    def _write(self, entries: Dict[str, Dict[str, Any]], gen: int) -> None:
+        with self._write_lock:
+            if gen <= self._written_gen:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+                self._written_gen = gen
+            except Exception:
+                pass
+
+    def _save(self) -> None:
+        # Снимок (поверхностная копия) берётся на loop; сериализация и запись — в executor.
+        self._gen += 1
+        entries = dict(self._entries or {})
+        if self._executor is None:
+            self._write(entries, self._gen)
+            return
+        try:
+            self._executor().submit(self._write, entries, self._gen)
+        except RuntimeError:
+            # Пул уже закрыт (shutdown) — пишем синхронно, чтобы не потерять запись.
+            self._write(entries, self._gen)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entries = self._load()
+        entry = entries.get(key)
+        if entry is None or float(entry.get("expires", 0)) <= time.time():
+            if entry is not None:
+                entries.pop(key, None)
+                self._save()
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        try:
+            self.stats["bytes_saved"] += int(key.rsplit(":", 1)[1])
+        except Exception:
+            pass
+        return dict(entry["attach"])
+
+    def put(self, key: str, kind: str, attach: Dict[str, Any]) -> None:
+        ttl = self.ttl_s.get(kind, 0.0)
+        if ttl <= 0 or not isinstance(attach, dict):
+            return
+        entries = self._load()
+        now = time.time()
+        entries[key] = {"attach": attach, "created": now, "expires": now + ttl}
+        if len(entries) > self.MAX_ENTRIES:
+            for old_key, _ in sorted(entries.items(), key=lambda kv: kv[1].get("created", 0))[
+                : len(entries) - self.MAX_ENTRIES
+            ]:
+                entries.pop(old_key, None)
+        self._save()
+
+    def invalidate(self, attaches: List[Dict[str, Any]]) -> None:
+        """Сервер отверг токен раньше срока — забываем записи с этими attach payload'ами."""
+        entries = self._load()
+        stale = [k for k, v in entries.items() if v.get("attach") in attaches]
+        for k in stale:
+            entries.pop(k, None)
+        if stale:
+            self.stats["invalidated"] += len(stale)
+            self._save()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._load()),
+            "ttl_s": dict(self.ttl_s),
+            **self.stats,
+        }
+
+
+class _DiskLRUCache:
+    """
+    Content-addressed дисковый кеш с бюджетом в байтах и LRU-вытеснением.
+
+    Блобы лежат в <root>/<sha[:2]>/<sha> (одинаковый контент хранится один раз), индекс
+    <root>/index.json связывает стабильные ключи (например "FILE:<file_id>") с sha256 контента
+    и хранит время последнего доступа. Все методы синхронные — вызывать из пула потоков
+    или под self.lock.
+    """
+
+    def __init__(self, root: str, budget_bytes: int):
+        self.root = root
+        self.budget_bytes = int(budget_bytes)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0}
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _index_path(self) -> str:
+        return os.path.join(self.root, "index.json")
+
+    def _blob_path(self, sha: str, ext: str = "") -> str:
+        return os.path.join(self.root, sha[:2], f"{sha}{ext}")
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            try:
+                with open(self._index_path(), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self._index = {"keys": dict(data.get("keys") or {}), "blobs": dict(data.get("blobs") or {})}
+            except Exception:
+                self._index = {"keys": {}, "blobs": {}}
+        return self._index
+
+    def _save(self) -> None:
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = f"{self._index_path()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._index or {}, f)
+            os.replace(tmp_path, self._index_path())
+        except Exception:
+            pass
+
+    def get(self, key: str) -> Optional[str]:
+        """Путь к закешированному файлу (и отметка доступа) или None."""
+        with self.lock:
+            index = self._load()
+            sha = index["keys"].get(key)
+            blob = index["blobs"].get(sha) if sha else None
+            path = self._blob_path(sha, blob.get("ext", "")) if blob else None
+            if blob is None or path is None or not os.path.exists(path):
+                if sha is not None:
+                    index["keys"].pop(key, None)
+                self.stats["misses"] += 1
+                return None
+            # atime сохраняется вместе со следующей записью индекса: чтения не должны писать на диск.
+            blob["atime"] = time.time()
+            self.stats["hits"] += 1
+            return path
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        """get() для пачки ключей одним вызовом (один проход в пуле вместо N на loop)."""
+        return {key: self.get(key) for key in keys}
+
+    def put_file(self, key: str, tmp_path: str, ext: str = "") -> str:
+        """
+        Забрать скачанный файл в кеш (по sha256 содержимого), вытеснить старое; вернуть путь.
+        ext сохраняется у блоба, чтобы QuickLook/share sheet понимали тип файла.
+        """
+        h = hashlib.sha256()
+        with open(tmp_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        sha = h.hexdigest()
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            index = self._load()
+            existing = index["blobs"].get(sha)
+            if existing is not None:
+                ext = existing.get("ext", "")
+            path = self._blob_path(sha, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if existing is not None and os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+            index["blobs"][sha] = {"size": size, "atime": time.time(), "ext": ext}
+            index["keys"][key] = sha
+            self._evict_locked(keep=sha)
+            self._save()
+        return path
+
+    def _evict_locked(self, keep: Optional[str] = None) -> None:
+        index = self._load()
+        total = sum(int(b.get("size", 0)) for b in index["blobs"].values())
+        if total <= self.budget_bytes:
+            return
+        for sha, blob in sorted(index["blobs"].items(), key=lambda kv: kv[1].get("atime", 0)):
+            if total <= self.budget_bytes:
+                break
+            if sha == keep:
+                continue
+            try:
+                os.remove(self._blob_path(sha, blob.get("ext", "")))
+            except Exception:
+                pass
+            index["blobs"].pop(sha, None)
+            total -= int(blob.get("size", 0))
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += int(blob.get("size", 0))
+        live = index["blobs"]
+        index["keys"] = {k: v for k, v in index["keys"].items() if v in live}
+
+    def discard_other_keys(self, prefix: str, keep_key: str) -> int:
+        """Удалить ключи с префиксом prefix, кроме keep_key (например, старое фото той же сущности)."""
+        with self.lock:
+            index = self._load()
+            stale = [k for k in index["keys"] if k.startswith(prefix) and k != keep_key]
+            for k in stale:
+                index["keys"].pop(k, None)
+            if stale:
+                live = set(index["keys"].values())
+                for sha in [sha for sha in index["blobs"] if sha not in live]:
+                    blob = index["blobs"].pop(sha)
+                    try:
+                        os.remove(self._blob_path(sha, blob.get("ext", "")))
+                    except Exception:
+                        pass
+                self._save()
+            return len(stale)
+
+    def set_budget(self, budget_bytes: int) -> None:
+        with self.lock:
+            self.budget_bytes = max(0, int(budget_bytes))
+            self._evict_locked()
+            self._save()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            index = self._load()
+            return {
+                "root": self.root,
+                "budget_bytes": self.budget_bytes,
+                "entries": len(index["keys"]),
+                "blobs": len(index["blobs"]),
+                "bytes": sum(int(b.get("size", 0)) for b in index["blobs"].values()),
+                **self.stats,
+            }
 
 
 class MaxClientWrapper:
@@ -125,8 +1888,35 @@ class MaxClientWrapper:
                     return None
         return None
 
+    # Сколько последних вложений помнить для download_attachment (chat_id, message_id, attach_id) -> тип/url.
+    _ATTACH_INDEX_MAX = 5000
+    # Предел кеша пользователей pymax (client._users), см. configure_cache_limits().
+    _USERS_CACHE_MAX = 5000
+    # Пауза после get_users в get_chats, чтобы pymax успел обновить client._users (бенчмарк ставит 0).
+    _USERS_SETTLE_S = 0.1
+
+    def _remember_attachment(
+        self,
+        chat_id: Any,
+        message_id: Any,
+        attach_id: Any,
+        a_type: str,
+        url: Optional[str] = None,
+        file_name: Optional[str] = None,
+    ) -> None:
+        try:
+            key = (int(chat_id), str(message_id), int(attach_id))
+        except Exception:
+            return
+        self._attach_index[key] = {"type": a_type, "url": url, "file_name": file_name}
+
     def _message_to_dict(self, msg: Any, fallback_chat_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
         """Конвертировать Message (или dict-подобный объект) в JSON-совместимый dict для Swift."""
+        record = self._message_record(msg, fallback_chat_id)
+        return record.to_dict() if record is not None else None
+
+    def _message_record(self, msg: Any, fallback_chat_id: Optional[int] = None) -> Optional[_MessageRecord]:
+        """Разобрать Message в компактную запись (_MessageRecord); попутно запоминает вложения для download_attachment."""
         if msg is None:
             return None
 
@@ -168,7 +1958,7 @@ class MaxClientWrapper:
                     if reply_to is not None:
                         reply_to = str(reply_to)
 
-            # reactions counters
+            # reactions counters (эмодзи интернированы: одни и те же на тысячах сообщений)
             reactions: Dict[str, int] = {}
             reaction_info = self._get_field(msg, "reactionInfo", "reaction_info", default=None)
             counters = self._get_field(reaction_info, "counters", default=None) if reaction_info is not None else None
@@ -178,22 +1968,24 @@ class MaxClientWrapper:
                     cnt = self._get_field(c, "count", default=0)
                     if r is not None:
                         try:
-                            reactions[str(r)] = int(cnt or 0)
+                            reactions[sys.intern(str(r))] = int(cnt or 0)
                         except Exception:
-                            reactions[str(r)] = 0
+                            reactions[sys.intern(str(r))] = 0
 
             # attachments
-            attachments: List[Dict[str, Any]] = []
+            attachments: List[_AttachmentRecord] = []
             attaches = self._get_field(msg, "attaches", default=None)
             if isinstance(attaches, list):
                 for a in attaches:
-                    a_type = self._get_field(a, "type", default=None)
+                    a_type = self._get_field(a, "type", "_type", default=None)
                     if hasattr(a_type, "value"):
                         a_type = a_type.value
                     a_type_str = str(a_type) if a_type is not None else "UNKNOWN"
                     if a_type_str.upper() == "PHOTO":
                         photo_id = self._get_field(a, "photo_id", "photoId", default=None)
                         base_url = self._get_field(a, "base_url", "baseUrl", default=None)
+                        if photo_id is not None:
+                            self._remember_attachment(chat_id, msg_id, photo_id, "PHOTO", url=base_url)
                         # Cache-buster: AsyncImage caches by URL; some base URLs can be template-like.
                         if base_url:
                             try:
@@ -203,55 +1995,42 @@ class MaxClientWrapper:
                             except Exception:
                                 pass
                         attachments.append(
-                            {
-                                "id": int(photo_id) if photo_id is not None else 0,
-                                "type": "PHOTO",
-                                "url": base_url,
-                                "thumbnail_url": base_url,
-                                "file_name": None,
-                                "file_size": None,
-                            }
+                            _AttachmentRecord(int(photo_id) if photo_id is not None else 0, "PHOTO", url=base_url)
                         )
                     elif a_type_str.upper() == "FILE":
                         file_id = self._get_field(a, "file_id", "fileId", default=None)
                         name = self._get_field(a, "name", default=None)
                         size = self._get_field(a, "size", default=None)
+                        if file_id is not None:
+                            self._remember_attachment(chat_id, msg_id, file_id, "FILE", file_name=name)
                         attachments.append(
-                            {
-                                "id": int(file_id) if file_id is not None else 0,
-                                "type": "FILE",
-                                "url": None,
-                                "thumbnail_url": None,
-                                "file_name": name,
-                                "file_size": int(size) if size is not None else None,
-                            }
+                            _AttachmentRecord(
+                                int(file_id) if file_id is not None else 0,
+                                "FILE",
+                                file_name=name,
+                                file_size=int(size) if size is not None else None,
+                            )
                         )
                     elif a_type_str.upper() == "VIDEO":
                         video_id = self._get_field(a, "video_id", "videoId", default=None)
                         thumb = self._get_field(a, "thumbnail", default=None)
+                        if video_id is not None:
+                            self._remember_attachment(chat_id, msg_id, video_id, "VIDEO")
                         attachments.append(
-                            {
-                                "id": int(video_id) if video_id is not None else 0,
-                                "type": "VIDEO",
-                                "url": None,
-                                "thumbnail_url": thumb,
-                                "file_name": None,
-                                "file_size": None,
-                            }
+                            _AttachmentRecord(int(video_id) if video_id is not None else 0, "VIDEO", thumbnail_url=thumb)
                         )
 
-            return {
-                "id": str(msg_id),
-                "chat_id": int(chat_id),
-                "text": text,
-                "sender_id": sender_id,
-                "date": time_ms,
-                "time": time_ms,
-                "type": msg_type,
-                "reply_to": reply_to,
-                "reactions": reactions if reactions else None,
-                "attachments": attachments if attachments else None,
-            }
+            return _MessageRecord(
+                str(msg_id),
+                int(chat_id),
+                text,
+                sender_id,
+                time_ms,
+                msg_type,
+                reply_to,
+                tuple(reactions.items()) if reactions else None,
+                tuple(attachments) if attachments else None,
+            )
         except Exception:
             return None
 
@@ -296,8 +2075,16 @@ class MaxClientWrapper:
         if self._conn_lock is None:
             self._conn_lock = asyncio.Lock()
 
-        async with self._conn_lock:
+        t0 = time.perf_counter()
+        with self._span("conn_lock"):
+            await self._conn_lock.acquire()
+        try:
+            if self._metrics.enabled:
+                self._metrics.observe("conn_lock_wait", (time.perf_counter() - t0) * 1000.0)
             if not getattr(self.client, "is_connected", False):
+                self._metrics.inc("reconnects")
+                # Пока соединения не было, события могли потеряться.
+                self._message_windows.mark_stale()
                 # Best-effort cleanup: cancel recv/outgoing tasks before reconnecting.
                 # This avoids accumulating pending tasks and improves reconnect stability.
                 try:
@@ -312,15 +2099,28 @@ class MaxClientWrapper:
                             pass
                     self.client.is_connected = False
 
-                await self.client.connect(self.client.user_agent)
+                with self._span("reconnect"):
+                    await self.client.connect(self.client.user_agent)
 
                 if getattr(self.client, "_token", None):
+                    with self._span("sync"):
+                        await self.client._sync(self.client.user_agent)
+                        await self.client._post_login_tasks(sync=False)
+                    self._save_session_snapshot()
+
+            elif getattr(self.client, "_token", None) and not getattr(self.client, "me", None):
+                with self._span("sync"):
                     await self.client._sync(self.client.user_agent)
                     await self.client._post_login_tasks(sync=False)
+                self._save_session_snapshot()
+        finally:
+            self._conn_lock.release()
+            self._bound_client_users()
 
-            elif getattr(self.client, "_token", None) and not getattr(self.client, "me", None):
-                await self.client._sync(self.client.user_agent)
-                await self.client._post_login_tasks(sync=False)
+    async def _throttle(self, op_class: str) -> float:
+        """Пройти rate limiter перед запросом к серверу; вернуть время ожидания в очереди (сек)."""
+        with self._span("rate_limit", op_class=op_class):
+            return await self._rate_limiter.acquire(op_class)
 
     def _reaction_info_to_dict(self, reaction_info: Any) -> Optional[Dict[str, Any]]:
         """Конвертировать ReactionInfo в JSON-совместимый dict для Swift."""
@@ -349,57 +2149,316 @@ class MaxClientWrapper:
             return None
 
     def _emit_event(self, event: Dict[str, Any]) -> None:
-        """Best-effort: сохранить событие в events dir (атомарно), чтобы Swift мог его подхватить."""
+        """Best-effort: передать событие в event sink (по умолчанию — атомарный JSON-файл в events dir для Swift)."""
+        t0 = time.perf_counter()
         try:
-            os.makedirs(self._events_dir, exist_ok=True)
-            ts_ms = int(time.time() * 1000)
-            event.setdefault("ts_ms", ts_ms)
-            filename = f"{ts_ms}_{uuid.uuid4().hex}.json"
-            tmp_path = os.path.join(self._events_dir, f".{filename}.tmp")
-            final_path = os.path.join(self._events_dir, filename)
-            with open(tmp_path, "w", encoding="utf-8") as f:
-                json.dump(event, f, ensure_ascii=False)
-            os.replace(tmp_path, final_path)
+            event.setdefault("ts_ms", int(time.time() * 1000))
+            self._event_sink.emit(event)
+            if self._metrics.enabled:
+                self._metrics.observe("emit_event", (time.perf_counter() - t0) * 1000.0)
         except Exception:
             # Никогда не падаем из-за событий — это обновления UI.
-            pass
+            self._metrics.inc("emit_event_errors")
 
-    def get_events_dir(self) -> Dict[str, Any]:
-        return {"success": True, "events_dir": self._events_dir}
-
-    def register_event_callbacks(self, events_dir: Optional[str] = None) -> Dict[str, Any]:
-        """
-        Регистрирует pymax callbacks (message/edit/delete/reaction/chat_update) и пишет события в JSON-файлы.
-        Swift затем мониторит папку через DispatchSource.
+    def configure_event_sink(
+        self,
+        kind: str = "files",
+        window_ms: Optional[float] = None,
+        max_batch: Optional[int] = None,
+        capacity: Optional[int] = None,
+    ) -> Dict[str, Any]:
         """
-        if self.client is None:
-            return {"success": False, "error": "Client not initialized"}
+        Выбрать способ доставки событий в UI.
 
-        if events_dir:
-            self._events_dir = events_dir
-        os.makedirs(self._events_dir, exist_ok=True)
+        :param kind: "files" — файл на событие (по умолчанию); "batched" — файл {"type": "batch", "events": [...]}
+            раз в window_ms со схлопыванием edit/reaction/chat_update; "memory" — кольцевой буфер, читается через poll_events()
+        """
+        try:
+            if kind == "files":
+                sink: Any = _FileEventSink(lambda: self._events_dir)
+            elif kind == "batched":
+                sink = _BatchedEventSink(
+                    lambda: self._events_dir,
+                    window_ms=50.0 if window_ms is None else window_ms,
+                    max_batch=500 if max_batch is None else max_batch,
+                )
+            elif kind == "memory":
+                sink = _MemoryEventSink(10_000 if capacity is None else capacity)
+            else:
+                return {"success": False, "error": f"Unknown event sink: {kind}"}
+            old, self._event_sink = self._event_sink, sink
+            # Досылаем то, что успел накопить прежний sink.
+            old.close()
+            return {"success": True, "sink": sink.snapshot()}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
 
-        if self._callbacks_registered:
-            return {"success": True, "events_dir": self._events_dir, "already_registered": True}
+    def get_event_sink_stats(self) -> Dict[str, Any]:
+        return {"success": True, "sink": self._event_sink.snapshot()}
+
+    def poll_events(self, after_seq: int = 0, limit: int = 500) -> Dict[str, Any]:
+        """Забрать события из memory sink с номером > after_seq."""
+        sink = self._event_sink
+        if not isinstance(sink, _MemoryEventSink):
+            return {"success": False, "error": f"Event sink is '{sink.kind}', not 'memory'"}
+        return {"success": True, **sink.poll(int(after_seq), max(1, int(limit)))}
+
+    def _bound_client_users(self) -> None:
+        """Заменить client._users на _BoundedLRU (повторно — если pymax пересоздал словарь)."""
+        client = self.client
+        users = getattr(client, "_users", None)
+        if client is None or not isinstance(users, dict):
+            return
+        # Собеседники из диалогов нужны get_chats на каждом вызове — закрепляем их.
+        peers = set()
+        for d in getattr(client, "dialogs", None) or []:
+            cid = getattr(d, "cid", None)
+            if cid is not None:
+                try:
+                    peers.add(int(cid))
+                except (TypeError, ValueError):
+                    pass
+        if isinstance(users, _BoundedLRU):
+            if users.max_entries != self._users_cache_max or users.pinned != peers:
+                users.max_entries = self._users_cache_max
+                users.pinned = peers
+                users.trim()
+            return
+        try:
+            client._users = _BoundedLRU(self._users_cache_max, users, peers)
+        except Exception:
+            pass
 
+    def configure_cache_limits(
+        self,
+        users_max: Optional[int] = None,
+        attachments_max: Optional[int] = None,
+        lookup_max: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Пределы in-memory кешей (LRU): пользователи pymax, индекс вложений, lookup cache."""
         try:
-            async def _on_message(msg: Any) -> None:
-                msg_dict = self._message_to_dict(msg)
-                if msg_dict:
-                    self._emit_event({"type": "message_new", "message": msg_dict})
+            # Кеши принадлежат loop thread — меняем и обрезаем их там же.
+            async def _configure():
+                if users_max is not None:
+                    self._users_cache_max = max(1, int(users_max))
+                    self._bound_client_users()
+                if attachments_max is not None:
+                    self._attach_index.max_entries = max(1, int(attachments_max))
+                    self._attach_index.trim()
+                if lookup_max is not None:
+                    self._lookup_cache.max_entries = max(16, int(lookup_max))
+                return {"success": True, "caches": self._cache_report()}
+
+            return self._run_async(_configure())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
 
-            async def _on_message_edit(msg: Any) -> None:
-                msg_dict = self._message_to_dict(msg)
-                if msg_dict:
-                    self._emit_event({"type": "message_edit", "message": msg_dict})
+    def _cache_report(self) -> Dict[str, Any]:
+        client = self.client
+        users = getattr(client, "_users", None) if client is not None else None
+        if isinstance(users, _BoundedLRU):
+            users_info: Dict[str, Any] = users.snapshot()
+        else:
+            users_info = {"entries": len(users or {}), "max_entries": None, "evictions": 0}
+        lookup = self._lookup_cache
+        return {
+            "client": {
+                "users": users_info,
+                "dialogs": len(getattr(client, "dialogs", None) or []),
+                "chats": len(getattr(client, "chats", None) or []),
+                "channels": len(getattr(client, "channels", None) or []),
+            },
+            "attachments": self._attach_index.snapshot(),
+            "lookup": {
+                "entries": len(lookup._entries),
+                "max_entries": lookup.max_entries,
+                "evictions": lookup.stats["evictions"],
+            },
+            "chat_filter": {"entries": len(self._chat_filter._entries), "keys": len(self._chat_filter._grams)},
+            "pending_sends": len(self._pending_sends),
+            "suppressed_echo_ids": len(self._suppressed_echo_ids),
+            "read_markers": len(self._read_markers),
+            "event_sink": self._event_sink.snapshot(),
+            "message_windows": self._message_windows.snapshot(),
+        }
 
-            async def _on_message_delete(msg: Any) -> None:
-                msg_dict = self._message_to_dict(msg)
-                if msg_dict:
-                    self._emit_event({"type": "message_delete", "message": msg_dict})
+    @staticmethod
+    def _mem_snapshot() -> Any:
+        snap = tracemalloc.take_snapshot()
+        return snap.filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            )
+        )
 
-            self.client.on_message()(_on_message)
-            self.client.on_message_edit()(_on_message_edit)
+    @staticmethod
+    def _mem_diff(new: Any, old: Any, top: int) -> List[Dict[str, Any]]:
+        out = []
+        for st in new.compare_to(old, "lineno")[:top]:
+            frame = st.traceback[0]
+            parts = frame.filename.replace("\\", "/").split("/")
+            out.append(
+                {
+                    "where": f"{'/'.join(parts[-2:])}:{frame.lineno}",
+                    "size_kib": round(st.size / 1024.0, 1),
+                    "size_diff_kib": round(st.size_diff / 1024.0, 1),
+                    "count_diff": st.count_diff,
+                }
+            )
+        return out
+
+    def get_memory_report(self, top: int = 15, reset_baseline: bool = False) -> Dict[str, Any]:
+        """
+        Размеры кешей обёртки/клиента + рост Python heap по tracemalloc.
+
+        Первый вызов включает tracemalloc и запоминает baseline (tracing_started=True, диффы пустые);
+        дальше — топ мест аллокации по росту с baseline и с предыдущего отчёта.
+        :param reset_baseline: после отчёта считать текущий снимок новым baseline
+        """
+        try:
+            started = False
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._mem_baseline = self._mem_last = None
+                started = True
+            snap = self._mem_snapshot()
+            top = max(1, int(top))
+            report: Dict[str, Any] = {
+                "tracing_started": started,
+                "growth_since_baseline": self._mem_diff(snap, self._mem_baseline, top) if self._mem_baseline else [],
+                "growth_since_last": self._mem_diff(snap, self._mem_last, top) if self._mem_last else [],
+            }
+            current, peak = tracemalloc.get_traced_memory()
+            report["traced_kib"] = round(current / 1024.0, 1)
+            report["traced_peak_kib"] = round(peak / 1024.0, 1)
+            report["tracemalloc_overhead_kib"] = round(tracemalloc.get_tracemalloc_memory() / 1024.0, 1)
+            try:
+                import resource
+
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                # Linux — КиБ, Darwin/iOS — байты.
+                report["max_rss_kib"] = rss if sys.platform.startswith("linux") else rss // 1024
+            except Exception:
+                pass
+            if self._mem_baseline is None or reset_baseline:
+                self._mem_baseline = snap
+            self._mem_last = snap
+
+            # _cache_report перебирает структуры loop thread (окна сообщений, LRU) — только на loop.
+            async def _caches():
+                return self._cache_report()
+
+            report["caches"] = self._run_async(_caches())
+            return {"success": True, "memory": report}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def stop_memory_tracking(self) -> Dict[str, Any]:
+        """Выключить tracemalloc (он замедляет аллокации) и отпустить снимки."""
+        self._mem_baseline = self._mem_last = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {"success": True}
+
+    def get_metrics(self, reset: bool = False) -> Dict[str, Any]:
+        """Снимок метрик операций (p50/p95/p99, ошибки по классам, retries, in-flight) и общих счётчиков."""
+        snap = self._metrics.snapshot()
+        if reset:
+            self._metrics.reset()
+        return {"success": True, "metrics": snap}
+
+    def reset_metrics(self) -> Dict[str, Any]:
+        self._metrics.reset()
+        return {"success": True}
+
+    def configure_metrics(self, enabled: bool) -> Dict[str, Any]:
+        self._metrics.enabled = bool(enabled)
+        return {"success": True, "enabled": self._metrics.enabled}
+
+    def configure_tracing(
+        self,
+        sample_rate: Optional[float] = None,
+        slow_ms: Optional[float] = None,
+        max_file_bytes: Optional[int] = None,
+        keep_files: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Настроить трассировку фаз операций.
+
+        :param sample_rate: доля трассируемых вызовов (0 — выключено, 1 — все)
+        :param slow_ms: всегда сохранять вызовы дольше порога (<= 0 — отключить)
+        """
+        try:
+            tr = self._tracer
+            if sample_rate is not None:
+                tr.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+            if slow_ms is not None:
+                tr.slow_ms = float(slow_ms) if float(slow_ms) > 0 else None
+            if max_file_bytes is not None:
+                tr.max_bytes = max(64 * 1024, int(max_file_bytes))
+            if keep_files is not None:
+                tr.keep_files = max(1, int(keep_files))
+            return {
+                "success": True,
+                "sample_rate": tr.sample_rate,
+                "slow_ms": tr.slow_ms,
+                "max_file_bytes": tr.max_bytes,
+                "keep_files": tr.keep_files,
+                "traces_dir": tr.root,
+                **tr.stats,
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_events_dir(self) -> Dict[str, Any]:
+        return {"success": True, "events_dir": self._events_dir}
+
+    def register_event_callbacks(self, events_dir: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Регистрирует pymax callbacks (message/edit/delete/reaction/chat_update) и пишет события в JSON-файлы.
+        Swift затем мониторит папку через DispatchSource.
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+
+        if events_dir:
+            self._events_dir = events_dir
+        os.makedirs(self._events_dir, exist_ok=True)
+
+        if self._callbacks_registered:
+            return {"success": True, "events_dir": self._events_dir, "already_registered": True}
+
+        try:
+            # Событие держит компактную запись; в JSON она превращается только при записи/poll в sink.
+            async def _on_message(msg: Any) -> None:
+                rec = self._message_record(msg)
+                if rec is not None:
+                    self._index_messages([rec])
+                    self._message_windows.on_message(rec)
+                    # Эхо собственного optimistic-сообщения: UI уже показал его и получит message_ack.
+                    if self._is_optimistic_echo(rec):
+                        return
+                    self._emit_event({"type": "message_new", "message": rec})
+
+            async def _on_message_edit(msg: Any) -> None:
+                rec = self._message_record(msg)
+                if rec is not None:
+                    self._index_messages([rec])
+                    self._message_windows.on_edit(rec)
+                    self._emit_event({"type": "message_edit", "message": rec})
+
+            async def _on_message_delete(msg: Any) -> None:
+                rec = self._message_record(msg)
+                if rec is not None:
+                    self._unindex_messages(rec.chat_id, [rec.id])
+                    self._message_windows.delete(rec.chat_id, [rec.id])
+                    self._emit_event({"type": "message_delete", "message": rec})
+
+            self.client.on_message()(_on_message)
+            self.client.on_message_edit()(_on_message_edit)
             self.client.on_message_delete()(_on_message_delete)
 
             async def _on_reaction_change(message_id: str, chat_id: int, reaction_info: Any) -> None:
@@ -419,6 +2478,11 @@ class MaxClientWrapper:
                     "type": self._get_field(chat, "type", default=None),
                     "icon_url": self._get_field(chat, "base_icon_url", "baseIconUrl", default=None),
                 }
+                if chat_dict["id"] is not None and chat_dict["title"]:
+                    try:
+                        self._chat_filter.upsert(int(chat_dict["id"]), chat_dict["title"])
+                    except Exception:
+                        pass
                 self._emit_event({"type": "chat_update", "chat": chat_dict})
 
             self.client.on_reaction_change(_on_reaction_change)
@@ -434,16 +2498,25 @@ class MaxClientWrapper:
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def __init__(self, phone: str, work_dir: Optional[str] = None, token: Optional[str] = None):
+    def __init__(
+        self,
+        phone: str,
+        work_dir: Optional[str] = None,
+        token: Optional[str] = None,
+        client_factory: Optional[Any] = None,
+    ):
         """
         Инициализация обертки.
         
         :param phone: Номер телефона
         :param work_dir: Рабочая директория для сохранения сессии
         :param token: Токен авторизации (если есть сохраненная сессия)
+        :param client_factory: Замена SocketMaxClient (тот же набор kwargs), например
+            devtools.fake_max.fake_client_factory() для офлайн-тестов и бенчмарков
         """
-        if SocketMaxClient is None:
-            raise RuntimeError("pymax not available")
+        # pymax загружается в create_client(): кешированные данные (события, поиск, фильтр чатов)
+        # доступны сразу после создания обёртки.
+        self._client_factory = client_factory
         
         # Определяем рабочую директорию
         if work_dir is None:
@@ -469,10 +2542,80 @@ class MaxClientWrapper:
         self._loop_lock = threading.Lock()
         self._loop_thread_ident: Optional[int] = None
         self._events_dir: str = os.path.join(self.work_dir, "events")
+        # Куда уходят события из _emit_event (см. configure_event_sink).
+        self._event_sink: Any = _FileEventSink(lambda: self._events_dir)
         self._callbacks_registered: bool = False
         self._conn_lock: Optional[asyncio.Lock] = None
         self._keepalive_task: Optional[asyncio.Task] = None
         self._keepalive_stop: Optional[asyncio.Event] = None
+        # Optimistic send: temp_id -> pending send; server ids whose echo must not reach the UI again.
+        self._pending_sends: Dict[str, Dict[str, Any]] = {}
+        self._suppressed_echo_ids: Dict[str, float] = {}
+        # Token-bucket limiter for outgoing requests (global + per operation class).
+        self._rate_limiter = _RateLimiter()
+        # Read-receipt coalescing: chat_id -> max message_id, flushed once per window.
+        self._read_coalesce_enabled: bool = True
+        self._read_window_s: float = 0.3
+        self._read_markers: Dict[int, int] = {}
+        self._read_retries: Dict[int, int] = {}
+        self._read_flush_task: Optional[asyncio.Task] = None
+        self._read_stats: Dict[str, int] = {"requested": 0, "network_calls": 0, "failed": 0}
+        # Uploads: files larger than one chunk go through the chunked/resumable path.
+        self._upload_chunk_size: int = 4 * 1024 * 1024
+        self._upload_chunk_retries: int = 2
+        self._upload_checkpoint_ttl_s: float = 6 * 3600.0
+        self._upload_cache = _UploadDedupCache(
+            os.path.join(self.work_dir, "upload_cache.json"), executor=self._io_executor
+        )
+        self._io_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._batch_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # Downloads: recently seen attachments + content-addressed media cache in work_dir/media.
+        self._attach_index = _BoundedLRU(self._ATTACH_INDEX_MAX)
+        self._media_cache = _DiskLRUCache(os.path.join(self.work_dir, "media"), 512 * 1024 * 1024)
+        self._download_connections: int = 4
+        self._download_part_size: int = 1024 * 1024
+        self._downloads_inflight: Dict[str, asyncio.Future] = {}
+        self._http_session: Any = None
+        # Avatar/icon thumbnails for the chat list (stable key per entity + photo_id).
+        self._thumb_cache = _DiskLRUCache(os.path.join(self.work_dir, "thumbs"), 64 * 1024 * 1024)
+        self._thumb_prefetch_count: int = 50
+        self._thumb_prefetch_task: Optional[asyncio.Task] = None
+        # Full-text message search (SQLite FTS5 in work_dir); all index I/O on one worker thread.
+        self._search_index = _MessageSearchIndex(os.path.join(self.work_dir, "search", "messages.sqlite3"))
+        self._search_pool_obj: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # Per-chat message windows (sorted by time/id) for local range queries, see get_messages_around().
+        self._message_windows = _MessageWindows()
+        # Chat-list filter index (titles / dialog peer names), see filter_chats().
+        self._chat_filter = _ChatFilterIndex()
+        # Lookup cache (search_by_phone / resolve_channel_by_name / join links) + in-flight dedup.
+        self._lookup_cache = _LookupCache()
+        self._lookup_inflight: Dict[str, asyncio.Task] = {}
+        self._lookup_latest: Dict[str, str] = {}
+        self._lookup_debounce_s = 0.0
+        # Background full-history indexer: walks fetch_history backward, checkpointed per chat.
+        self._history_task: Optional[asyncio.Task] = None
+        self._history_state_path = os.path.join(self.work_dir, "search", "history_index.json")
+        self._history_state: Optional[Dict[str, Any]] = None
+        self._history_rate_per_s = 1.0
+        self._history_page_size = 100
+        self._history_bucket = _TokenBucket(self._history_rate_per_s, 1)
+        # Per-operation metrics (latency histograms, errors, retries, in-flight), see get_metrics().
+        self._metrics = _Metrics()
+        # Phase-level tracing (sampled) -> work_dir/traces/traces.jsonl, see configure_tracing().
+        self._tracer = _Tracer(os.path.join(self.work_dir, "traces"))
+        # Sync API calls in flight (from Swift); the indexer yields while this is non-zero.
+        self._active_user_calls = 0
+        self._last_user_call_end = 0.0
+        self._active_user_calls_lock = threading.Lock()
+        # Memory report: bound for client._users, tracemalloc snapshots (baseline / previous report).
+        self._users_cache_max = self._USERS_CACHE_MAX
+        self._mem_baseline: Any = None
+        self._mem_last: Any = None
+        # Session snapshot (me / dialogs / chats / channels / folder ids) for start_client(fast=True).
+        self._session_snapshot_path = os.path.join(self.work_dir, "session_snapshot.json")
+        self._session_sync_task: Optional[asyncio.Task] = None
+        # None — в этой сессии get_folders ещё не вызывался: в снимке остаются прежние id.
+        self._folder_ids: Optional[List[Any]] = None
 
     async def _keepalive_loop(self) -> None:
         """
@@ -594,7 +2737,41 @@ class MaxClientWrapper:
         """Получить или создать event loop."""
         return self._ensure_loop_thread()
     
-    def _run_async(self, coro):
+    @staticmethod
+    async def _as_op(op: str, coro, trace: Optional[_Trace] = None):
+        """
+        Выполнить корутину с _current_op=op (видно retry-счётчикам и дочерним задачам)
+        и, если операция трассируется, с корневым span как родителем; фиксирует loop_hop.
+        """
+        _current_op.set(op)
+        if trace is None:
+            return await coro
+        root = trace.root
+        hop = _Span(trace, "loop_hop", root.span_id)
+        hop.t0 = root.t0
+        hop.end()
+        _current_span.set(root)
+        return await coro
+
+    @staticmethod
+    def _span(name: str, **attrs: Any) -> Any:
+        """Дочерний span текущей трассируемой операции; no-op, если трассировки нет."""
+        parent = _current_span.get()
+        if parent is None:
+            return _NOOP_SPAN
+        return _Span(parent.trace, name, parent.span_id, attrs or None)
+
+    async def _timed(self, stages: Optional[Dict[str, float]], name: str, aw: Any) -> Any:
+        """Выполнить этап (span + время в stages[name], мс); исключение пробрасывается."""
+        t0 = time.perf_counter()
+        try:
+            with self._span(name):
+                return await aw
+        finally:
+            if stages is not None:
+                stages[name] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+    def _run_async(self, coro, timeout: float = 60):
         """Run an async coroutine synchronously without stopping the asyncio loop."""
         loop = self._ensure_loop_thread()
         try:
@@ -602,8 +2779,39 @@ class MaxClientWrapper:
             if self._loop_thread_ident is not None and threading.get_ident() == self._loop_thread_ident:
                 raise RuntimeError("_run_async called from asyncio loop thread")
 
-            fut = asyncio.run_coroutine_threadsafe(coro, loop)
-            return fut.result(timeout=60)
+            metrics = self._metrics
+            tracer = self._tracer
+            op = sys._getframe(1).f_code.co_name if (metrics.enabled or tracer.active) else None
+            trace = None
+            if op is not None:
+                trace = tracer.start(op)
+                coro = self._as_op(op, coro, trace)
+                if metrics.enabled:
+                    metrics.op_start(op)
+                t0 = time.perf_counter()
+            with self._active_user_calls_lock:
+                self._active_user_calls += 1
+            err: Optional[str] = None
+            try:
+                fut = asyncio.run_coroutine_threadsafe(coro, loop)
+                result = fut.result(timeout=timeout)
+                if isinstance(result, dict) and result.get("success") is False:
+                    err = _classify_error(result.get("error"))
+                return result
+            except BaseException as e:
+                err = _classify_error(e)
+                raise
+            finally:
+                with self._active_user_calls_lock:
+                    self._active_user_calls -= 1
+                    self._last_user_call_end = time.monotonic()
+                if op is not None:
+                    if metrics.enabled:
+                        metrics.op_end(op, (time.perf_counter() - t0) * 1000.0, err)
+                    if trace is not None:
+                        record = tracer.finish(trace, err)
+                        if record is not None:
+                            self._io_executor().submit(tracer.write, record)
         except concurrent.futures.TimeoutError as e:
             _dprint("Error in _run_async: timeout")
             raise TimeoutError("Python async call timed out") from e
@@ -620,17 +2828,21 @@ class MaxClientWrapper:
         
         :return: Dict с результатом инициализации
         """
+        if self._client_factory is None and not _ensure_pymax():
+            return _pymax_unavailable_result()
         try:
             # Для iOS используем SocketMaxClient с device_type="IOS"
             # SocketMaxClient использует TCP Socket вместо WebSocket
-            ua = UserAgentPayload(device_type="IOS", app_version="25.12.14")
-            self.client = SocketMaxClient(
+            ua = UserAgentPayload(device_type="IOS", app_version="25.12.14") if UserAgentPayload is not None else None
+            factory = self._client_factory or SocketMaxClient
+            self.client = factory(
                 phone=self.phone,
                 work_dir=self.work_dir,
                 headers=ua,
                 token=self.token,  # Передаем токен если есть
                 reconnect=False,
             )
+            self._bound_client_users()
             return {"success": True, "message": "Client created"}
         except Exception as e:
             return {"success": False, "error": str(e)}
@@ -675,12 +2887,20 @@ class MaxClientWrapper:
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def login_with_code(self, temp_token: str, code: str) -> Dict[str, Any]:
+    def login_with_code(
+        self,
+        temp_token: str,
+        code: str,
+        bootstrap: bool = False,
+        bootstrap_options: Any = None,
+    ) -> Dict[str, Any]:
         """
         Авторизоваться с кодом.
         
         :param temp_token: Временный токен из request_code
         :param code: 6-значный код верификации
+        :param bootstrap: сразу после входа собрать стартовый payload (см. bootstrap()) и вернуть в "bootstrap"
+        :param bootstrap_options: dict/JSON kwargs для bootstrap (prefetch_chats, messages_limit, folder_sync)
         :return: Dict с результатом авторизации
         """
         if self.client is None:
@@ -732,6 +2952,7 @@ class MaxClientWrapper:
                 # Убеждаемся, что Socket подключен
                 if not self.client.is_connected:
                     _dprint("⚠️ Socket not connected, connecting...")
+                    self._message_windows.mark_stale()
                     try:
                         await self.client.connect(self.client.user_agent)
                         _dprint("✓ Socket connected")
@@ -802,6 +3023,7 @@ class MaxClientWrapper:
 
                         if is_connection_error and retry_count < max_retries - 1:
                             retry_count += 1
+                            self._metrics.retry()
                             _dprint(f"⚠️ Connection error detected ({error_type}), reconnecting and retrying...")
                             await _reset_connection()
                             await asyncio.sleep(0.5 * retry_count)
@@ -831,419 +3053,1406 @@ class MaxClientWrapper:
                 try:
                     await self.client._sync(self.client.user_agent)
                     await self.client._post_login_tasks(sync=False)
+                    self._save_session_snapshot()
                 except Exception as e:
                     _dprint(f"Warning: post-login init failed: {e}")
 
-                # Start background keepalive/reconnect loop (best-effort)
-                try:
-                    await self._ensure_keepalive_started()
-                except Exception:
-                    pass
-                
-                # Получаем информацию о текущем пользователе
-                me_info = None
-                if self.client.me:
-                    # Безопасно получаем first_name из names (поддержка и dict/pydantic)
-                    first_name = ""
-                    names = self._get_field(self.client.me, "names", default=None)
-                    if names and isinstance(names, list) and len(names) > 0:
-                        n0 = names[0]
-                        first_name = (
-                            self._get_field(n0, "first_name", "firstName", default=None)
-                            or self._get_field(n0, "name", default=None)
-                            or ""
-                        )
-
-                    me_info = {
-                        "id": self._get_field(self.client.me, "id", default=0),
-                        "first_name": first_name,  # Всегда строка, даже если пустая
-                        "phone": self._get_field(self.client.me, "phone", default=None) or self.phone,
-                    }
-                return {
+                result = {
                     "success": True,
                     "token": self.client._token,
                     "phone": self.phone,  # Возвращаем номер телефона для сохранения
-                    "me": me_info,  # Может быть None, если me еще не загружен
+                    "me": self._me_info(),  # Может быть None, если me еще не загружен
                 }
+                if bootstrap:
+                    # Чаты, папки и первые сообщения — в том же вызове (keepalive стартует внутри).
+                    # Вход уже состоялся: сбой bootstrap не должен потерять токен — он уходит в result["bootstrap"].
+                    try:
+                        opts = (
+                            json.loads(bootstrap_options)
+                            if isinstance(bootstrap_options, str)
+                            else dict(bootstrap_options or {})
+                        )
+                        result["bootstrap"] = await asyncio.wait_for(
+                            self._bootstrap_async(**opts), self._BOOTSTRAP_TIMEOUT_S
+                        )
+                    except Exception as e:
+                        err = "bootstrap timed out" if isinstance(e, asyncio.TimeoutError) else str(e)
+                        result["bootstrap"] = {"success": False, "error": err}
+                if not bootstrap or not result["bootstrap"].get("success"):
+                    # Start background keepalive/reconnect loop (best-effort)
+                    try:
+                        await self._ensure_keepalive_started()
+                    except Exception:
+                        pass
+                return result
             
-            return self._run_async(_login())
+            # Вход (до 60 с) + bootstrap (до _BOOTSTRAP_TIMEOUT_S) в одном вызове.
+            return self._run_async(_login(), timeout=60 + self._BOOTSTRAP_TIMEOUT_S if bootstrap else 60)
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def get_chats(self) -> Dict[str, Any]:
+    # Бюджет стартового конвейера (bootstrap() и login_with_code(bootstrap=True)), сек.
+    _BOOTSTRAP_TIMEOUT_S = 120
+
+    async def _bootstrap_async(
+        self, prefetch_chats: int = 3, messages_limit: int = 30, folder_sync: int = 0
+    ) -> Dict[str, Any]:
         """
-        Получить список чатов, диалогов и каналов.
-        
-        :return: Dict со списком всех чатов (dialogs, chats, channels)
+        Стартовый конвейер: session -> параллельно (keepalive, chats[users || groups], folders),
+        затем параллельно последние сообщения первых prefetch_chats чатов. Ошибка этапа,
+        кроме session, не валит остальные — она попадает в errors.
+        """
+        stages: Dict[str, float] = {}
+        errors: Dict[str, str] = {}
+        t0 = time.perf_counter()
+        try:
+            await self._timed(stages, "session", self._ensure_connected_and_session())
+        except Exception as e:
+            return {"success": False, "error": str(e), "stages": stages}
+
+        async def _stage(name: str, aw: Any) -> Any:
+            try:
+                return await self._timed(stages, name, aw)
+            except Exception as e:
+                errors[name] = str(e)
+                return None
+
+        async def _keepalive() -> None:
+            await self._ensure_keepalive_started()
+
+        async def _chats_then_prefetch() -> Any:
+            chats = await _stage("chats", self._get_chats_async(stages))
+            if not chats or not chats.get("success"):
+                return chats, {}
+            ids = [c["id"] for c in chats["chats"][: max(0, int(prefetch_chats))]]
+            if not ids:
+                return chats, {}
+
+            async def _one(chat_id: Any) -> Any:
+                res = await self._get_messages_async(chat_id, messages_limit)
+                if not res.get("success"):
+                    raise RuntimeError(res.get("error") or "get_messages failed")
+                return res["messages"]
+
+            async def _prefetch() -> Dict[str, Any]:
+                pages = await asyncio.gather(*(_one(cid) for cid in ids), return_exceptions=True)
+                out: Dict[str, Any] = {}
+                for cid, page in zip(ids, pages):
+                    if isinstance(page, BaseException):
+                        errors[f"messages:{cid}"] = str(page)
+                    else:
+                        out[str(cid)] = page
+                return out
+
+            return chats, await _stage("prefetch", _prefetch())
+
+        _, (chats, messages), folders = await asyncio.gather(
+            _stage("keepalive", _keepalive()),
+            _chats_then_prefetch(),
+            _stage("folders", self._get_folders_async(folder_sync)),
+        )
+        if chats is not None and not chats.get("success"):
+            errors["chats"] = chats.get("error") or "get_chats failed"
+        if folders is not None and not folders.get("success"):
+            errors["folders"] = folders.get("error") or "get_folders failed"
+        return {
+            "success": True,
+            "me": self._me_info(),
+            "chats": (chats or {}).get("chats"),
+            "folders": (folders or {}).get("folders"),
+            "messages": messages or {},
+            "stages": stages,
+            "total_ms": round((time.perf_counter() - t0) * 1000.0, 2),
+            "errors": errors,
+        }
+
+    def bootstrap(self, prefetch_chats: int = 3, messages_limit: int = 30, folder_sync: int = 0) -> Dict[str, Any]:
+        """
+        Всё для первого экрана одним вызовом: me, чаты, папки и последние сообщения первых чатов.
+
+        Независимые запросы выполняются параллельно; время каждого этапа — в "stages" (мс).
         """
         if self.client is None:
             return {"success": False, "error": "Client not initialized"}
-        
         try:
-            async def _get_chats():
-                # Ensure connected + session initialized (also prevents concurrent connect storms)
-                await self._ensure_connected_and_session()
+            return self._run_async(
+                self._bootstrap_async(prefetch_chats, messages_limit, folder_sync), timeout=self._BOOTSTRAP_TIMEOUT_S
+            )
+        except Exception as e:
+            return {"success": False, "error": str(e)}
 
-                # Важно: для нормальных имён диалогов нужно подтянуть пользователей по cid.
-                # pymax умеет это через get_users() (CONTACT_INFO).
-                try:
-                    cids = [d.cid for d in self.client.dialogs if getattr(d, "cid", None)]
-                    # Убираем дубли и None
-                    unique_cids = sorted({int(x) for x in cids if x is not None})
-                    if unique_cids:
-                        # Загружаем пользователей и ждем завершения
-                        await self.client.get_users(unique_cids)
-                        # Даем немного времени на обновление кеша
-                        await asyncio.sleep(0.1)
-                except Exception as e:
-                    # best-effort: не ломаем список чатов, если CONTACT_INFO упал
-                    _dprint(f"Warning: Failed to load users: {e}")
-                    pass
-                
-                # Собираем все типы чатов: диалоги, чаты и каналы
-                # IMPORTANT: IDs can appear in multiple sources (e.g. channels are also in chats list),
-                # so we must dedupe by id to keep Swift stable.
-                prio = {"DIALOG": 0, "CHAT": 1, "CHANNEL": 2}
-                by_id: Dict[int, Dict[str, Any]] = {}
+    # Операции, доступные в call_batch: имя -> async-реализация, которая выполняется прямо на loop,
+    # или None — тогда синхронный публичный метод идёт в пул батча (сам он попадает на loop через _run_async).
+    _BATCH_OPS: Dict[str, Optional[str]] = {
+        "get_chats": "_get_chats_async",
+        "get_messages": "_get_messages_async",
+        "get_folders": "_get_folders_async",
+        "get_messages_around": None,
+        "fetch_chats": None,
+        "filter_chats": None,
+        "search_messages": None,
+        "search_by_phone": None,
+        "resolve_channel_by_name": None,
+        "read_message": None,
+        "flush_read_markers": None,
+        "send_message": None,
+        "edit_message": None,
+        "delete_message": None,
+        "pin_message": None,
+        "add_reaction": None,
+        "remove_reaction": None,
+        "get_read_marker_stats": None,
+        "get_message_window_stats": None,
+        "get_search_index_stats": None,
+    }
+
+    def _batch_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """Отдельный пул для синхронных операций call_batch (не занимает io pool, которым они сами пользуются)."""
+        if self._batch_pool is None:
+            self._batch_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=8, thread_name_prefix="whitemax-batch"
+            )
+        return self._batch_pool
+
+    async def _batch_native(self, op: str, aw: Any) -> Any:
+        """Async-операция батча с теми же метриками и span, что дал бы ей _run_async."""
+        _current_op.set(op)
+        metrics = self._metrics
+        if metrics.enabled:
+            metrics.op_start(op)
+        t0 = time.perf_counter()
+        err: Optional[str] = None
+        try:
+            with self._span(op):
+                result = await aw
+            if isinstance(result, dict) and result.get("success") is False:
+                err = _classify_error(result.get("error"))
+            return result
+        except BaseException as e:
+            err = _classify_error(e)
+            raise
+        finally:
+            if metrics.enabled:
+                metrics.op_end(op, (time.perf_counter() - t0) * 1000.0, err)
+
+    def _batch_check(self, spec: Any) -> Optional[str]:
+        """Ошибка формата операции батча (или None): объект, известная op, args — объект или список."""
+        if not isinstance(spec, dict):
+            return "op must be an object"
+        if spec.get("op") not in self._BATCH_OPS:
+            return f"Unsupported op: {spec.get('op')}"
+        if spec.get("args") is not None and not isinstance(spec["args"], (dict, list)):
+            return "args must be an object or a list"
+        return None
+
+    async def _batch_one(self, index: int, spec: Any, in_pool: set) -> Dict[str, Any]:
+        """
+        Выполнить одну операцию батча; любая ошибка превращается в {"success": False, ...}.
+        Индексы синхронных операций, уже отданных в пул, попадают в in_pool: отменить их нельзя.
+        """
+        entry: Dict[str, Any] = {"index": index, "id": None, "op": None}
+        t0 = time.perf_counter()
+        try:
+            if isinstance(spec, dict):
+                entry["id"] = spec.get("id")
+                entry["op"] = spec.get("op")
+            err = self._batch_check(spec)
+            if err is not None:
+                raise ValueError(err)
+            op = spec["op"]
+            args = spec.get("args")
+            if args is None:
+                args = {}
+            pos, kw = (list(args), {}) if isinstance(args, list) else ((), dict(args))
+            impl = self._BATCH_OPS[op]
+            if impl is not None:
+                result = await self._batch_native(op, getattr(self, impl)(*pos, **kw))
+            else:
+                method = getattr(self, op)
+                in_pool.add(index)
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self._batch_executor(), lambda: method(*pos, **kw)
+                )
+            if not isinstance(result, dict):
+                result = {"success": True, "result": result}
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        entry["ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+        entry["result"] = result
+        return entry
+
+    def call_batch(
+        self,
+        ops: Any,
+        sequential: bool = False,
+        isolate: bool = True,
+        timeout: float = 60,
+    ) -> Dict[str, Any]:
+        """
+        Несколько операций за один вызов из Swift (например, открытие чата: get_messages + read_message + get_folders).
+
+        :param ops: list/JSON: [{"op": "get_messages", "args": {"chat_id": 1, "limit": 30}, "id": "m"}, ...];
+            args — объект (именованные) или список (позиционные) аргументы публичного метода, см. _BATCH_OPS.
+        :param sequential: выполнять строго по порядку (для зависимых мутаций), иначе — параллельно на loop.
+        :param isolate: ошибка операции не влияет на остальные. При False формат всех операций проверяется
+            до запуска, а первая ошибка останавливает батч: не начатые и выполняющиеся async-операции
+            отменяются ("skipped": true). Синхронные операции, уже отданные в пул, отменить нельзя —
+            они помечаются "running": true (результат неизвестен, повторять мутацию вслепую не стоит).
+        :param timeout: общий бюджет батча (с); не уложившиеся операции отменяются с error="timeout".
+        :return: {"success", "results": [{"index", "id", "op", "ms", "result"}] в порядке ops, "failed", "took_ms"}
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        try:
+            specs = json.loads(ops) if isinstance(ops, str) else list(ops or [])
+            if not isinstance(specs, list):
+                return {"success": False, "error": "ops must be a list"}
+        except Exception as e:
+            return {"success": False, "error": f"Invalid ops: {e}"}
+        try:
+            budget = max(0.0, float(timeout))
+        except (TypeError, ValueError) as e:
+            return {"success": False, "error": f"Invalid timeout: {e}"}
+
+        def _stub(i: int, result: Dict[str, Any]) -> Dict[str, Any]:
+            spec = specs[i] if isinstance(specs[i], dict) else {}
+            return {"index": i, "id": spec.get("id"), "op": spec.get("op"), "ms": 0.0, "result": result}
+
+        def _failed(entry: Dict[str, Any]) -> bool:
+            return not entry["result"].get("success", True)
+
+        def _summary(entries: List[Dict[str, Any]], ok: bool, t0: float) -> Dict[str, Any]:
+            result: Dict[str, Any] = {
+                "success": ok,
+                "results": entries,
+                "failed": sum(1 for e in entries if _failed(e)),
+                "took_ms": round((time.perf_counter() - t0) * 1000.0, 2),
+            }
+            if not ok:
+                # Причина — первая настоящая ошибка, а не отменённые/недождавшиеся из-за неё операции.
+                failures = [e for e in entries if _failed(e)]
+                first = next(
+                    (e for e in failures if not e["result"].get("skipped") and not e["result"].get("running")),
+                    failures[0] if failures else None,
+                )
+                result["error"] = (first["result"].get("error") if first else None) or "batch failed"
+            return result
 
-                def _upsert(cd: Dict[str, Any]) -> None:
+        if not isolate:
+            invalid = {i: err for i, err in ((i, self._batch_check(s)) for i, s in enumerate(specs)) if err}
+            if invalid:
+                entries = [
+                    _stub(i, {"success": False, "error": invalid[i]})
+                    if i in invalid
+                    else _stub(i, {"success": False, "error": "skipped", "skipped": True})
+                    for i in range(len(specs))
+                ]
+                return _summary(entries, False, time.perf_counter())
+
+        async def _batch() -> Dict[str, Any]:
+            t0 = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + budget
+            entries: List[Optional[Dict[str, Any]]] = [None] * len(specs)
+            in_pool: set = set()
+            stop_reason: Optional[str] = None
+            if sequential:
+                for i, spec in enumerate(specs):
+                    task = loop.create_task(self._batch_one(i, spec, in_pool))
                     try:
-                        cid = int(cd.get("id"))
-                    except Exception:
-                        return
-                    cur = by_id.get(cid)
-                    if cur is None:
-                        by_id[cid] = cd
-                        return
-                    cur_type = str(cur.get("type") or "unknown").upper()
-                    new_type = str(cd.get("type") or "unknown").upper()
-                    if prio.get(new_type, -1) > prio.get(cur_type, -1):
-                        by_id[cid] = cd
-                        return
-                    # Otherwise keep current, but fill missing fields from new.
-                    if not (cur.get("title") or "") and (cd.get("title") or ""):
-                        cur["title"] = cd.get("title")
-                    if cur.get("icon_url") is None and cd.get("icon_url") is not None:
-                        cur["icon_url"] = cd.get("icon_url")
-                    if cur.get("photo_id") is None and cd.get("photo_id") is not None:
-                        cur["photo_id"] = cd.get("photo_id")
-                
-                # Добавляем диалоги
-                for dialog in self.client.dialogs:
-                    # Название диалога (обычно имя собеседника)
-                    title: str = ""
-                    photo_id = None
-                    icon_url = None
-                    
-                    # Determine peer id for dialog.
-                    # Prefer participants != me.id (more reliable than cid), fallback to dialog.cid.
-                    me_id = self._get_field(self.client.me, "id", default=None) if getattr(self.client, "me", None) else None
-                    peer_id = None
-                    parts = self._get_field(dialog, "participants", default=None)
-                    if me_id is not None and isinstance(parts, dict):
-                        try:
-                            for k in parts.keys():
-                                try:
-                                    pid = int(k)
-                                except Exception:
-                                    continue
-                                if int(pid) != int(me_id):
-                                    peer_id = int(pid)
-                                    break
-                        except Exception:
-                            peer_id = None
+                        entries[i] = await asyncio.wait_for(task, max(0.0, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        stop_reason = "timeout"
+                        break
+                    if not isolate and _failed(entries[i]):
+                        stop_reason = "skipped"
+                        break
+            else:
+                tasks = [loop.create_task(self._batch_one(i, spec, in_pool)) for i, spec in enumerate(specs)]
+                pending = set(tasks)
+                while pending:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        stop_reason = "timeout"
+                        break
+                    done, pending = await asyncio.wait(
+                        pending,
+                        timeout=remaining,
+                        return_when=asyncio.ALL_COMPLETED if isolate else asyncio.FIRST_COMPLETED,
+                    )
+                    for t in done:
+                        entry = t.result()
+                        entries[entry["index"]] = entry
+                    if not isolate and any(_failed(t.result()) for t in done):
+                        stop_reason = "skipped"
+                        break
+                for t in pending:
+                    t.cancel()
+            for i, entry in enumerate(entries):
+                if entry is not None:
+                    continue
+                err: Dict[str, Any] = {"success": False, "error": stop_reason or "skipped"}
+                if i in in_pool:
+                    # Уже выполняется в пуле: итог неизвестен (мутация могла пройти).
+                    err["running"] = True
+                    if stop_reason != "timeout":
+                        err["error"] = "outcome unknown: still running"
+                elif stop_reason != "timeout":
+                    err["skipped"] = True
+                entries[i] = _stub(i, err)
+            filled = [e for e in entries if e is not None]
+            failed = any(_failed(e) for e in filled)
+            return _summary(filled, not failed or (isolate and stop_reason is None), t0)
+
+        try:
+            # Небольшой запас сверх бюджета: ответ с частичными результатами собирается уже после дедлайна.
+            return self._run_async(_batch(), timeout=budget + 5)
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def filter_chats(self, query: str, limit: int = 50) -> Dict[str, Any]:
+        """
+        Отфильтровать список чатов по названию (регистр, ё/е и кириллица/латиница не важны).
+
+        Работает по локальному индексу, который строится в get_chats; сервер не трогает.
+        :return: Dict с ранжированным списком id чатов
+        """
+        t0 = time.perf_counter()
+        try:
+            ids = self._chat_filter.query(query or "", max(1, int(limit)))
+            return {
+                "success": True,
+                "ids": ids,
+                "indexed": len(self._chat_filter),
+                "took_us": int((time.perf_counter() - t0) * 1e6),
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    async def _get_chats_async(self, stages: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """Собрать список чатов (на loop); stages — куда записать время этапов users / groups."""
+        # Ensure connected + session initialized (also prevents concurrent connect storms)
+        await self._ensure_connected_and_session()
+        await self._throttle("fetch")
+
+        # Важно: для нормальных имён диалогов нужно подтянуть пользователей по cid.
+        # pymax умеет это через get_users() (CONTACT_INFO).
+        async def _load_users() -> None:
+            try:
+                cids = [d.cid for d in self.client.dialogs if getattr(d, "cid", None)]
+                # Убираем дубли и None
+                unique_cids = sorted({int(x) for x in cids if x is not None})
+                if unique_cids:
+                    # Загружаем пользователей и ждем завершения
+                    await self.client.get_users(unique_cids)
+                    # Даем немного времени на обновление кеша
+                    if self._USERS_SETTLE_S > 0:
+                        await asyncio.sleep(self._USERS_SETTLE_S)
+            except Exception as e:
+                # best-effort: не ломаем список чатов, если CONTACT_INFO упал
+                _dprint(f"Warning: Failed to load users: {e}")
+
+        async def _load_groups() -> List[Any]:
+            chat_ids = [chat.id for chat in self.client.chats]
+            return await self.client.get_chats(chat_ids) if chat_ids else []
+
+        # Пользователи диалогов и информация о группах независимы — запрашиваем параллельно.
+        _, group_chats = await asyncio.gather(
+            self._timed(stages, "users", _load_users()),
+            self._timed(stages, "groups", _load_groups()),
+        )
+
+        # Собираем все типы чатов: диалоги, чаты и каналы
+        # IMPORTANT: IDs can appear in multiple sources (e.g. channels are also in chats list),
+        # so we must dedupe by id to keep Swift stable.
+        prio = {"DIALOG": 0, "CHAT": 1, "CHANNEL": 2}
+        by_id: Dict[int, Dict[str, Any]] = {}
 
-                    if peer_id is None and getattr(dialog, "cid", None) is not None:
+        def _upsert(cd: Dict[str, Any]) -> None:
+            try:
+                cid = int(cd.get("id"))
+            except Exception:
+                return
+            cur = by_id.get(cid)
+            if cur is None:
+                by_id[cid] = cd
+                return
+            cur_type = str(cur.get("type") or "unknown").upper()
+            new_type = str(cd.get("type") or "unknown").upper()
+            if prio.get(new_type, -1) > prio.get(cur_type, -1):
+                by_id[cid] = cd
+                return
+            # Otherwise keep current, but fill missing fields from new.
+            if not (cur.get("title") or "") and (cd.get("title") or ""):
+                cur["title"] = cd.get("title")
+            if cur.get("icon_url") is None and cd.get("icon_url") is not None:
+                cur["icon_url"] = cd.get("icon_url")
+                cur["_thumb"] = cd.get("_thumb")
+            if cur.get("photo_id") is None and cd.get("photo_id") is not None:
+                cur["photo_id"] = cd.get("photo_id")
+
+        # Добавляем диалоги
+        for dialog in self.client.dialogs:
+            # Название диалога (обычно имя собеседника)
+            title: str = ""
+            photo_id = None
+            icon_url = None
+            raw_icon_url = None
+
+            # Determine peer id for dialog.
+            # Prefer participants != me.id (more reliable than cid), fallback to dialog.cid.
+            me_id = self._get_field(self.client.me, "id", default=None) if getattr(self.client, "me", None) else None
+            peer_id = None
+            parts = self._get_field(dialog, "participants", default=None)
+            if me_id is not None and isinstance(parts, dict):
+                try:
+                    for k in parts.keys():
                         try:
-                            peer_id = int(dialog.cid)
+                            pid = int(k)
                         except Exception:
-                            peer_id = None
+                            continue
+                        if int(pid) != int(me_id):
+                            peer_id = int(pid)
+                            break
+                except Exception:
+                    peer_id = None
+
+            if peer_id is None and getattr(dialog, "cid", None) is not None:
+                try:
+                    peer_id = int(dialog.cid)
+                except Exception:
+                    peer_id = None
+
+            if peer_id is not None:
+                try:
+                    # Получаем пользователя по ID из _users
+                    user = self.client._users.get(peer_id)
 
-                    if peer_id is not None:
+                    # Если пользователь не найден в кеше, пытаемся загрузить его
+                    if user is None:
                         try:
-                            # Получаем пользователя по ID из _users
-                            user = self.client._users.get(peer_id)
-                            
-                            # Если пользователь не найден в кеше, пытаемся загрузить его
-                            if user is None:
-                                try:
-                                    users = await self.client.get_users([peer_id])
-                                    if users and len(users) > 0:
-                                        user = users[0]
-                                        # Обновляем кеш
-                                        self.client._users[peer_id] = user
-                                except Exception as load_error:
-                                    _dprint(f"Warning: Failed to load user {peer_id}: {load_error}")
-                            
-                            if user is not None:
-                                # Пытаемся получить имя из разных источников
-                                user_names = self._get_field(user, "names", default=None)
-                                if user_names and isinstance(user_names, list) and len(user_names) > 0:
-                                    # Проверяем все имена в списке
-                                    for name_obj in user_names:
-                                        # Пробуем разные варианты полей
-                                        name = (
-                                            self._get_field(name_obj, "name", default=None)
-                                            or self._get_field(name_obj, "first_name", "firstName", default=None)
-                                            or None
-                                        )
-                                        if name and name.strip():
-                                            title = name.strip()
-                                            break
-                                
-                                # Если имя не найдено в names, пробуем другие поля
-                                if not title:
-                                    # Пробуем напрямую из user
-                                    title = (
-                                        self._get_field(user, "name", default=None)
-                                        or self._get_field(user, "first_name", "firstName", default=None)
-                                        or None
-                                    )
-                                    if title:
-                                        title = title.strip()
-                                
-                                # Получаем photo_id
-                                photo_id = self._get_field(user, "photo_id", "photoId", default=None)
-                                
-                                # Получаем base_url для формирования icon_url
-                                base_url = self._get_field(user, "base_url", "baseUrl", default=None)
-                                base_raw_url = self._get_field(user, "base_raw_url", "baseRawUrl", default=None)
-                                # Используем base_url или base_raw_url для icon_url
-                                icon_url = base_url or base_raw_url
-                                # Cache-buster for avatars as well
-                                if icon_url:
-                                    try:
-                                        sep = "&" if "?" in str(icon_url) else "?"
-                                        icon_url = f"{icon_url}{sep}uid={int(peer_id)}"
-                                    except Exception:
-                                        pass
-                        except Exception as e:
-                            _dprint(f"Warning: Failed to get user info for peer_id {peer_id}: {e}")
-                            pass
+                            users = await self.client.get_users([peer_id])
+                            if users and len(users) > 0:
+                                user = users[0]
+                                # Обновляем кеш
+                                self.client._users[peer_id] = user
+                        except Exception as load_error:
+                            _dprint(f"Warning: Failed to load user {peer_id}: {load_error}")
+
+                    if user is not None:
+                        # Пытаемся получить имя из разных источников
+                        user_names = self._get_field(user, "names", default=None)
+                        if user_names and isinstance(user_names, list) and len(user_names) > 0:
+                            # Проверяем все имена в списке
+                            for name_obj in user_names:
+                                # Пробуем разные варианты полей
+                                name = (
+                                    self._get_field(name_obj, "name", default=None)
+                                    or self._get_field(name_obj, "first_name", "firstName", default=None)
+                                    or None
+                                )
+                                if name and name.strip():
+                                    title = name.strip()
+                                    break
 
-                    # Если имя не найдено, используем fallback
-                    if not title:
-                        title = f"User {peer_id}" if peer_id is not None else f"Dialog {dialog.id}"
-                    
-                    chat_dict = {
-                        "id": dialog.id,
-                        "title": title,
-                        "type": "DIALOG",
-                        "photo_id": photo_id,  # Для диалога берем photo_id из User
-                        "icon_url": icon_url,  # Используем base_url из User для отображения фото профиля
-                        "unread_count": 0,  # Dialog не имеет unread_count
-                        "cid": peer_id,
-                    }
-                    _upsert(chat_dict)
-                
-                # Добавляем чаты (группы)
-                chat_ids = [chat.id for chat in self.client.chats]
-                if chat_ids:
-                    chats = await self.client.get_chats(chat_ids)
-                    for chat in chats:
-                        icon_url = self._get_field(chat, "base_icon_url", "baseIconUrl", default=None)
+                        # Если имя не найдено в names, пробуем другие поля
+                        if not title:
+                            # Пробуем напрямую из user
+                            title = (
+                                self._get_field(user, "name", default=None)
+                                or self._get_field(user, "first_name", "firstName", default=None)
+                                or None
+                            )
+                            if title:
+                                title = title.strip()
+
+                        # Получаем photo_id
+                        photo_id = self._get_field(user, "photo_id", "photoId", default=None)
+
+                        # Получаем base_url для формирования icon_url
+                        base_url = self._get_field(user, "base_url", "baseUrl", default=None)
+                        base_raw_url = self._get_field(user, "base_raw_url", "baseRawUrl", default=None)
+                        # Используем base_url или base_raw_url для icon_url
+                        icon_url = base_url or base_raw_url
+                        raw_icon_url = icon_url
+                        # Cache-buster for avatars as well
                         if icon_url:
                             try:
                                 sep = "&" if "?" in str(icon_url) else "?"
-                                icon_url = f"{icon_url}{sep}chatId={int(chat.id)}"
+                                icon_url = f"{icon_url}{sep}uid={int(peer_id)}"
                             except Exception:
                                 pass
-                        chat_dict = {
-                            "id": chat.id,
-                            "title": self._get_field(chat, "title", default="") or "",
-                            "type": "CHAT",
-                            "photo_id": None,  # Chat не имеет photo_id, использует base_icon_url
-                            "icon_url": icon_url,
-                            "unread_count": 0,  # Chat не имеет unread_count
-                        }
-                        _upsert(chat_dict)
-                
-                # Добавляем каналы (Channel наследуется от Chat)
-                for channel in self.client.channels:
-                    icon_url = self._get_field(channel, "base_icon_url", "baseIconUrl", default=None)
-                    if icon_url:
-                        try:
-                            sep = "&" if "?" in str(icon_url) else "?"
-                            icon_url = f"{icon_url}{sep}chatId={int(channel.id)}"
-                        except Exception:
-                            pass
-                    chat_dict = {
-                        "id": channel.id,
-                        "title": self._get_field(channel, "title", default="") or "",
-                        "type": "CHANNEL",
-                        "photo_id": None,  # Channel не имеет photo_id, использует base_icon_url
-                        "icon_url": icon_url,
-                        "unread_count": 0,  # Channel не имеет unread_count
-                    }
-                    _upsert(chat_dict)
-                
-                return {"success": True, "chats": list(by_id.values())}
-            
-            return self._run_async(_get_chats())
-        except Exception as e:
-            return {"success": False, "error": str(e)}
-    
-    def get_messages(self, chat_id: int, limit: int = 50) -> Dict[str, Any]:
+                except Exception as e:
+                    _dprint(f"Warning: Failed to get user info for peer_id {peer_id}: {e}")
+                    pass
+
+            # Если имя не найдено, используем fallback
+            if not title:
+                title = f"User {peer_id}" if peer_id is not None else f"Dialog {dialog.id}"
+
+            chat_dict = {
+                "id": dialog.id,
+                "title": title,
+                "type": "DIALOG",
+                "photo_id": photo_id,  # Для диалога берем photo_id из User
+                "icon_url": icon_url,  # Используем base_url из User для отображения фото профиля
+                "unread_count": 0,  # Dialog не имеет unread_count
+                "cid": peer_id,
+                "_thumb": ("user", peer_id, photo_id, raw_icon_url),
+            }
+            _upsert(chat_dict)
+
+        # Добавляем чаты (группы)
+        if group_chats:
+            for chat in group_chats:
+                icon_url = self._get_field(chat, "base_icon_url", "baseIconUrl", default=None)
+                raw_icon_url = icon_url
+                if icon_url:
+                    try:
+                        sep = "&" if "?" in str(icon_url) else "?"
+                        icon_url = f"{icon_url}{sep}chatId={int(chat.id)}"
+                    except Exception:
+                        pass
+                chat_dict = {
+                    "id": chat.id,
+                    "title": self._get_field(chat, "title", default="") or "",
+                    "type": "CHAT",
+                    "photo_id": None,  # Chat не имеет photo_id, использует base_icon_url
+                    "icon_url": icon_url,
+                    "unread_count": 0,  # Chat не имеет unread_count
+                    "_thumb": ("chat", chat.id, None, raw_icon_url),
+                }
+                _upsert(chat_dict)
+
+        # Добавляем каналы (Channel наследуется от Chat)
+        for channel in self.client.channels:
+            icon_url = self._get_field(channel, "base_icon_url", "baseIconUrl", default=None)
+            raw_icon_url = icon_url
+            if icon_url:
+                try:
+                    sep = "&" if "?" in str(icon_url) else "?"
+                    icon_url = f"{icon_url}{sep}chatId={int(channel.id)}"
+                except Exception:
+                    pass
+            chat_dict = {
+                "id": channel.id,
+                "title": self._get_field(channel, "title", default="") or "",
+                "type": "CHANNEL",
+                "photo_id": None,  # Channel не имеет photo_id, использует base_icon_url
+                "icon_url": icon_url,
+                "unread_count": 0,  # Channel не имеет unread_count
+                "_thumb": ("chat", channel.id, None, raw_icon_url),
+            }
+            _upsert(chat_dict)
+
+        chats_out = list(by_id.values())
+        self._chat_filter.rebuild(chats_out)
+        await self._attach_thumbnails(chats_out)
+        return {"success": True, "chats": chats_out}
+
+    def get_chats(self) -> Dict[str, Any]:
         """
-        Получить сообщения из чата.
+        Получить список чатов, диалогов и каналов.
         
-        :param chat_id: ID чата
-        :param limit: Максимальное количество сообщений
-        :return: Dict со списком сообщений
+        :return: Dict со списком всех чатов (dialogs, chats, channels)
         """
         if self.client is None:
             return {"success": False, "error": "Client not initialized"}
         
         try:
-            async def _get_messages():
-                # Вспомогательная функция для переподключения и инициализации сессии
-                async def _ensure_connected():
-                    """Убедиться, что соединение установлено и сессия инициализирована."""
-                    if not self.client.is_connected:
-                        _dprint("⚠️ Socket not connected, connecting...")
-                        try:
-                            # Закрываем старое соединение если есть
-                            if hasattr(self.client, '_socket') and self.client._socket:
-                                try:
-                                    self.client._socket.close()
-                                except:
-                                    pass
-                            self.client.is_connected = False
-                            
-                            await self.client.connect(self.client.user_agent)
-                            _dprint("✓ Socket connected")
-                            
-                            # Если есть токен, нужно инициализировать сессию
-                            if self.client._token:
-                                _dprint("⚠️ Token found, initializing session...")
-                                await self.client._sync(self.client.user_agent)
-                                await self.client._post_login_tasks(sync=False)
-                                _dprint("✓ Session initialized")
-                        except Exception as conn_error:
-                            _dprint(f"✗ Connection failed: {conn_error}, retrying...")
-                            # Если соединение не удалось, пробуем еще раз
-                            await asyncio.sleep(0.5)
-                            await self.client.connect(self.client.user_agent)
-                            if self.client._token:
-                                await self.client._sync(self.client.user_agent)
-                                await self.client._post_login_tasks(sync=False)
-                    elif self.client._token and not self.client.me:
-                        # Если подключены, но сессия не инициализирована, инициализируем
-                        _dprint("⚠️ Socket connected but session not initialized, initializing...")
-                        await self.client._sync(self.client.user_agent)
-                        await self.client._post_login_tasks(sync=False)
-                        _dprint("✓ Session initialized")
-                
-                # Убеждаемся, что Socket подключен и сессия инициализирована
-                await _ensure_connected()
-                
-                # fetch_history использует backward для количества сообщений
-                # Обрабатываем ошибки соединения и переподключаемся при необходимости
-                max_retries = 3
-                retry_count = 0
-                messages = None
-                last_error = None
-                
-                while retry_count < max_retries:
-                    try:
-                        # Проверяем соединение перед каждой попыткой
-                        if not self.client.is_connected:
-                            _dprint("⚠️ Connection lost before fetch_history, reconnecting...")
-                            await _ensure_connected()
-                        
-                        messages = await self.client.fetch_history(chat_id=chat_id, backward=limit, forward=0)
-                        break  # Успешно получили сообщения
-                    except Exception as e:
-                        last_error = e
-                        error_str = str(e)
-                        error_type = type(e).__name__
-                        _dprint(
-                            f"✗ Error fetching history for chat_id={chat_id} "
-                            f"(attempt {retry_count + 1}/{max_retries}): {error_type}: {e}"
-                        )
-                        
-                        # Проверяем, является ли ошибка связанной с соединением
-                        # Проверяем по типу исключения (если импортированы) и по строке
-                        is_connection_error = (
-                            (PYMAX_AVAILABLE and (isinstance(e, SocketNotConnectedError) or isinstance(e, SocketSendError))) or
-                            isinstance(e, ssl.SSLEOFError) or
-                            isinstance(e, ssl.SSLError) or
-                            isinstance(e, ConnectionError) or
-                            error_type in ["SocketNotConnectedError", "SocketSendError", "SSLEOFError", "SSLError", "ConnectionError"] or
-                            any(keyword in error_str.lower() for keyword in ["not connected", "socket", "eof", "connection", "send and wait failed"])
+            return self._run_async(self._get_chats_async())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @staticmethod
+    def _thumb_key(kind: str, entity_id: Any, photo_id: Any, raw_url: str) -> Optional[str]:
+        """
+        Стабильный ключ миниатюры: (сущность, photo_id). У групп/каналов photo_id нет —
+        идентификатором фото служит сам base_icon_url (без cache-buster'ов).
+        """
+        if entity_id is None or not raw_url:
+            return None
+        photo_key = str(photo_id) if photo_id is not None else hashlib.sha1(raw_url.encode("utf-8")).hexdigest()[:16]
+        return f"{kind}:{entity_id}:{photo_key}"
+
+    async def _attach_thumbnails(self, chats: List[Dict[str, Any]]) -> None:
+        """
+        Проставить icon_path (локальный файл) из кеша миниатюр и запустить фоновую подгрузку
+        аватаров для первых N чатов, которых ещё нет в кеше. Выполняется на loop thread;
+        индекс кеша и stat файлов читаются одним вызовом в пуле I/O.
+        """
+        thumbs: List[Any] = []
+        for cd in chats:
+            kind, entity_id, photo_id, raw_url = cd.pop("_thumb", None) or (None, None, None, None)
+            key = self._thumb_key(kind, entity_id, photo_id, raw_url) if kind else None
+            thumbs.append((cd, kind, entity_id, key, raw_url))
+        keys = [t[3] for t in thumbs if t[3]]
+        paths = await self._in_io_pool(self._thumb_cache.get_many, keys) if keys else {}
+
+        missing: List[Any] = []
+        for cd, kind, entity_id, key, raw_url in thumbs:
+            path = paths.get(key) if key else None
+            cd["icon_path"] = path
+            if key and path is None and len(missing) < self._thumb_prefetch_count:
+                missing.append((cd.get("id"), f"{kind}:{entity_id}:", key, raw_url))
+
+        if not missing:
+            return
+        if self._thumb_prefetch_task is not None and not self._thumb_prefetch_task.done():
+            self._thumb_prefetch_task.cancel()
+        self._thumb_prefetch_task = asyncio.get_running_loop().create_task(
+            self._prefetch_thumbnails(missing), name="whitemax-thumb-prefetch"
+        )
+
+    async def _prefetch_thumbnails(self, jobs: List[Any]) -> None:
+        """Скачать аватары (не более 4 одновременно) и сообщить Swift событием thumbnail_ready."""
+        sem = asyncio.Semaphore(4)
+
+        async def _one(chat_id: Any, entity_prefix: str, key: str, url: str) -> None:
+            async with sem:
+                tmp_dir = os.path.join(self._thumb_cache.root, "tmp")
+                os.makedirs(tmp_dir, exist_ok=True)
+                tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part")
+                try:
+                    session = await self._get_http_session()
+                    async with session.get(url) as resp:
+                        if resp.status != 200:
+                            return
+                        data = await resp.read()
+                    await self._in_io_pool(self._write_file, tmp_path, data)
+                    path = await self._in_io_pool(self._thumb_cache.put_file, key, tmp_path, ".jpg")
+                    # photo_id сменился — старая миниатюра этой сущности больше не нужна.
+                    await self._in_io_pool(self._thumb_cache.discard_other_keys, entity_prefix, key)
+                    self._emit_event({"type": "thumbnail_ready", "chat_id": chat_id, "icon_path": path})
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _dprint(f"Warning: thumbnail prefetch failed for chat {chat_id}: {e}")
+                finally:
+                    if os.path.exists(tmp_path):
+                        try:
+                            os.remove(tmp_path)
+                        except Exception:
+                            pass
+
+        await asyncio.gather(*[_one(*job) for job in jobs], return_exceptions=True)
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def configure_thumbnails(
+        self, prefetch_count: Optional[int] = None, budget_bytes: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Сколько первых чатов подгружать в фоне и бюджет дискового кеша миниатюр (байты)."""
+        try:
+            if prefetch_count is not None:
+                self._thumb_prefetch_count = max(0, int(prefetch_count))
+            if budget_bytes is not None:
+                self._thumb_cache.set_budget(int(budget_bytes))
+            return {
+                "success": True,
+                "prefetch_count": self._thumb_prefetch_count,
+                "thumb_cache": self._thumb_cache.snapshot(),
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def _search_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        """Один поток для всего I/O поискового индекса (SQLite-соединение не делится между потоками)."""
+        if self._search_pool_obj is None:
+            self._search_pool_obj = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="whitemax-search"
+            )
+        return self._search_pool_obj
+
+    def _index_messages(self, messages: List[Dict[str, Any]]) -> None:
+        """Best-effort: добавить/обновить сообщения в поисковом индексе (в фоне, не блокируя loop)."""
+        if not messages:
+            return
+        try:
+            self._search_pool().submit(self._search_index.upsert_many, list(messages))
+        except Exception:
+            pass
+
+    def _unindex_messages(self, chat_id: int, message_ids: List[str]) -> None:
+        try:
+            self._search_pool().submit(self._search_index.delete, chat_id, [str(i) for i in message_ids])
+        except Exception:
+            pass
+
+    def search_messages(
+        self,
+        query: str,
+        chat_id: Optional[int] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Полнотекстовый поиск по локальному индексу сообщений (ранжирование bm25, префиксные слова).
+
+        Индекс пополняется из get_messages и событий message_new/edit/delete и переживает перезапуск.
+        :param cursor: непрозрачный курсор следующей страницы (next_cursor из предыдущего ответа)
+        """
+        if not (query or "").strip():
+            return {"success": False, "error": "query required"}
+        try:
+            offset = max(0, int(cursor)) if cursor else 0
+            limit = max(1, min(500, int(limit)))
+            rows = self._search_pool().submit(
+                self._search_index.search, query, chat_id, limit, offset
+            ).result(timeout=30)
+            return {
+                "success": True,
+                "results": rows,
+                "next_cursor": str(offset + len(rows)) if len(rows) == limit else None,
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_search_index_stats(self) -> Dict[str, Any]:
+        try:
+            stats = self._search_pool().submit(self._search_index.stats).result(timeout=30)
+            return {"success": True, "search_index": stats}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    # --- Background history indexer ---
+
+    _HISTORY_IDLE_GRACE_S = 1.0
+
+    def _load_history_state(self) -> Dict[str, Any]:
+        if self._history_state is None:
+            state: Dict[str, Any] = {}
+            try:
+                with open(self._history_state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f) or {}
+            except Exception:
+                state = {}
+            state.setdefault("chats", {})
+            self._history_state = state
+        return self._history_state
+
+    def _save_history_state(self) -> None:
+        """Атомарно сохранить checkpoints индексатора (tmp + os.replace)."""
+        state = self._history_state
+        if state is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._history_state_path), exist_ok=True)
+            tmp_path = self._history_state_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self._history_state_path)
+        except Exception as e:
+            _dprint(f"⚠️ Failed to save history index state: {e}")
+
+    def _known_chat_ids(self) -> List[int]:
+        ids: List[int] = []
+        seen = set()
+        for src in ("dialogs", "chats", "channels"):
+            for item in getattr(self.client, src, None) or []:
+                cid = getattr(item, "id", None)
+                if cid is None:
+                    cid = getattr(item, "cid", None)
+                if cid is None or cid in seen:
+                    continue
+                seen.add(cid)
+                ids.append(int(cid))
+        return ids
+
+    async def _wait_user_idle(self) -> None:
+        """Уступить пользовательским вызовам: ждать, пока нет активных _run_async + небольшой grace."""
+        while True:
+            if self._active_user_calls <= 0:
+                idle_for = time.monotonic() - self._last_user_call_end
+                if idle_for >= self._HISTORY_IDLE_GRACE_S:
+                    return
+                await asyncio.sleep(self._HISTORY_IDLE_GRACE_S - idle_for)
+            else:
+                await asyncio.sleep(0.2)
+
+    async def _history_index_page(self, chat_id: int, ck: Dict[str, Any], loop: Any) -> None:
+        """Проиндексировать одну страницу истории чата (от ck["before"] назад) и сдвинуть checkpoint."""
+        await self._wait_user_idle()
+        wait = self._history_bucket.reserve(time.monotonic())
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self._ensure_connected_and_session()
+        await self._throttle("fetch")
+        page = await self.client.fetch_history(
+            chat_id=chat_id,
+            from_time=ck.get("before"),
+            forward=0,
+            backward=self._history_page_size,
+        )
+        # Страницы истории pymax приходят без chat_id.
+        msgs = [m for m in (self._message_to_dict(x, fallback_chat_id=chat_id) for x in (page or [])) if m]
+        # Курсор (before, edge_ids): запрос включает границу before, чтобы не потерять сообщения
+        # с тем же миллисекундным time на стыке страниц; уже виденные на границе id отбрасываем.
+        before = ck.get("before")
+        seen = set(ck.get("edge_ids") or [])
+        fresh = [
+            m
+            for m in msgs
+            if not (before is not None and int(m.get("time") or 0) == before and str(m.get("id")) in seen)
+        ]
+        times = [int(m["time"]) for m in fresh if m.get("time")]
+        if fresh:
+            await loop.run_in_executor(self._search_pool(), self._search_index.upsert_many, fresh)
+        oldest = min(times) if times else None
+        if not fresh or oldest is None or (before is not None and oldest > before):
+            ck["done"] = True
+        else:
+            edge = {str(m.get("id")) for m in fresh if m.get("time") and int(m["time"]) == oldest}
+            if oldest == before:
+                edge |= seen
+            ck["before"] = oldest
+            ck["edge_ids"] = sorted(edge)
+            ck["indexed"] = int(ck.get("indexed") or 0) + len(fresh)
+
+    async def _history_indexer(self, chat_ids: List[int]) -> None:
+        state = self._load_history_state()
+        chats_state: Dict[str, Any] = state["chats"]
+        total = len(chat_ids)
+        done_count = sum(1 for cid in chat_ids if (chats_state.get(str(cid)) or {}).get("done"))
+        loop = asyncio.get_running_loop()
+        failed = 0
+        try:
+            for chat_id in chat_ids:
+                ck = chats_state.setdefault(str(chat_id), {"before": None, "indexed": 0, "done": False})
+                try:
+                    while not ck.get("done"):
+                        await self._history_index_page(chat_id, ck, loop)
+                        if ck.get("done"):
+                            done_count += 1
+                        self._save_history_state()
+                        self._emit_event(
+                            {
+                                "type": "history_index_progress",
+                                "chat_id": chat_id,
+                                "indexed": ck.get("indexed", 0),
+                                "chat_done": bool(ck.get("done")),
+                                "chats_done": done_count,
+                                "chats_total": total,
+                            }
                         )
-                        
-                        if is_connection_error:
-                            _dprint(f"⚠️ Connection error detected ({error_type}), attempting to reconnect...")
-                            retry_count += 1
-                            if retry_count < max_retries:
+                except Exception as e:
+                    # Ошибка одного чата не останавливает проход: checkpoint сохранён, чат доиндексируется
+                    # при следующем запуске.
+                    _dprint(f"✗ History indexer failed for chat_id={chat_id}: {e}")
+                    failed += 1
+                    self._save_history_state()
+                    self._emit_event({"type": "history_index_error", "chat_id": chat_id, "error": str(e)})
+            self._emit_event({"type": "history_index_done", "chats_total": total, "chats_failed": failed})
+        except asyncio.CancelledError:
+            self._save_history_state()
+            raise
+        except Exception as e:
+            _dprint(f"✗ History indexer failed: {e}")
+            self._save_history_state()
+            self._emit_event({"type": "history_index_error", "error": str(e)})
+        finally:
+            if self._history_task is asyncio.current_task():
+                self._history_task = None
+
+    def start_history_indexer(
+        self,
+        chat_ids: Optional[List[int]] = None,
+        rate_per_s: Optional[float] = None,
+        page_size: Optional[int] = None,
+        restart: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Запустить фоновую индексацию всей истории (для search_messages).
+
+        Прогресс сохраняется по чатам и продолжается после перезапуска приложения.
+        :param chat_ids: список чатов; по умолчанию — все известные клиенту
+        :param rate_per_s: лимит запросов fetch_history в секунду (собственный, поверх общего limiter)
+        :param restart: сбросить checkpoints и пройти историю заново
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        try:
+            if rate_per_s is not None:
+                self._history_rate_per_s = max(0.05, float(rate_per_s))
+                self._history_bucket = _TokenBucket(self._history_rate_per_s, 1)
+            if page_size is not None:
+                self._history_page_size = max(10, min(200, int(page_size)))
+
+            async def _start():
+                if self._history_task is not None and not self._history_task.done():
+                    return {"success": True, "already_running": True}
+                ids = [int(c) for c in chat_ids] if chat_ids else self._known_chat_ids()
+                if restart:
+                    state = self._load_history_state()
+                    for cid in ids:
+                        state["chats"].pop(str(cid), None)
+                    self._save_history_state()
+                self._history_task = asyncio.create_task(self._history_indexer(ids))
+                return {"success": True, "chats_total": len(ids)}
+
+            return self._run_async(_start())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def stop_history_indexer(self) -> Dict[str, Any]:
+        try:
+            async def _stop():
+                task = self._history_task
+                if task is None or task.done():
+                    return {"success": True, "was_running": False}
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return {"success": True, "was_running": True}
+
+            return self._run_async(_stop())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_history_indexer_status(self) -> Dict[str, Any]:
+        try:
+            chats = dict(self._load_history_state()["chats"])
+            return {
+                "success": True,
+                "running": self._history_task is not None and not self._history_task.done(),
+                "rate_per_s": self._history_rate_per_s,
+                "page_size": self._history_page_size,
+                "chats_done": sum(1 for c in chats.values() if c.get("done")),
+                "chats_seen": len(chats),
+                "messages_indexed": sum(int(c.get("indexed") or 0) for c in chats.values()),
+                "chats": chats,
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    async def _get_messages_async(self, chat_id: int, limit: int = 50) -> Dict[str, Any]:
+        """Последние limit сообщений чата (на loop); общий код get_messages и bootstrap."""
+        # Вспомогательная функция для переподключения и инициализации сессии
+        async def _ensure_connected():
+            """Убедиться, что соединение установлено и сессия инициализирована."""
+            if not self.client.is_connected:
+                _dprint("⚠️ Socket not connected, connecting...")
+                self._message_windows.mark_stale()
+                try:
+                    # Закрываем старое соединение если есть
+                    if hasattr(self.client, '_socket') and self.client._socket:
+                        try:
+                            self.client._socket.close()
+                        except:
+                            pass
+                    self.client.is_connected = False
+
+                    await self.client.connect(self.client.user_agent)
+                    _dprint("✓ Socket connected")
+
+                    # Если есть токен, нужно инициализировать сессию
+                    if self.client._token:
+                        _dprint("⚠️ Token found, initializing session...")
+                        await self.client._sync(self.client.user_agent)
+                        await self.client._post_login_tasks(sync=False)
+                        _dprint("✓ Session initialized")
+                except Exception as conn_error:
+                    _dprint(f"✗ Connection failed: {conn_error}, retrying...")
+                    # Если соединение не удалось, пробуем еще раз
+                    await asyncio.sleep(0.5)
+                    await self.client.connect(self.client.user_agent)
+                    if self.client._token:
+                        await self.client._sync(self.client.user_agent)
+                        await self.client._post_login_tasks(sync=False)
+            elif self.client._token and not self.client.me:
+                # Если подключены, но сессия не инициализирована, инициализируем
+                _dprint("⚠️ Socket connected but session not initialized, initializing...")
+                await self.client._sync(self.client.user_agent)
+                await self.client._post_login_tasks(sync=False)
+                _dprint("✓ Session initialized")
+
+        # Убеждаемся, что Socket подключен и сессия инициализирована
+        with self._span("ensure_connected"):
+            await _ensure_connected()
+        await self._throttle("fetch")
+
+        # fetch_history использует backward для количества сообщений
+        # Обрабатываем ошибки соединения и переподключаемся при необходимости
+        max_retries = 3
+        retry_count = 0
+        messages = None
+        last_error = None
+
+        while retry_count < max_retries:
+            try:
+                # Проверяем соединение перед каждой попыткой
+                if not self.client.is_connected:
+                    _dprint("⚠️ Connection lost before fetch_history, reconnecting...")
+                    await _ensure_connected()
+
+                with self._span("fetch_history", attempt=retry_count + 1):
+                    messages = await self.client.fetch_history(chat_id=chat_id, backward=limit, forward=0)
+                break  # Успешно получили сообщения
+            except Exception as e:
+                last_error = e
+                error_str = str(e)
+                error_type = type(e).__name__
+                _dprint(
+                    f"✗ Error fetching history for chat_id={chat_id} "
+                    f"(attempt {retry_count + 1}/{max_retries}): {error_type}: {e}"
+                )
+
+                # Проверяем, является ли ошибка связанной с соединением
+                # Проверяем по типу исключения (если импортированы) и по строке
+                is_connection_error = (
+                    (PYMAX_AVAILABLE and (isinstance(e, SocketNotConnectedError) or isinstance(e, SocketSendError))) or
+                    isinstance(e, ssl.SSLEOFError) or
+                    isinstance(e, ssl.SSLError) or
+                    isinstance(e, ConnectionError) or
+                    error_type in ["SocketNotConnectedError", "SocketSendError", "SSLEOFError", "SSLError", "ConnectionError"] or
+                    any(keyword in error_str.lower() for keyword in ["not connected", "socket", "eof", "connection", "send and wait failed"])
+                )
+
+                if is_connection_error:
+                    _dprint(f"⚠️ Connection error detected ({error_type}), attempting to reconnect...")
+                    retry_count += 1
+                    self._metrics.retry()
+                    if retry_count < max_retries:
+                        try:
+                            # Закрываем старое соединение
+                            if hasattr(self.client, '_socket') and self.client._socket:
                                 try:
-                                    # Закрываем старое соединение
-                                    if hasattr(self.client, '_socket') and self.client._socket:
-                                        try:
-                                            self.client._socket.close()
-                                        except:
-                                            pass
-                                    self.client.is_connected = False
-                                    
-                                    # Переподключаемся с увеличивающейся задержкой
-                                    await asyncio.sleep(0.5 * retry_count)
-                                    await _ensure_connected()
-                                    
-                                    _dprint("✓ Reconnected successfully, retrying fetch_history...")
-                                    continue  # Пробуем еще раз
-                                except Exception as reconnect_error:
-                                    _dprint(f"✗ Reconnection failed: {reconnect_error}")
-                                    if retry_count >= max_retries:
-                                        if _DEBUG:
-                                            import traceback
-                                            traceback.print_exc()
-                                        return {"success": False, "error": f"Failed to reconnect after {max_retries} attempts: {reconnect_error}"}
-                            else:
-                                # Последняя попытка не удалась
+                                    self.client._socket.close()
+                                except:
+                                    pass
+                            self.client.is_connected = False
+
+                            # Переподключаемся с увеличивающейся задержкой
+                            await asyncio.sleep(0.5 * retry_count)
+                            await _ensure_connected()
+
+                            _dprint("✓ Reconnected successfully, retrying fetch_history...")
+                            continue  # Пробуем еще раз
+                        except Exception as reconnect_error:
+                            _dprint(f"✗ Reconnection failed: {reconnect_error}")
+                            if retry_count >= max_retries:
                                 if _DEBUG:
                                     import traceback
                                     traceback.print_exc()
-                                return {"success": False, "error": f"Failed after {max_retries} reconnection attempts: {e}"}
-                        else:
-                            # Другие ошибки - не повторяем
-                            _dprint(f"✗ Non-connection error, not retrying: {error_type}")
-                            if _DEBUG:
-                                import traceback
-                                traceback.print_exc()
-                            return {"success": False, "error": str(e)}
-                
-                # Если после всех попыток не удалось получить сообщения
-                if messages is None:
-                    error_msg = f"Failed to fetch messages after {max_retries} attempts: {last_error}" if last_error else "Unknown error"
-                    _dprint(f"✗ {error_msg}")
-                    return {"success": False, "error": error_msg}
-                
-                # Проверяем, что сообщения получены
-                if messages is None:
-                    _dprint(f"⚠️ fetch_history returned None for chat_id={chat_id}")
-                    messages = []
-                
-                _dprint(f"📨 Fetched {len(messages) if messages else 0} messages from API for chat_id={chat_id}")
-                
-                # Конвертируем в JSON-совместимый формат и сортируем по времени (старые первыми, новые последними)
-                messages_list = []
-                for msg in (messages or []):
-                    msg_dict = self._message_to_dict(msg, fallback_chat_id=chat_id)
-                    if msg_dict:
-                        messages_list.append(msg_dict)
-                
-                # Сортируем по времени (старые первыми, новые последними)
-                messages_list.sort(key=lambda x: x.get("time", 0) or 0)
+                                return {"success": False, "error": f"Failed to reconnect after {max_retries} attempts: {reconnect_error}"}
+                    else:
+                        # Последняя попытка не удалась
+                        if _DEBUG:
+                            import traceback
+                            traceback.print_exc()
+                        return {"success": False, "error": f"Failed after {max_retries} reconnection attempts: {e}"}
+                else:
+                    # Другие ошибки - не повторяем
+                    _dprint(f"✗ Non-connection error, not retrying: {error_type}")
+                    if _DEBUG:
+                        import traceback
+                        traceback.print_exc()
+                    return {"success": False, "error": str(e)}
+
+        # Если после всех попыток не удалось получить сообщения
+        if messages is None:
+            error_msg = f"Failed to fetch messages after {max_retries} attempts: {last_error}" if last_error else "Unknown error"
+            _dprint(f"✗ {error_msg}")
+            return {"success": False, "error": error_msg}
+
+        # Проверяем, что сообщения получены
+        if messages is None:
+            _dprint(f"⚠️ fetch_history returned None for chat_id={chat_id}")
+            messages = []
+
+        _dprint(f"📨 Fetched {len(messages) if messages else 0} messages from API for chat_id={chat_id}")
+
+        # Конвертируем в JSON-совместимый формат и сортируем по времени (старые первыми, новые последними)
+        records = []
+        with self._span("message_to_dict", count=len(messages or [])):
+            for msg in (messages or []):
+                rec = self._message_record(msg, fallback_chat_id=chat_id)
+                if rec is not None:
+                    records.append(rec)
+
+            # Сортируем по времени (старые первыми, новые последними)
+            records.sort(key=lambda r: r.time or 0)
+            messages_list = [r.to_dict() for r in records]
+        self._index_messages(records)
+        # Последняя страница: отрезок до самого нового сообщения (дальше его продлевают события).
+        self._message_windows.add_run(
+            int(chat_id), records, reached_oldest=len(messages or []) < limit, reached_newest=True
+        )
 
-                return {"success": True, "messages": messages_list}
-            
-            return self._run_async(_get_messages())
+        return {"success": True, "messages": messages_list}
+
+    def get_messages(self, chat_id: int, limit: int = 50) -> Dict[str, Any]:
+        """
+        Получить сообщения из чата.
+        
+        :param chat_id: ID чата
+        :param limit: Максимальное количество сообщений
+        :return: Dict со списком сообщений
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        
+        try:
+            return self._run_async(self._get_messages_async(chat_id, limit))
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def send_message(self, chat_id: int, text: str, reply_to: Optional[Any] = None) -> Dict[str, Any]:
-        """Отправить сообщение в чат."""
+    def get_messages_around(
+        self,
+        chat_id: int,
+        message_id: Any,
+        before: int = 25,
+        after: int = 25,
+    ) -> Dict[str, Any]:
+        """
+        Сообщения вокруг message_id (для перехода к ответу и восстановления прокрутки).
+
+        Отдаётся из окна чата, если там есть непрерывный отрезок нужной длины (source="cache");
+        иначе — fetch_history от времени сообщения (время берётся из окна или поискового индекса).
+        :param before: сколько более старых сообщений (message_id тоже входит в ответ)
+        :param after: сколько более новых
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        try:
+            chat_id = int(chat_id)
+            message_id = str(message_id)
+            before = max(0, int(before))
+            after = max(0, int(after))
+        except Exception:
+            return {"success": False, "error": "Invalid arguments"}
+
+        def _result(found: Dict[str, Any], source: str) -> Dict[str, Any]:
+            return {
+                "success": True,
+                "messages": [r.to_dict() for r in found["records"]],
+                "has_more_before": not found["has_oldest"],
+                "complete": found["complete_before"] and found["complete_after"],
+                "source": source,
+            }
+
+        try:
+            async def _around():
+                windows = self._message_windows
+                found = windows.around(chat_id, message_id, before, after)
+                if found is not None and found["complete_before"] and found["complete_after"]:
+                    windows.stats["hits"] += 1
+                    return _result(found, "cache")
+                windows.stats["misses"] += 1
+
+                win = windows.get(chat_id)
+                rec = win.by_id.get(message_id) if win is not None else None
+                anchor_time = rec.time if rec is not None else None
+                if anchor_time is None:
+                    anchor_time = await asyncio.get_running_loop().run_in_executor(
+                        self._search_pool(), self._search_index.message_time, chat_id, message_id
+                    )
+                if anchor_time is None:
+                    return {"success": False, "error": "Message not found in local cache"}
+
+                await self._ensure_connected_and_session()
+                await self._throttle("fetch")
+                with self._span("fetch_history"):
+                    page = await self.client.fetch_history(
+                        chat_id=chat_id, from_time=anchor_time, forward=after, backward=before + 1
+                    )
+                records = [r for r in (self._message_record(m, fallback_chat_id=chat_id) for m in (page or [])) if r]
+                older = sum(1 for r in records if (r.time or 0) <= anchor_time)
+                self._index_messages(records)
+                windows.add_run(chat_id, records, reached_oldest=older < before + 1, reached_newest=False)
+                found = windows.around(chat_id, message_id, before, after)
+                if found is None:
+                    return {"success": False, "error": "Message not found"}
+                return _result(found, "server")
+
+            return self._run_async(_around())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def configure_message_windows(self, max_messages: Optional[int] = None, clear: bool = False) -> Dict[str, Any]:
+        """Общий бюджет окон сообщений (число сообщений во всех чатах) и/или сброс окон."""
+        try:
+            # Окна обновляют обработчики событий на loop — меняем их там же.
+            async def _configure():
+                self._message_windows.configure(max_messages, bool(clear))
+                return {"success": True, "message_windows": self._message_windows.snapshot()}
+
+            return self._run_async(_configure())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_message_window_stats(self) -> Dict[str, Any]:
+        try:
+            async def _stats():
+                return {"success": True, "message_windows": self._message_windows.snapshot()}
+
+            return self._run_async(_stats())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    # How long a server id of an acknowledged optimistic send stays in the echo-suppression set.
+    _ECHO_SUPPRESS_TTL_S = 120.0
+    # Echo without a send response yet must carry a server time no earlier than the send start (minus skew).
+    _ECHO_MATCH_SKEW_MS = 5000
+
+    @staticmethod
+    def _attach_signature(attachments: Any) -> Tuple[str, ...]:
+        """Типы вложений (отсортированные) — чтобы эхо с фото не совпало с текстовым черновиком и наоборот."""
+        return tuple(sorted(str(a.get("type") or "") for a in attachments or []))
+
+    def _pending_message_dict(
+        self,
+        chat_id: int,
+        text: str,
+        reply_to: Optional[int],
+        attachments: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """Локальный черновик сообщения (temp id, pending=True) в формате _message_to_dict."""
+        temp_id = f"tmp_{uuid.uuid4().hex}"
+        now_ms = int(time.time() * 1000)
+        me = getattr(self.client, "me", None) if self.client is not None else None
+        return {
+            "id": temp_id,
+            "temp_id": temp_id,
+            "chat_id": int(chat_id),
+            "text": text or "",
+            "sender_id": self._get_field(me, "id", default=None),
+            "date": now_ms,
+            "time": now_ms,
+            "type": "USER",
+            "reply_to": str(reply_to) if reply_to is not None else None,
+            "reactions": None,
+            "attachments": attachments if attachments else None,
+            "pending": True,
+        }
+
+    def _start_optimistic_send(self, pending: Dict[str, Any], send_coro: Any) -> Dict[str, Any]:
+        """
+        Запустить отправку в фоне на asyncio loop и сразу вернуть черновик.
+        Результат придёт событием message_ack (temp_id -> настоящий id).
+        """
+        temp_id = pending["temp_id"]
+        entry = {
+            "chat_id": pending["chat_id"],
+            "sender_id": pending["sender_id"],
+            "text": pending["text"],
+            "attach_sig": self._attach_signature(pending.get("attachments")),
+            "created_ms": pending["time"],
+            "echo_id": None,
+        }
+
+        async def _run() -> None:
+            # _pending_sends принадлежит loop thread (его читает _is_optimistic_echo): регистрируем здесь,
+            # до начала отправки — раньше неё эхо прийти не может.
+            self._pending_sends[temp_id] = entry
+            try:
+                result = await send_coro
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+            self._ack_optimistic_send(temp_id, result)
+
+        try:
+            loop = self._ensure_loop_thread()
+            asyncio.run_coroutine_threadsafe(_run(), loop)
+        except Exception as e:
+            try:
+                send_coro.close()
+            except Exception:
+                pass
+            return {"success": False, "error": str(e)}
+        return {"success": True, "pending": True, "temp_id": temp_id, "message": pending}
+
+    def _ack_optimistic_send(self, temp_id: str, result: Dict[str, Any]) -> None:
+        """Сопоставить temp id с серверным id и сообщить Swift (выполняется на loop thread)."""
+        entry = self._pending_sends.pop(temp_id, None) or {}
+        msg_dict = result.get("message") if result.get("success") else None
+        if not msg_dict:
+            self._emit_event(
+                {
+                    "type": "message_ack",
+                    "success": False,
+                    "temp_id": temp_id,
+                    "chat_id": entry.get("chat_id"),
+                    "error": result.get("error") or "Send failed",
+                }
+            )
+            return
+
+        real_id = str(msg_dict.get("id"))
+        self._index_messages([msg_dict])
+        # Echo may still be on its way (or already consumed by _is_optimistic_echo).
+        if entry.get("echo_id") != real_id:
+            self._suppressed_echo_ids[real_id] = time.monotonic() + self._ECHO_SUPPRESS_TTL_S
+        self._emit_event(
+            {
+                "type": "message_ack",
+                "success": True,
+                "temp_id": temp_id,
+                "chat_id": msg_dict.get("chat_id"),
+                "message_id": real_id,
+                "message": msg_dict,
+            }
+        )
+
+    def _is_optimistic_echo(self, msg_dict: Dict[str, Any]) -> bool:
+        """True, если входящее сообщение — эхо нашей optimistic-отправки (его не нужно показывать повторно)."""
+        if not self._pending_sends and not self._suppressed_echo_ids:
+            return False
+
+        now = time.monotonic()
+        for mid, expires in list(self._suppressed_echo_ids.items()):
+            if expires < now:
+                self._suppressed_echo_ids.pop(mid, None)
+
+        msg_id = str(msg_dict.get("id"))
+        if self._suppressed_echo_ids.pop(msg_id, None) is not None:
+            return True
+
+        # Echo arrived before the send response: match by chat/sender/text/attachment types, and the
+        # server time must not predate the send (a same-text message sent earlier from another device).
+        sender_id = msg_dict.get("sender_id")
+        if sender_id is None:
+            return False
+        chat_id = msg_dict.get("chat_id")
+        text = msg_dict.get("text") or ""
+        msg_time = msg_dict.get("time")
+        me = getattr(self.client, "me", None) if self.client is not None else None
+        me_id = self._get_field(me, "id", default=None)
+        sig = None
+        for entry in self._pending_sends.values():
+            if (
+                entry["echo_id"] is None
+                and entry["chat_id"] == chat_id
+                and (entry["sender_id"] if entry["sender_id"] is not None else me_id) == sender_id
+                and entry["text"] == text
+                and (msg_time is None or msg_time >= entry["created_ms"] - self._ECHO_MATCH_SKEW_MS)
+            ):
+                if sig is None:
+                    sig = self._attach_signature(msg_dict.get("attachments"))
+                if entry["attach_sig"] != sig:
+                    continue
+                entry["echo_id"] = msg_id
+                return True
+        return False
+
+    def send_message(
+        self,
+        chat_id: int,
+        text: str,
+        reply_to: Optional[Any] = None,
+        optimistic: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Отправить сообщение в чат.
+
+        :param optimistic: вернуть черновик (temp id, pending=True) сразу, не дожидаясь сервера;
+            подтверждение придёт событием message_ack.
+        """
         if self.client is None:
             return {"success": False, "error": "Client not initialized"}
 
@@ -1252,6 +4461,7 @@ class MaxClientWrapper:
         try:
             async def _send():
                 await self._ensure_connected_and_session()
+                await self._throttle("send")
                 msg = await self.client.send_message(
                     text=text,
                     chat_id=chat_id,
@@ -1263,6 +4473,9 @@ class MaxClientWrapper:
                     return {"success": False, "error": "Invalid message response"}
                 return {"success": True, "message": msg_dict}
 
+            if optimistic:
+                pending = self._pending_message_dict(chat_id, text, reply_to_int)
+                return self._start_optimistic_send(pending, _send())
             return self._run_async(_send())
         except Exception as e:
             return {"success": False, "error": str(e)}
@@ -1279,6 +4492,7 @@ class MaxClientWrapper:
         try:
             async def _edit():
                 await self._ensure_connected_and_session()
+                await self._throttle("edit")
                 msg = await self.client.edit_message(
                     chat_id=chat_id,
                     message_id=message_id_int,
@@ -1305,6 +4519,7 @@ class MaxClientWrapper:
         try:
             async def _delete():
                 await self._ensure_connected_and_session()
+                await self._throttle("delete")
                 ok = await self.client.delete_message(
                     chat_id=chat_id,
                     message_ids=ids,
@@ -1328,6 +4543,7 @@ class MaxClientWrapper:
         try:
             async def _pin():
                 await self._ensure_connected_and_session()
+                await self._throttle("edit")
                 ok = await self.client.pin_message(chat_id=chat_id, message_id=message_id_int, notify_pin=notify_pin)
                 return {"success": True, "pinned": bool(ok), "message_id": str(message_id_int)}
 
@@ -1348,6 +4564,7 @@ class MaxClientWrapper:
         try:
             async def _add():
                 await self._ensure_connected_and_session()
+                await self._throttle("reaction")
                 info = await self.client.add_reaction(chat_id=chat_id, message_id=msg_id_str, reaction=reaction)
                 info_dict = self._reaction_info_to_dict(info)
                 return {"success": True, "reaction_info": info_dict}
@@ -1368,6 +4585,7 @@ class MaxClientWrapper:
         try:
             async def _remove():
                 await self._ensure_connected_and_session()
+                await self._throttle("reaction")
                 info = await self.client.remove_reaction(chat_id=chat_id, message_id=msg_id_str)
                 info_dict = self._reaction_info_to_dict(info)
                 return {"success": True, "reaction_info": info_dict}
@@ -1386,93 +4604,713 @@ class MaxClientWrapper:
             return {"success": False, "error": "File not found"}
 
         try:
-            async def _upload():
-                await self._ensure_connected_and_session()
-                attach = await self.client._upload_attachment(Photo(path=file_path))
-                if not attach:
-                    return {"success": False, "error": "Upload failed"}
-                # attach is a dict, typically contains photoToken
-                photo_token = None
-                if isinstance(attach, dict):
-                    photo_token = attach.get("photoToken") or attach.get("photo_token")
-                return {"success": True, "attach": attach, "photo_token": photo_token}
+            async def _upload():
+                await self._ensure_connected_and_session()
+                attach = await self._upload_path(file_path, "photo")
+                # attach is a dict, typically contains photoToken
+                photo_token = None
+                if isinstance(attach, dict):
+                    photo_token = attach.get("photoToken") or attach.get("photo_token")
+                return {"success": True, "attach": attach, "photo_token": photo_token}
+
+            return self._run_async(_upload())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def upload_file(self, file_path: str) -> Dict[str, Any]:
+        """Загрузить файл и вернуть attach payload (file_id) для последующей отправки."""
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        if File is None:
+            return {"success": False, "error": "pymax File not available"}
+        if not file_path or not os.path.exists(file_path):
+            return {"success": False, "error": "File not found"}
+
+        try:
+            async def _upload():
+                await self._ensure_connected_and_session()
+                attach = await self._upload_path(file_path, "file")
+                file_id = None
+                if isinstance(attach, dict):
+                    file_id = attach.get("fileId") or attach.get("file_id")
+                return {"success": True, "attach": attach, "file_id": file_id}
+
+            return self._run_async(_upload())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def send_attachment(
+        self,
+        chat_id: int,
+        file_path: str,
+        attachment_type: str = "file",
+        text: str = "",
+        reply_to: Optional[Any] = None,
+        notify: bool = True,
+        optimistic: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Отправить вложение (photo/file) в чат без запроса доступов к галерее (Swift передаёт локальный temp path).
+
+        :param optimistic: вернуть черновик сразу (вложение с local_path), подтверждение — событием message_ack.
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        if not file_path or not os.path.exists(file_path):
+            return {"success": False, "error": "File not found"}
+
+        at = (attachment_type or "file").lower().strip()
+        reply_to_int = self._coerce_int(reply_to)
+
+        try:
+            async def _send():
+                await self._ensure_connected_and_session()
+
+                if self._can_send_prepared():
+                    # Загрузка через _upload_path (chunked/resumable для больших файлов) + MSG_SEND.
+                    kind = "photo" if at in ("photo", "image", "img") else "file"
+                    attach = await self._upload_path(file_path, kind)
+                    msg_dict = await self._send_with_attaches(chat_id, text, [attach], reply_to_int, notify)
+                    if not msg_dict:
+                        return {"success": False, "error": "Invalid message response"}
+                    return {"success": True, "message": msg_dict}
+
+                await self._throttle("send")
+                kind = "photo" if at in ("photo", "image", "img") else "file"
+                try:
+                    attachment_obj = await self._in_io_pool(self._make_attachment_obj, file_path, kind)
+                except RuntimeError as e:
+                    return {"success": False, "error": str(e)}
+
+                msg = await self.client.send_message(
+                    text=text or "",
+                    chat_id=chat_id,
+                    notify=notify,
+                    attachment=attachment_obj,
+                    reply_to=reply_to_int,
+                )
+                msg_dict = self._message_to_dict(msg, fallback_chat_id=chat_id)
+                if not msg_dict:
+                    return {"success": False, "error": "Invalid message response"}
+                return {"success": True, "message": msg_dict}
+
+            if optimistic:
+                is_photo = at in ("photo", "image", "img")
+                pending_attach = {
+                    "id": 0,
+                    "type": "PHOTO" if is_photo else "FILE",
+                    "url": None,
+                    "thumbnail_url": None,
+                    "file_name": os.path.basename(file_path),
+                    "file_size": os.path.getsize(file_path),
+                    "local_path": file_path,
+                }
+                pending = self._pending_message_dict(chat_id, text, reply_to_int, [pending_attach])
+                return self._start_optimistic_send(pending, _send())
+            return self._run_async(_send())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    @staticmethod
+    def _attachment_kind(file_path: str, attachment_type: Optional[str] = None) -> str:
+        """'photo' или 'file': явный тип от Swift, иначе по MIME-типу расширения."""
+        at = (attachment_type or "auto").lower().strip()
+        if at in ("photo", "image", "img"):
+            return "photo"
+        if at != "auto":
+            return "file"
+        mime, _ = mimetypes.guess_type(file_path)
+        return "photo" if mime and mime.startswith("image/") else "file"
+
+    def _can_send_prepared(self) -> bool:
+        """Можно ли отправлять заранее загруженные вложения собственным MSG_SEND."""
+        return Opcode is not None and hasattr(self.client, "_send_and_wait")
+
+    def _emit_upload_progress(
+        self,
+        upload_id: str,
+        file_path: str,
+        bytes_sent: int,
+        total_bytes: int,
+        started: float,
+        session_bytes: int,
+        done: bool = False,
+    ) -> None:
+        elapsed = max(1e-6, time.monotonic() - started)
+        self._emit_event(
+            {
+                "type": "upload_progress",
+                "upload_id": upload_id,
+                "file_name": os.path.basename(file_path),
+                "bytes_sent": int(bytes_sent),
+                "total_bytes": int(total_bytes),
+                "rate_bps": int(session_bytes / elapsed),
+                "done": done,
+            }
+        )
+
+    def _upload_checkpoint_path(self, upload_id: str) -> str:
+        return os.path.join(self.work_dir, "uploads", f"{upload_id}.json")
+
+    def _load_upload_checkpoint(self, upload_id: str, size: int, mtime_ns: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._upload_checkpoint_path(upload_id), "r", encoding="utf-8") as f:
+                ckpt = json.load(f)
+        except Exception:
+            return None
+        if (
+            ckpt.get("size") != size
+            or ckpt.get("mtime_ns") != mtime_ns
+            or not ckpt.get("url")
+            or time.time() - float(ckpt.get("created", 0)) > self._upload_checkpoint_ttl_s
+        ):
+            self._drop_upload_checkpoint(upload_id)
+            return None
+        return ckpt
+
+    def _save_upload_checkpoint(self, upload_id: str, ckpt: Dict[str, Any]) -> None:
+        """Атомарно сохранить checkpoint загрузки (как и события: tmp + os.replace)."""
+        try:
+            path = self._upload_checkpoint_path(upload_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(ckpt, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            pass
+
+    def _drop_upload_checkpoint(self, upload_id: str) -> None:
+        try:
+            os.remove(self._upload_checkpoint_path(upload_id))
+        except Exception:
+            pass
+
+    async def _upload_file_chunked(self, file_path: str, upload_id: str, st: os.stat_result) -> Dict[str, Any]:
+        """
+        Загрузить FILE по частям (Content-Range), как делает pymax, но кусками по _upload_chunk_size.
+        После каждого подтверждённого куска пишем checkpoint в work_dir/uploads, поэтому повторный вызов
+        (например, после переподключения) продолжает с последнего подтверждённого offset.
+        Куски отдаются в сеть срезами memory-mapped файла (без копии в памяти); если mmap недоступен —
+        читаем кусок в пуле потоков.
+        """
+        aiohttp = _load_aiohttp()
+        size = int(st.st_size)
+
+        # Файлы checkpoint читаются/пишутся в пуле I/O, не на loop.
+        ckpt = await self._in_io_pool(self._load_upload_checkpoint, upload_id, size, st.st_mtime_ns)
+        if ckpt is None:
+            await self._throttle("upload")
+            data = await self.client._send_and_wait(opcode=Opcode.FILE_UPLOAD, payload={"count": 1})
+            resp = self._get_field(data, "payload", default=None) or {}
+            info = (resp.get("info") or [None])[0] if isinstance(resp, dict) else None
+            url = self._get_field(info, "url", default=None)
+            file_id = self._get_field(info, "fileId", "file_id", default=None)
+            if not url or file_id is None:
+                raise RuntimeError("Upload failed: no upload url")
+            ckpt = {
+                "url": url,
+                "file_id": int(file_id),
+                "size": size,
+                "mtime_ns": st.st_mtime_ns,
+                "acked": 0,
+                "created": time.time(),
+            }
+            await self._in_io_pool(self._save_upload_checkpoint, upload_id, dict(ckpt))
+
+        file_id = int(ckpt["file_id"])
+        offset = int(ckpt.get("acked", 0))
+        started = time.monotonic()
+
+        # pymax резолвит этот future, когда сервер закончит обработку файла (NOTIF_ATTACH).
+        waiter: Optional[asyncio.Future] = None
+        waiters = getattr(self.client, "_file_upload_waiters", None)
+        if isinstance(waiters, dict):
+            waiter = asyncio.get_running_loop().create_future()
+            waiters[file_id] = waiter
+
+        try:
+            mm: Optional[mmap.mmap] = None
+            view: Optional[memoryview] = None
+            try:
+                with open(file_path, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mm)
+            except (OSError, ValueError):
+                mm = None
 
-            return self._run_async(_upload())
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+            try:
+                await self._post_file_chunks(
+                    aiohttp, file_path, upload_id, ckpt, view, offset, size, started
+                )
+            finally:
+                if view is not None:
+                    try:
+                        view.release()
+                    except Exception:
+                        pass
+                if mm is not None:
+                    try:
+                        mm.close()
+                    except Exception:
+                        pass
 
-    def upload_file(self, file_path: str) -> Dict[str, Any]:
-        """Загрузить файл и вернуть attach payload (file_id) для последующей отправки."""
-        if self.client is None:
-            return {"success": False, "error": "Client not initialized"}
+            if waiter is not None:
+                try:
+                    await asyncio.wait_for(waiter, timeout=60)
+                except Exception as e:
+                    _dprint(f"Warning: file {file_id} processing wait failed: {e}")
+        finally:
+            # Ошибка/отмена куска тоже не должна оставлять future в client._file_upload_waiters.
+            if waiter is not None and waiters.get(file_id) is waiter:
+                waiters.pop(file_id, None)
+        await self._in_io_pool(self._drop_upload_checkpoint, upload_id)
+        return {"_type": "FILE", "fileId": file_id}
+
+    async def _post_file_chunks(
+        self,
+        aiohttp: Any,
+        file_path: str,
+        upload_id: str,
+        ckpt: Dict[str, Any],
+        view: Optional[memoryview],
+        offset: int,
+        size: int,
+        started: float,
+    ) -> None:
+        file_name = os.path.basename(file_path)
+        session_bytes = 0
+        async with aiohttp.ClientSession() as session:
+            while offset < size:
+                end = min(size, offset + self._upload_chunk_size) - 1
+                if view is not None:
+                    chunk: Any = view[offset : end + 1]
+                else:
+                    chunk = await self._in_io_pool(self._read_file_range, file_path, offset, end - offset + 1)
+                headers = {
+                    "Content-Disposition": f"attachment; filename={file_name}",
+                    "Content-Range": f"{offset}-{end}/{size}",
+                    "Content-Length": str(len(chunk)),
+                    "Connection": "keep-alive",
+                }
+                last_err: Optional[Exception] = None
+                for attempt in range(self._upload_chunk_retries + 1):
+                    try:
+                        async with session.post(url=ckpt["url"], headers=headers, data=chunk) as response:
+                            if response.status not in (200, 201, 206):
+                                raise RuntimeError(f"Upload chunk failed: HTTP {response.status}")
+                        last_err = None
+                        break
+                    except Exception as e:
+                        last_err = e
+                        _dprint(f"✗ Upload chunk {offset}-{end} failed (attempt {attempt + 1}): {e}")
+                        self._metrics.retry()
+                        await asyncio.sleep(0.5 * (attempt + 1))
+                if last_err is not None:
+                    # Checkpoint остаётся: следующий вызов продолжит с offset.
+                    raise last_err
+
+                offset = end + 1
+                session_bytes += len(chunk)
+                ckpt["acked"] = offset
+                # Ждём запись (не блокируя loop): так записи checkpoint не обгоняют друг друга.
+                await self._in_io_pool(self._save_upload_checkpoint, upload_id, dict(ckpt))
+                self._emit_upload_progress(
+                    upload_id, file_path, offset, size, started, session_bytes, done=offset >= size
+                )
+                if isinstance(chunk, memoryview):
+                    chunk.release()
+
+    def _io_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """Пул потоков для файлового I/O (подготовка загрузок, запись скачиваний, хеширование) вне asyncio loop."""
+        if self._io_pool is None:
+            self._io_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="whitemax-io"
+            )
+        return self._io_pool
+
+    async def _in_io_pool(self, fn: Any, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor(), fn, *args)
+
+    def _prepare_upload(self, file_path: str, kind: str) -> Dict[str, Any]:
+        """Выполняется в пуле: stat, id для resume, SHA-256 для дедупа."""
+        st = os.stat(file_path)
+        upload_id = hashlib.sha1(
+            f"{os.path.abspath(file_path)}|{st.st_size}|{st.st_mtime_ns}|{kind}".encode("utf-8")
+        ).hexdigest()
+        dedup_key = None
+        if self._upload_cache.enabled:
+            dedup_key = _UploadDedupCache.file_key(file_path, kind)
+            self._upload_cache.ensure_loaded()
+        return {"stat": st, "upload_id": upload_id, "dedup_key": dedup_key}
+
+    @staticmethod
+    def _make_attachment_obj(file_path: str, kind: str) -> Any:
+        """Выполняется в пуле: pymax Photo/File читают файл целиком при создании."""
+        if kind == "photo":
+            if Photo is None:
+                raise RuntimeError("pymax Photo not available")
+            return Photo(path=file_path)
         if File is None:
-            return {"success": False, "error": "pymax File not available"}
-        if not file_path or not os.path.exists(file_path):
-            return {"success": False, "error": "File not found"}
+            raise RuntimeError("pymax File not available")
+        return File(path=file_path)
 
-        try:
-            async def _upload():
-                await self._ensure_connected_and_session()
-                attach = await self.client._upload_attachment(File(path=file_path))
-                if not attach:
-                    return {"success": False, "error": "Upload failed"}
-                file_id = None
-                if isinstance(attach, dict):
-                    file_id = attach.get("fileId") or attach.get("file_id")
-                return {"success": True, "attach": attach, "file_id": file_id}
+    @staticmethod
+    def _read_file_range(file_path: str, offset: int, length: int) -> bytes:
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
 
-            return self._run_async(_upload())
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    async def _upload_path(self, file_path: str, kind: str) -> Dict[str, Any]:
+        """
+        Загрузить локальный файл и вернуть attach payload.
+        Большие FILE — по частям с возобновлением (_upload_file_chunked), остальное — client._upload_attachment.
+        """
+        prep = await self._in_io_pool(self._prepare_upload, file_path, kind)
+        st = prep["stat"]
+        upload_id = prep["upload_id"]
+
+        # Тот же контент уже загружался и токен ещё жив — не загружаем повторно.
+        dedup_key: Optional[str] = prep["dedup_key"]
+        if dedup_key is not None:
+            cached = self._upload_cache.get(dedup_key)
+            if cached is not None:
+                self._emit_upload_progress(
+                    upload_id, file_path, st.st_size, st.st_size, time.monotonic(), 0, done=True
+                )
+                return cached
 
-    def send_attachment(
+        attach = await self._upload_path_uncached(file_path, kind, st, upload_id)
+        if dedup_key is not None:
+            self._upload_cache.put(dedup_key, kind, attach)
+        return attach
+
+    async def _upload_path_uncached(
+        self, file_path: str, kind: str, st: os.stat_result, upload_id: str
+    ) -> Dict[str, Any]:
+        if (
+            kind == "file"
+            and st.st_size > self._upload_chunk_size
+            and self._can_send_prepared()
+            and _load_aiohttp() is not None
+        ):
+            return await self._upload_file_chunked(file_path, upload_id, st)
+
+        started = time.monotonic()
+        attachment_obj = await self._in_io_pool(self._make_attachment_obj, file_path, kind)
+        await self._throttle("upload")
+        attach = await self.client._upload_attachment(attachment_obj)
+        if not attach:
+            raise RuntimeError("Upload failed")
+        if not isinstance(attach, dict) and hasattr(attach, "model_dump"):
+            # pydantic Attach -> wire-format dict (нужно для MSG_SEND и дедуп-кеша)
+            attach = attach.model_dump(by_alias=True)
+        self._emit_upload_progress(
+            upload_id, file_path, st.st_size, st.st_size, started, st.st_size, done=True
+        )
+        return attach
+
+    async def _send_with_attaches(
         self,
         chat_id: int,
-        file_path: str,
-        attachment_type: str = "file",
+        text: str,
+        attaches: List[Dict[str, Any]],
+        reply_to: Optional[int],
+        notify: bool,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Отправить сообщение с уже загруженными вложениями (attach payload'ы из _upload_attachment).
+        pymax.send_message сам загружает файлы по одному, поэтому здесь собираем MSG_SEND вручную.
+        """
+        if Opcode is None or not hasattr(self.client, "_send_and_wait"):
+            raise RuntimeError("pymax MSG_SEND not available")
+        message: Dict[str, Any] = {
+            "text": text or "",
+            "cid": int(time.time() * 1000),
+            "elements": [],
+            "attaches": attaches,
+        }
+        if reply_to is not None:
+            message["link"] = {"type": "REPLY", "messageId": reply_to}
+        payload = {"chatId": chat_id, "message": message, "notify": notify}
+
+        await self._throttle("send")
+        data = await self.client._send_and_wait(opcode=Opcode.MSG_SEND, payload=payload)
+        resp = self._get_field(data, "payload", default=None) or {}
+        if isinstance(resp, dict) and resp.get("error"):
+            # Токен мог протухнуть раньше TTL дедуп-кеша: в следующий раз загрузим заново.
+            self._upload_cache.invalidate(attaches)
+            raise RuntimeError(resp.get("localizedMessage") or resp.get("message") or resp.get("error"))
+        raw_msg = resp.get("message", resp) if isinstance(resp, dict) else resp
+        msg: Any = raw_msg
+        if isinstance(raw_msg, dict) and Message is not None and hasattr(Message, "from_dict"):
+            try:
+                msg = Message.from_dict(raw_msg)
+            except Exception:
+                msg = raw_msg
+        return self._message_to_dict(msg, fallback_chat_id=chat_id)
+
+    def send_attachments(
+        self,
+        chat_id: int,
+        file_paths: Any,
+        attachment_type: str = "auto",
         text: str = "",
         reply_to: Optional[Any] = None,
         notify: bool = True,
+        max_parallel: int = 3,
+        on_partial_failure: str = "send",
     ) -> Dict[str, Any]:
-        """Отправить вложение (photo/file) в чат без запроса доступов к галерее (Swift передаёт локальный temp path)."""
+        """
+        Отправить несколько вложений одним сообщением (альбомом).
+
+        Файлы загружаются параллельно (не более max_parallel одновременно), затем уходит одно сообщение.
+        Частичный отказ: on_partial_failure="send" — отправить то, что загрузилось (partial=True);
+        "abort" — ничего не отправлять. Если не загрузилось ничего, сообщение не отправляется.
+        В results — результат по каждому файлу в исходном порядке.
+        """
         if self.client is None:
             return {"success": False, "error": "Client not initialized"}
-        if not file_path or not os.path.exists(file_path):
-            return {"success": False, "error": "File not found"}
+        try:
+            paths = json.loads(file_paths) if isinstance(file_paths, str) else list(file_paths or [])
+        except Exception:
+            return {"success": False, "error": "Invalid file_paths"}
+        paths = [str(p) for p in paths if p]
+        if not paths:
+            return {"success": False, "error": "file_paths required"}
+        policy = (on_partial_failure or "send").lower().strip()
+        if policy not in ("send", "abort"):
+            return {"success": False, "error": "on_partial_failure must be 'send' or 'abort'"}
 
-        at = (attachment_type or "file").lower().strip()
         reply_to_int = self._coerce_int(reply_to)
 
         try:
             async def _send():
                 await self._ensure_connected_and_session()
+                sem = asyncio.Semaphore(max(1, int(max_parallel)))
+
+                async def _one(index: int, path: str) -> Dict[str, Any]:
+                    # mimetypes при первом вызове читает системные таблицы — не на loop thread.
+                    kind = await self._in_io_pool(self._attachment_kind, path, attachment_type)
+                    res: Dict[str, Any] = {"index": index, "path": path, "type": kind.upper()}
+                    if not os.path.exists(path):
+                        res.update(success=False, error="File not found")
+                        return res
+                    async with sem:
+                        try:
+                            res["attach"] = await self._upload_path(path, kind)
+                            res["success"] = True
+                        except Exception as e:
+                            res.update(success=False, error=str(e))
+                    return res
 
-                attachment_obj = None
-                if at in ("photo", "image", "img"):
-                    if Photo is None:
-                        return {"success": False, "error": "pymax Photo not available"}
-                    attachment_obj = Photo(path=file_path)
-                else:
-                    if File is None:
-                        return {"success": False, "error": "pymax File not available"}
-                    attachment_obj = File(path=file_path)
+                results = await asyncio.gather(*[_one(i, p) for i, p in enumerate(paths)])
+                uploaded = [r for r in results if r.get("success")]
+                failed = len(results) - len(uploaded)
+                public_results = [{k: v for k, v in r.items() if k != "attach"} for r in results]
 
-                msg = await self.client.send_message(
-                    text=text or "",
-                    chat_id=chat_id,
-                    notify=notify,
-                    attachment=attachment_obj,
-                    reply_to=reply_to_int,
+                if not uploaded:
+                    return {"success": False, "error": "All uploads failed", "results": public_results}
+                if failed and policy == "abort":
+                    return {
+                        "success": False,
+                        "error": f"{failed} of {len(results)} uploads failed",
+                        "results": public_results,
+                    }
+
+                msg_dict = await self._send_with_attaches(
+                    chat_id, text, [r["attach"] for r in uploaded], reply_to_int, notify
                 )
-                msg_dict = self._message_to_dict(msg, fallback_chat_id=chat_id)
                 if not msg_dict:
-                    return {"success": False, "error": "Invalid message response"}
-                return {"success": True, "message": msg_dict}
+                    return {"success": False, "error": "Invalid message response", "results": public_results}
+                return {
+                    "success": True,
+                    "partial": failed > 0,
+                    "failed": failed,
+                    "message": msg_dict,
+                    "results": public_results,
+                }
 
             return self._run_async(_send())
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    async def _get_http_session(self) -> Any:
+        """Общий aiohttp.ClientSession (пул соединений) для скачиваний; живёт на loop thread."""
+        aiohttp = _load_aiohttp()
+        if aiohttp is None:
+            raise RuntimeError("aiohttp not available")
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=max(1, self._download_connections))
+            )
+        return self._http_session
+
+    async def _resolve_attachment_url(
+        self, chat_id: int, message_id: int, attach_id: int, a_type: str
+    ) -> Optional[str]:
+        info = self._attach_index.get((chat_id, str(message_id), attach_id)) or {}
+        if a_type == "PHOTO":
+            return info.get("url")
+        await self._ensure_connected_and_session()
+        await self._throttle("fetch")
+        if a_type == "FILE":
+            req = await self.client.get_file_by_id(chat_id=chat_id, message_id=message_id, file_id=attach_id)
+        elif a_type == "VIDEO":
+            req = await self.client.get_video_by_id(chat_id=chat_id, message_id=message_id, video_id=attach_id)
+        else:
+            return None
+        return self._get_field(req, "url", default=None)
+
+    @staticmethod
+    def _pwrite_at(fd: int, data: bytes, offset: int) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    async def _download_to_file(self, url: str, tmp_path: str) -> int:
+        """
+        Скачать url в tmp_path. Если сервер поддерживает Range — параллельными range-запросами
+        (не более _download_connections), иначе одним потоком. Запись на диск — в пуле потоков.
+        """
+        session = await self._get_http_session()
+        total: Optional[int] = None
+        async with session.get(url, headers={"Range": "bytes=0-0"}) as resp:
+            if resp.status == 206:
+                tail = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+                total = int(tail) if tail.isdigit() else None
+            elif resp.status == 200:
+                # Range не поддерживается: сервер уже отдаёт весь файл — дочитываем этот ответ.
+                fd = await self._in_io_pool(os.open, tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                pos = 0
+                try:
+                    async for data in resp.content.iter_chunked(256 * 1024):
+                        await self._in_io_pool(self._pwrite_at, fd, data, pos)
+                        pos += len(data)
+                finally:
+                    await self._in_io_pool(os.close, fd)
+                return pos
+            else:
+                raise RuntimeError(f"Download failed: HTTP {resp.status}")
+
+        if total is None:
+            raise RuntimeError("Download failed: unknown content length")
+
+        fd = await self._in_io_pool(os.open, tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            await self._in_io_pool(os.ftruncate, fd, total)
+            part = max(self._download_part_size, -(-total // max(1, self._download_connections)))
+            sem = asyncio.Semaphore(max(1, self._download_connections))
+
+            async def _fetch(start: int, end: int) -> None:
+                async with sem:
+                    async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as r:
+                        if r.status != 206:
+                            raise RuntimeError(f"Range request failed: HTTP {r.status}")
+                        pos = start
+                        async for data in r.content.iter_chunked(256 * 1024):
+                            await self._in_io_pool(self._pwrite_at, fd, data, pos)
+                            pos += len(data)
+                        if pos != end + 1:
+                            raise RuntimeError(f"Short range read {start}-{end}: got {pos - start} bytes")
+
+            await asyncio.gather(*[_fetch(a, min(a + part, total) - 1) for a in range(0, total, part)])
+        finally:
+            await self._in_io_pool(os.close, fd)
+        return total
+
+    async def _download_attachment(self, chat_id: int, message_id: int, attach_id: int, a_type: str) -> str:
+        key = f"{a_type}:{attach_id}"
+        file_name = (self._attach_index.get((chat_id, str(message_id), attach_id)) or {}).get("file_name")
+        ext = os.path.splitext(file_name)[1] if file_name else {"PHOTO": ".jpg", "VIDEO": ".mp4"}.get(a_type, "")
+        cached = await self._in_io_pool(self._media_cache.get, key)
+        if cached:
+            return cached
+
+        url = await self._resolve_attachment_url(chat_id, message_id, attach_id, a_type)
+        if not url:
+            raise RuntimeError("Attachment url not available")
+        tmp_dir = os.path.join(self._media_cache.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part")
+        try:
+            await self._download_to_file(url, tmp_path)
+            return await self._in_io_pool(self._media_cache.put_file, key, tmp_path, ext)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+            raise
+
+    def download_attachment(
+        self,
+        chat_id: int,
+        message_id: Any,
+        attach_id: Any,
+        attachment_type: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Скачать вложение (PHOTO/FILE/VIDEO) в локальный дисковый кеш и вернуть путь к файлу.
+
+        Тип берётся из последних сообщений, прошедших через wrapper; для неизвестных — из attachment_type.
+        Одновременные запросы одного вложения объединяются в одно скачивание.
+        """
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        msg_int = self._coerce_int(message_id)
+        att_int = self._coerce_int(attach_id)
+        if msg_int is None or att_int is None:
+            return {"success": False, "error": "Invalid message_id/attach_id"}
+
+        try:
+            async def _download():
+                # _attach_index — loop-only LRU: читаем его здесь, а не в Swift-потоке.
+                info = self._attach_index.get((int(chat_id), str(msg_int), att_int)) or {}
+                a_type = str(attachment_type or info.get("type") or "").upper()
+                if a_type not in ("PHOTO", "FILE", "VIDEO"):
+                    return {"success": False, "error": "Unknown attachment; pass attachment_type"}
+                key = f"{a_type}:{att_int}"
+                fut = self._downloads_inflight.get(key)
+                if fut is None:
+                    fut = asyncio.ensure_future(self._download_attachment(int(chat_id), msg_int, att_int, a_type))
+                    self._downloads_inflight[key] = fut
+                    fut.add_done_callback(lambda _f: self._downloads_inflight.pop(key, None))
+                path = await asyncio.shield(fut)
+                return {
+                    "success": True,
+                    "path": path,
+                    "type": a_type,
+                    "size": os.path.getsize(path),
+                    "file_name": info.get("file_name"),
+                }
+
+            return self._run_async(_download(), timeout=600)
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def configure_media_cache(
+        self, budget_bytes: Optional[int] = None, connections: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Задать бюджет дискового кеша медиа (байты) и число параллельных соединений на скачивание."""
+        try:
+            if budget_bytes is not None:
+                self._media_cache.set_budget(int(budget_bytes))
+            if connections is not None:
+                self._download_connections = max(1, int(connections))
+            return self.get_media_cache_stats()
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_media_cache_stats(self) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "media_cache": self._media_cache.snapshot(),
+            "connections": self._download_connections,
+        }
+
     def change_profile(
         self,
         first_name: str,
@@ -1497,6 +5335,7 @@ class MaxClientWrapper:
         try:
             async def _change():
                 await self._ensure_connected_and_session()
+                await self._throttle("edit")
                 ok = await self.client.change_profile(
                     first_name=first_name,
                     last_name=last_name,
@@ -1525,27 +5364,32 @@ class MaxClientWrapper:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    async def _get_folders_async(self, folder_sync: int = 0) -> Dict[str, Any]:
+        await self._ensure_connected_and_session()
+        await self._throttle("fetch")
+        fl = await self.client.get_folders(folder_sync=folder_sync)
+        # best-effort serialization
+        folders = []
+        for f in getattr(fl, "folders", []) or []:
+            folders.append(
+                {
+                    "id": self._get_field(f, "id", default=None),
+                    "title": self._get_field(f, "title", default="") or "",
+                    "include": self._get_field(f, "include", default=[]) or [],
+                }
+            )
+        folder_ids = [f["id"] for f in folders]
+        if folder_ids != self._folder_ids:
+            self._folder_ids = folder_ids
+            self._save_session_snapshot()
+        return {"success": True, "folders": folders}
+
     def get_folders(self, folder_sync: int = 0) -> Dict[str, Any]:
         """Получить папки (folders) пользователя."""
         if self.client is None:
             return {"success": False, "error": "Client not initialized"}
         try:
-            async def _get():
-                await self._ensure_connected_and_session()
-                fl = await self.client.get_folders(folder_sync=folder_sync)
-                # best-effort serialization
-                folders = []
-                for f in getattr(fl, "folders", []) or []:
-                    folders.append(
-                        {
-                            "id": self._get_field(f, "id", default=None),
-                            "title": self._get_field(f, "title", default="") or "",
-                            "include": self._get_field(f, "include", default=[]) or [],
-                        }
-                    )
-                return {"success": True, "folders": folders}
-
-            return self._run_async(_get())
+            return self._run_async(self._get_folders_async(folder_sync))
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -1556,6 +5400,7 @@ class MaxClientWrapper:
         try:
             async def _fetch():
                 await self._ensure_connected_and_session()
+                await self._throttle("fetch")
                 chats = await self.client.fetch_chats(marker=marker)
                 out = []
                 for chat in chats or []:
@@ -1573,6 +5418,97 @@ class MaxClientWrapper:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    async def _cached_lookup(self, kind: str, key: str, fetch, supersede: bool = True) -> Dict[str, Any]:
+        """
+        Выполнить lookup через кеш: попадание (в т.ч. "не найдено") отдаётся без сервера,
+        одинаковые запросы в полёте объединяются, а при supersede новый запрос того же kind
+        отменяет предыдущий незавершённый (набор в поиске: старый ответ уже не нужен).
+        """
+        cache_key = f"{kind}:{key}"
+        hit = self._lookup_cache.get(cache_key)
+        if hit is not None:
+            return dict(hit, cached=True)
+
+        task = self._lookup_inflight.get(cache_key)
+        if task is not None:
+            self._lookup_cache.stats["coalesced"] += 1
+        else:
+            if supersede:
+                prev_key = self._lookup_latest.get(kind)
+                prev_task = self._lookup_inflight.get(prev_key) if prev_key else None
+                if prev_task is not None and not prev_task.done():
+                    prev_task.cancel()
+                    self._lookup_cache.stats["cancelled"] += 1
+                self._lookup_latest[kind] = cache_key
+            task = asyncio.create_task(self._run_lookup(kind, cache_key, fetch, supersede))
+            self._lookup_inflight[cache_key] = task
+        try:
+            return dict(await asyncio.shield(task))
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return {"success": False, "error": "Lookup superseded by a newer query", "cancelled": True}
+            raise
+
+    async def _run_lookup(self, kind: str, cache_key: str, fetch, debounce: bool) -> Dict[str, Any]:
+        try:
+            if debounce and self._lookup_debounce_s > 0:
+                # Пока ждём, более новый запрос может отменить этот — тогда сервер не трогаем вовсе.
+                await asyncio.sleep(self._lookup_debounce_s)
+            try:
+                result = await fetch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+            self._lookup_cache.put(cache_key, kind, result)
+            return result
+        finally:
+            if self._lookup_inflight.get(cache_key) is asyncio.current_task():
+                del self._lookup_inflight[cache_key]
+
+    def configure_lookup_cache(
+        self,
+        max_entries: Optional[int] = None,
+        ttl_s: Optional[float] = None,
+        negative_ttl_s: Optional[float] = None,
+        debounce_ms: Optional[int] = None,
+        clear: bool = False,
+    ) -> Dict[str, Any]:
+        """Настроить кеш lookup-запросов. ttl_s применяется к phone/channel, negative_ttl_s — ко всем kind."""
+        try:
+            # _lookup_cache принадлежит loop thread — меняем его там же.
+            async def _configure():
+                if max_entries is not None:
+                    self._lookup_cache.max_entries = max(16, int(max_entries))
+                for kind, (ttl_ok, ttl_neg) in list(self._lookup_cache.ttls.items()):
+                    if ttl_s is not None and kind != "join":
+                        ttl_ok = max(0.0, float(ttl_s))
+                    if negative_ttl_s is not None:
+                        ttl_neg = max(0.0, float(negative_ttl_s))
+                    self._lookup_cache.ttls[kind] = (ttl_ok, ttl_neg)
+                if debounce_ms is not None:
+                    self._lookup_debounce_s = max(0, int(debounce_ms)) / 1000.0
+                if clear:
+                    self._lookup_cache.clear()
+                return self._lookup_cache_report()
+
+            return self._run_async(_configure())
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_lookup_cache_stats(self) -> Dict[str, Any]:
+        return self._lookup_cache_report()
+
+    def _lookup_cache_report(self) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "lookup_cache": dict(
+                self._lookup_cache.snapshot(),
+                inflight=len(self._lookup_inflight),
+                debounce_ms=int(self._lookup_debounce_s * 1000),
+            ),
+        }
+
     def search_by_phone(self, phone: str) -> Dict[str, Any]:
         """Поиск пользователя по номеру телефона."""
         if self.client is None:
@@ -1580,10 +5516,17 @@ class MaxClientWrapper:
         if not phone:
             return {"success": False, "error": "phone required"}
 
+        key = "".join(ch for ch in phone if ch.isdigit())
+        if not key:
+            return {"success": False, "error": "phone required"}
+
         try:
             async def _search():
                 await self._ensure_connected_and_session()
+                await self._throttle("lookup")
                 user = await self.client.search_by_phone(phone)
+                if user is None:
+                    return {"success": False, "error": "User not found"}
                 names = self._get_field(user, "names", default=None)
                 display = None
                 if names and isinstance(names, list) and len(names) > 0:
@@ -1602,7 +5545,7 @@ class MaxClientWrapper:
                     },
                 }
 
-            return self._run_async(_search())
+            return self._run_async(self._cached_lookup("phone", key, _search))
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -1619,6 +5562,7 @@ class MaxClientWrapper:
         try:
             async def _resolve():
                 await self._ensure_connected_and_session()
+                await self._throttle("lookup")
                 ch = await self.client.resolve_channel_by_name(n)
                 if ch is None:
                     return {"success": False, "error": "Channel not found"}
@@ -1631,7 +5575,7 @@ class MaxClientWrapper:
                     },
                 }
 
-            return self._run_async(_resolve())
+            return self._run_async(self._cached_lookup("channel", n.casefold(), _resolve))
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -1648,6 +5592,7 @@ class MaxClientWrapper:
         try:
             async def _create():
                 await self._ensure_connected_and_session()
+                await self._throttle("folder")
                 upd = await self.client.create_folder(title=title, chat_include=include, filters=None)
                 folder = getattr(upd, "folder", None)
                 return {
@@ -1676,6 +5621,7 @@ class MaxClientWrapper:
         try:
             async def _update():
                 await self._ensure_connected_and_session()
+                await self._throttle("folder")
                 upd = await self.client.update_folder(
                     folder_id=folder_id,
                     title=title,
@@ -1706,6 +5652,7 @@ class MaxClientWrapper:
         try:
             async def _delete():
                 await self._ensure_connected_and_session()
+                await self._throttle("folder")
                 upd = await self.client.delete_folder(folder_id=folder_id)
                 return {"success": True, "deleted": True, "folder_id": folder_id}
 
@@ -1722,6 +5669,7 @@ class MaxClientWrapper:
         try:
             async def _join():
                 await self._ensure_connected_and_session()
+                await self._throttle("membership")
                 chat = await self.client.join_group(link)
                 return {
                     "success": True,
@@ -1733,7 +5681,7 @@ class MaxClientWrapper:
                     },
                 }
 
-            return self._run_async(_join())
+            return self._run_async(self._cached_lookup("join", "group:" + link.strip(), _join, supersede=False))
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -1750,6 +5698,7 @@ class MaxClientWrapper:
                 for attempt in range(3):
                     try:
                         await self._ensure_connected_and_session()
+                        await self._throttle("membership")
                         ch = await self.client.join_channel(link)
                         if ch is None:
                             return {"success": False, "error": "Channel not found"}
@@ -1775,6 +5724,7 @@ class MaxClientWrapper:
                             or et in ["socketnotconnectederror", "socketsenderror", "sslerror", "ssleoferror"]
                         )
                         if attempt < 2 and is_conn:
+                            self._metrics.retry()
                             try:
                                 if hasattr(self.client, "_cleanup_client"):
                                     await self.client._cleanup_client()
@@ -1786,7 +5736,7 @@ class MaxClientWrapper:
 
                 return {"success": False, "error": str(last_err) if last_err else "Join failed"}
 
-            return self._run_async(_join())
+            return self._run_async(self._cached_lookup("join", "channel:" + link.strip(), _join, supersede=False))
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -1797,6 +5747,7 @@ class MaxClientWrapper:
         try:
             async def _leave():
                 await self._ensure_connected_and_session()
+                await self._throttle("membership")
                 await self.client.leave_group(chat_id)
                 return {"success": True, "left": True, "chat_id": chat_id}
 
@@ -1811,6 +5762,7 @@ class MaxClientWrapper:
         try:
             async def _leave():
                 await self._ensure_connected_and_session()
+                await self._throttle("membership")
                 await self.client.leave_channel(chat_id)
                 return {"success": True, "left": True, "chat_id": chat_id}
 
@@ -1818,70 +5770,367 @@ class MaxClientWrapper:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def read_message(self, chat_id: int, message_id: Any) -> Dict[str, Any]:
-        """Отметить сообщение как прочитанное."""
+    def read_message(self, chat_id: int, message_id: Any, coalesce: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Отметить сообщение как прочитанное.
+
+        По умолчанию отметки копятся по чатам (только максимальный message_id) и уходят на сервер
+        раз в окно коалесцинга; coalesce=False отправляет запрос сразу.
+        """
         if self.client is None:
             return {"success": False, "error": "Client not initialized"}
         msg_int = self._coerce_int(message_id)
         if msg_int is None:
             return {"success": False, "error": "Invalid message_id"}
+
+        use_coalescing = self._read_coalesce_enabled if coalesce is None else bool(coalesce)
         try:
+            if use_coalescing:
+                loop = self._ensure_loop_thread()
+                loop.call_soon_threadsafe(self._queue_read_marker, int(chat_id), msg_int)
+                return {
+                    "success": True,
+                    "coalesced": True,
+                    "state": {"chat_id": chat_id, "message_id": str(msg_int)},
+                }
+
             async def _read():
                 await self._ensure_connected_and_session()
+                await self._throttle("read")
+                self._read_stats["requested"] += 1
+                self._read_stats["network_calls"] += 1
                 state = await self.client.read_message(message_id=msg_int, chat_id=chat_id)
                 return {"success": True, "state": {"chat_id": chat_id, "message_id": str(msg_int)}}
 
             return self._run_async(_read())
         except Exception as e:
             return {"success": False, "error": str(e)}
-    
-    def start_client(self) -> Dict[str, Any]:
+
+    def _queue_read_marker(self, chat_id: int, message_id: int) -> None:
+        """Запомнить отметку прочтения (на loop thread) и запланировать flush по окну."""
+        self._read_stats["requested"] += 1
+        cur = self._read_markers.get(chat_id)
+        if cur is None or message_id > cur:
+            self._read_markers[chat_id] = message_id
+        if self._read_flush_task is None or self._read_flush_task.done():
+            self._read_flush_task = asyncio.get_running_loop().create_task(
+                self._flush_read_markers_later(), name="whitemax-read-flush"
+            )
+
+    async def _flush_read_markers_later(self) -> None:
+        await asyncio.sleep(self._read_window_s)
+        try:
+            await self._flush_read_markers()
+        except Exception as e:
+            # Отметки остались в очереди; уйдут со следующей отметкой или flush_read_markers().
+            _dprint(f"Warning: read marker flush failed: {e}")
+
+    async def _flush_read_markers(self) -> int:
+        """Отправить накопленные отметки прочтения (по одному запросу на чат); вернуть число отправленных."""
+        if not self._read_markers:
+            return 0
+        # Сначала соединение: при ошибке отметки должны остаться в очереди.
+        await self._ensure_connected_and_session()
+        markers, self._read_markers = self._read_markers, {}
+        if not markers:
+            return 0
+        sent = 0
+        for chat_id, message_id in markers.items():
+            try:
+                await self._throttle("read")
+                self._read_stats["network_calls"] += 1
+                await self.client.read_message(message_id=message_id, chat_id=chat_id)
+                self._read_retries.pop(chat_id, None)
+                sent += 1
+            except Exception as e:
+                _dprint(f"Warning: read marker flush failed for chat_id={chat_id}: {e}")
+                self._read_stats["failed"] += 1
+                # Вернём отметку в очередь (если не пришла более новая), но не бесконечно.
+                attempts = self._read_retries.get(chat_id, 0) + 1
+                if attempts <= 3:
+                    self._read_retries[chat_id] = attempts
+                    self._metrics.retry("read_message")
+                    cur = self._read_markers.get(chat_id)
+                    if cur is None or message_id > cur:
+                        self._read_markers[chat_id] = message_id
+                else:
+                    self._read_retries.pop(chat_id, None)
+        flush_task = self._read_flush_task
+        if self._read_markers and (
+            flush_task is None or flush_task.done() or flush_task is asyncio.current_task()
+        ):
+            self._read_flush_task = asyncio.get_running_loop().create_task(
+                self._flush_read_markers_later(), name="whitemax-read-flush"
+            )
+        return sent
+
+    def _read_marker_stats(self) -> Dict[str, Any]:
+        st = dict(self._read_stats)
+        st["pending"] = len(self._read_markers)
+        st["calls_saved"] = max(0, st["requested"] - st["network_calls"] - st["pending"])
+        st["window_ms"] = int(self._read_window_s * 1000)
+        st["enabled"] = self._read_coalesce_enabled
+        return st
+
+    def flush_read_markers(self) -> Dict[str, Any]:
+        """Немедленно отправить накопленные отметки прочтения (например, когда приложение уходит в фон)."""
+        if self.client is None:
+            return {"success": False, "error": "Client not initialized"}
+        try:
+            sent = self._run_async(self._flush_read_markers())
+            return {"success": True, "flushed": sent, "stats": self._read_marker_stats()}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def configure_read_coalescing(self, enabled: bool = True, window_ms: int = 300) -> Dict[str, Any]:
+        """Включить/выключить коалесцинг отметок прочтения и задать окно (ms)."""
+        self._read_coalesce_enabled = bool(enabled)
+        self._read_window_s = max(0, int(window_ms)) / 1000.0
+        return {"success": True, "stats": self._read_marker_stats()}
+
+    def get_read_marker_stats(self) -> Dict[str, Any]:
+        """Сколько отметок прочтения запрошено, сколько реально ушло на сервер и сколько запросов сэкономлено."""
+        return {"success": True, "stats": self._read_marker_stats()}
+
+    def configure_uploads(self, config: Any) -> Dict[str, Any]:
+        """
+        Настроить загрузки.
+
+        :param config: dict/JSON: chunk_size (байты, >= 64 KiB), chunk_retries, checkpoint_ttl_s,
+            dedup_enabled, dedup_ttl_photo_s, dedup_ttl_file_s (0 — не кешировать этот тип).
+        """
+        try:
+            cfg = json.loads(config) if isinstance(config, str) else dict(config or {})
+            if "chunk_size" in cfg:
+                self._upload_chunk_size = max(64 * 1024, int(cfg["chunk_size"]))
+            if "chunk_retries" in cfg:
+                self._upload_chunk_retries = max(0, int(cfg["chunk_retries"]))
+            if "checkpoint_ttl_s" in cfg:
+                self._upload_checkpoint_ttl_s = max(0.0, float(cfg["checkpoint_ttl_s"]))
+            if "dedup_enabled" in cfg:
+                self._upload_cache.enabled = bool(cfg["dedup_enabled"])
+            for kind in ("photo", "file"):
+                if f"dedup_ttl_{kind}_s" in cfg:
+                    self._upload_cache.ttl_s[kind] = max(0.0, float(cfg[f"dedup_ttl_{kind}_s"]))
+            return self.get_upload_stats()
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_upload_stats(self) -> Dict[str, Any]:
+        """Настройки загрузок и статистика дедуп-кеша (hits/misses/bytes_saved)."""
+        return {
+            "success": True,
+            "uploads": {
+                "chunk_size": self._upload_chunk_size,
+                "chunk_retries": self._upload_chunk_retries,
+                "checkpoint_ttl_s": self._upload_checkpoint_ttl_s,
+                "dedup": self._upload_cache.snapshot(),
+            },
+        }
+
+    def configure_rate_limits(self, config: Any) -> Dict[str, Any]:
+        """
+        Настроить rate limiter исходящих запросов.
+
+        :param config: dict/JSON вида {"enabled": bool, "global": {"rate", "burst"},
+            "classes": {"read": {"rate", "burst"}, ...}}; rate <= 0 отключает лимит класса.
+        """
+        try:
+            cfg = json.loads(config) if isinstance(config, str) else dict(config or {})
+            self._rate_limiter.configure(cfg)
+            return {"success": True, "rate_limits": self._rate_limiter.snapshot()}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_rate_limit_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """Статистика rate limiter: сколько запросов ждали в очереди и сколько (ms)."""
+        snap = self._rate_limiter.snapshot()
+        if reset:
+            self._rate_limiter.reset_stats()
+        return {"success": True, "rate_limits": snap}
+
+    def _me_info(self) -> Optional[Dict[str, Any]]:
+        me = getattr(self.client, "me", None) if self.client is not None else None
+        if not me:
+            return None
+        # Безопасно получаем first_name из names (поддержка и dict/pydantic)
+        first_name = ""
+        names = self._get_field(me, "names", default=None)
+        if names and isinstance(names, list) and len(names) > 0:
+            n0 = names[0]
+            first_name = (
+                self._get_field(n0, "first_name", "firstName", default=None)
+                or self._get_field(n0, "name", default=None)
+                or ""
+            )
+        return {
+            "id": self._get_field(me, "id", default=0),
+            "first_name": first_name,  # Всегда строка, даже если пустая
+            "phone": self._get_field(me, "phone", default=None) or self.phone,
+        }
+
+    def _build_session_snapshot(self) -> Dict[str, Any]:
+        """Компактный снимок после sync: списки вместо dict, только то, что нужно для старта и диффа."""
+        client = self.client
+
+        def _last_time(obj: Any) -> Any:
+            last = self._get_field(obj, "last_message", "lastMessage", default=None)
+            return self._normalize_time_to_int_ms(self._get_field(last, "time", default=None)) if last else None
+
+        return {
+            "version": 1,
+            "ts_ms": int(time.time() * 1000),
+            "phone": self.phone,
+            "me": self._me_info(),
+            "dialogs": [
+                [self._get_field(d, "id", default=None), self._get_field(d, "cid", default=None), _last_time(d)]
+                for d in getattr(client, "dialogs", None) or []
+            ],
+            "chats": [
+                [self._get_field(c, "id", default=None), self._get_field(c, "title", default="") or "", _last_time(c)]
+                for c in getattr(client, "chats", None) or []
+            ],
+            "channels": [
+                [self._get_field(c, "id", default=None), self._get_field(c, "title", default="") or "", _last_time(c)]
+                for c in getattr(client, "channels", None) or []
+            ],
+            "folder_ids": list(self._folder_ids) if self._folder_ids is not None else None,
+        }
+
+    def _save_session_snapshot(self) -> None:
+        """Best-effort: снимок собирается на loop (чтение списков pymax), пишется в пуле I/O."""
+        try:
+            snap = self._build_session_snapshot()
+            if snap["me"] is None:
+                return
+        except Exception:
+            return
+
+        def _write() -> None:
+            if snap["folder_ids"] is None:
+                prev = self._load_session_snapshot()
+                snap["folder_ids"] = (prev or {}).get("folder_ids") or []
+            tmp = self._session_snapshot_path + ".tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(snap, ensure_ascii=False, separators=(",", ":")))
+                os.replace(tmp, self._session_snapshot_path)
+            except Exception:
+                pass
+
+        try:
+            self._io_executor().submit(_write)
+        except Exception:
+            pass
+
+    def _load_session_snapshot(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._session_snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if snap.get("version") != 1 or snap.get("phone") != self.phone or not snap.get("me"):
+            return None
+        return snap
+
+    @staticmethod
+    def _session_snapshot_diff(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+        """Что поменялось между снимком, с которого стартовал UI, и свежим sync."""
+        diff: Dict[str, Any] = {}
+        for kind in ("dialogs", "chats", "channels"):
+            before = {row[0]: row for row in old.get(kind) or []}
+            after = {row[0]: row for row in new.get(kind) or []}
+            changed = {
+                "added": [cid for cid in after if cid not in before],
+                "removed": [cid for cid in before if cid not in after],
+                "updated": [cid for cid, row in after.items() if cid in before and before[cid] != row],
+            }
+            if any(changed.values()):
+                diff[kind] = changed
+        if (old.get("me") or {}) != (new.get("me") or {}):
+            diff["me"] = new.get("me")
+        if old.get("folder_ids") != new.get("folder_ids") and new.get("folder_ids"):
+            diff["folder_ids"] = new.get("folder_ids")
+        return diff
+
+    async def _background_session_sync(self, snap: Dict[str, Any]) -> None:
+        """Полный connect/sync после быстрого старта; итог — событие session_sync с диффом к снимку."""
+        try:
+            await self._ensure_connected_and_session()
+            try:
+                await self._ensure_keepalive_started()
+            except Exception:
+                pass
+            if not getattr(self.client, "me", None):
+                raise RuntimeError("Session not initialized")
+            diff = self._session_snapshot_diff(snap, self._build_session_snapshot())
+            self._emit_event(
+                {
+                    "type": "session_sync",
+                    "success": True,
+                    "me": self._me_info(),
+                    "changed": bool(diff),
+                    "diff": diff,
+                }
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._emit_event(
+                {"type": "session_sync", "success": False, "error": str(e), "error_class": _classify_error(e)}
+            )
+
+    def start_client(self, fast: bool = False) -> Dict[str, Any]:
         """
         Запустить клиент (подключиться и авторизоваться).
-        
+
+        :param fast: при наличии токена и снимка сессии вернуть me/счётчики из снимка сразу,
+            а connect/sync выполнить в фоне (событие session_sync с диффом по завершении)
         :return: Dict с результатом запуска
         """
         if self.client is None:
             result = self.create_client()
             if not result.get("success"):
                 return result
-        
+
         try:
+            if fast and getattr(self.client, "_token", None):
+                snap = self._load_session_snapshot()
+                if snap is not None:
+                    async def _kickoff():
+                        if self._folder_ids is None:
+                            self._folder_ids = list(snap.get("folder_ids") or [])
+                        task = self._session_sync_task
+                        if task is None or task.done():
+                            self._session_sync_task = asyncio.ensure_future(self._background_session_sync(snap))
+                        return {
+                            "success": True,
+                            "connected": bool(getattr(self.client, "is_connected", False)),
+                            "authenticated": True,
+                            "me": snap["me"],
+                            "from_snapshot": True,
+                            "snapshot_ts_ms": snap.get("ts_ms"),
+                            "counts": {k: len(snap.get(k) or []) for k in ("dialogs", "chats", "channels")},
+                            "folder_ids": snap.get("folder_ids") or [],
+                        }
+
+                    return self._run_async(_kickoff())
+
             async def _start():
                 # Ensure connected/session (sync/post-login) and start keepalive for realtime events.
                 await self._ensure_connected_and_session()
                 try:
                     await self._ensure_keepalive_started()
                 except Exception:
-                    pass
-                    
-                # Если есть сохраненный токен, используем его для синхронизации
-                if self.client._token:
-                    # Получаем информацию о пользователе
-                    me_info = None
-                    if self.client.me:
-                        # Безопасно получаем first_name из names (поддержка и dict/pydantic)
-                        first_name = ""
-                        names = self._get_field(self.client.me, "names", default=None)
-                        if names and isinstance(names, list) and len(names) > 0:
-                            n0 = names[0]
-                            first_name = (
-                                self._get_field(n0, "first_name", "firstName", default=None)
-                                or self._get_field(n0, "name", default=None)
-                                or ""
-                            )
-
-                        me_info = {
-                            "id": self._get_field(self.client.me, "id", default=0),
-                            "first_name": first_name,  # Всегда строка, даже если пустая
-                            "phone": self._get_field(self.client.me, "phone", default=None) or self.phone,
-                        }
+                    pass
                     
+                # Если есть сохраненный токен, используем его для синхронизации
+                if self.client._token:
                     return {
                         "success": True,
                         "connected": self.client.is_connected,
                         "authenticated": True,
-                        "me": me_info,
+                        "me": self._me_info(),
                     }
                 else:
                     return {
@@ -1906,6 +6155,30 @@ class MaxClientWrapper:
         
         try:
             async def _stop():
+                if self._session_sync_task is not None:
+                    self._session_sync_task.cancel()
+                    try:
+                        await self._session_sync_task
+                    except BaseException:
+                        pass
+                    self._session_sync_task = None
+                if self._history_task is not None:
+                    self._history_task.cancel()
+                    try:
+                        await self._history_task
+                    except BaseException:
+                        pass
+                    self._history_task = None
+                # Не теряем события, ещё лежащие в буфере batched sink.
+                try:
+                    self._event_sink.flush()
+                except Exception:
+                    pass
+                # Best-effort: don't lose coalesced read markers on shutdown.
+                try:
+                    await self._flush_read_markers()
+                except Exception:
+                    pass
                 # Stop keepalive loop first
                 if self._keepalive_stop is not None:
                     try:
@@ -1919,12 +6192,37 @@ class MaxClientWrapper:
                     except Exception:
                         pass
                     self._keepalive_task = None
+                # Prefetch миниатюр сам открывает http session — останавливаем его до закрытия сессии.
+                if self._thumb_prefetch_task is not None:
+                    self._thumb_prefetch_task.cancel()
+                    try:
+                        await self._thumb_prefetch_task
+                    except BaseException:
+                        pass
+                    self._thumb_prefetch_task = None
+                if self._http_session is not None:
+                    try:
+                        await self._http_session.close()
+                    except Exception:
+                        pass
+                    self._http_session = None
                 await self.client.close()
                 return {"success": True, "message": "Client stopped"}
             
             result = self._run_async(_stop())
             # Also stop asyncio loop thread to avoid dangling tasks on shutdown.
             self._stop_loop_thread()
+            if self._io_pool is not None:
+                self._io_pool.shutdown(wait=False)
+                self._io_pool = None
+            if self._batch_pool is not None:
+                self._batch_pool.shutdown(wait=False)
+                self._batch_pool = None
+            try:
+                if self._search_pool_obj is not None:
+                    self._search_pool_obj.submit(self._search_index.close).result(timeout=5)
+            except Exception:
+                pass
             return result
         except Exception as e:
             return {"success": False, "error": str(e)}
@@ -1934,34 +6232,46 @@ class MaxClientWrapper:
 _wrapper_instance: Optional[MaxClientWrapper] = None
 
 
-def create_wrapper(phone: str, work_dir: Optional[str] = None, token: Optional[str] = None) -> str:
-    """Создать глобальный экземпляр обертки."""
+def create_wrapper(
+    phone: str, work_dir: Optional[str] = None, token: Optional[str] = None, lazy: bool = True
+) -> str:
+    """
+    Создать глобальный экземпляр обертки.
+
+    По умолчанию pymax не импортируется здесь (это самая дорогая часть старта): он загружается
+    в create_client(), а ошибка импорта возвращается оттуда в том же формате. lazy=False —
+    проверить pymax сразу, как раньше.
+    """
     global _wrapper_instance
-    if not PYMAX_AVAILABLE:
-        return json.dumps(
-            {
-                "success": False,
-                "error": "pymax not available - missing dependencies",
-                "details": _PYMAX_IMPORT_ERROR,
-            }
-        )
+    if not lazy and not _ensure_pymax():
+        return json.dumps(_pymax_unavailable_result())
     try:
         _wrapper_instance = MaxClientWrapper(phone, work_dir, token)
         return json.dumps({"success": True})
-    except RuntimeError as e:
-        if "pymax not available" in str(e):
-            return json.dumps(
-                {
-                    "success": False,
-                    "error": "pymax not available - missing dependencies",
-                    "details": _PYMAX_IMPORT_ERROR or str(e),
-                }
-            )
-        return json.dumps({"success": False, "error": str(e)})
     except Exception as e:
         return json.dumps({"success": False, "error": str(e)})
 
 
+def preload_pymax() -> str:
+    """Импортировать pymax заранее (например, пока UI показывает кешированные данные)."""
+    t0 = time.perf_counter()
+    if not _ensure_pymax():
+        return json.dumps(_pymax_unavailable_result())
+    return json.dumps({"success": True, "took_ms": round((time.perf_counter() - t0) * 1000.0, 1)})
+
+
+def get_pymax_status() -> str:
+    """Состояние импорта pymax без попытки импорта (для отчёта об ошибках)."""
+    return json.dumps(
+        {
+            "success": True,
+            "attempted": _PYMAX_IMPORT_ATTEMPTED,
+            "available": PYMAX_AVAILABLE,
+            "details": _PYMAX_IMPORT_ERROR,
+        }
+    )
+
+
 def request_code(phone: Optional[str] = None, language: str = "ru") -> str:
     """Запросить код авторизации."""
     global _wrapper_instance
@@ -1971,12 +6281,30 @@ def request_code(phone: Optional[str] = None, language: str = "ru") -> str:
     return json.dumps(result)
 
 
-def login_with_code(temp_token: str, code: str) -> str:
-    """Авторизоваться с кодом."""
+def login_with_code(temp_token: str, code: str, bootstrap: bool = False, bootstrap_options: Any = None) -> str:
+    """Авторизоваться с кодом (bootstrap=True — сразу вернуть стартовый payload; bootstrap_options — dict/JSON)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.login_with_code(temp_token, code, bootstrap, bootstrap_options)
+    return json.dumps(result)
+
+
+def bootstrap(prefetch_chats: int = 3, messages_limit: int = 30, folder_sync: int = 0) -> str:
+    """Get me, chats, folders and first messages in one call (stages run concurrently)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.bootstrap(prefetch_chats, messages_limit, folder_sync)
+    return json.dumps(result)
+
+
+def call_batch(ops_json: str, sequential: bool = False, isolate: bool = True, timeout: float = 60) -> str:
+    """Run several operations in one bridge call (concurrently, or in order with sequential=True)."""
     global _wrapper_instance
     if _wrapper_instance is None:
         return json.dumps({"success": False, "error": "Wrapper not initialized"})
-    result = _wrapper_instance.login_with_code(temp_token, code)
+    result = _wrapper_instance.call_batch(ops_json, sequential, isolate, timeout)
     return json.dumps(result)
 
 
@@ -1998,12 +6326,39 @@ def get_messages(chat_id: int, limit: int = 50) -> str:
     return json.dumps(result)
 
 
-def start_client() -> str:
+def get_messages_around(chat_id: int, message_id: Any, before: int = 25, after: int = 25) -> str:
+    """Get messages around message_id (served from the local window when possible)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_messages_around(chat_id, message_id, before, after)
+    return json.dumps(result)
+
+
+def configure_message_windows(max_messages: Optional[int] = None, clear: bool = False) -> str:
+    """Configure the per-chat message window budget."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_message_windows(max_messages, clear)
+    return json.dumps(result)
+
+
+def get_message_window_stats() -> str:
+    """Get per-chat message window stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_message_window_stats()
+    return json.dumps(result)
+
+
+def start_client(fast: bool = False) -> str:
     """Запустить клиент."""
     global _wrapper_instance
     if _wrapper_instance is None:
         return json.dumps({"success": False, "error": "Wrapper not initialized"})
-    result = _wrapper_instance.start_client()
+    result = _wrapper_instance.start_client(fast)
     return json.dumps(result)
 
 
@@ -2016,12 +6371,12 @@ def stop_client() -> str:
     return json.dumps(result)
 
 
-def send_message(chat_id: int, text: str, reply_to: Optional[Any] = None) -> str:
+def send_message(chat_id: int, text: str, reply_to: Optional[Any] = None, optimistic: bool = False) -> str:
     """Отправить сообщение в чат."""
     global _wrapper_instance
     if _wrapper_instance is None:
         return json.dumps({"success": False, "error": "Wrapper not initialized"})
-    result = _wrapper_instance.send_message(chat_id, text, reply_to)
+    result = _wrapper_instance.send_message(chat_id, text, reply_to, optimistic)
     return json.dumps(result)
 
 
@@ -2032,12 +6387,35 @@ def send_attachment(
     text: str = "",
     reply_to: Optional[Any] = None,
     notify: bool = True,
+    optimistic: bool = False,
 ) -> str:
     """Send photo/file attachment."""
     global _wrapper_instance
     if _wrapper_instance is None:
         return json.dumps({"success": False, "error": "Wrapper not initialized"})
-    result = _wrapper_instance.send_attachment(chat_id, file_path, attachment_type, text, reply_to, notify)
+    result = _wrapper_instance.send_attachment(
+        chat_id, file_path, attachment_type, text, reply_to, notify, optimistic
+    )
+    return json.dumps(result)
+
+
+def send_attachments(
+    chat_id: int,
+    file_paths: Any,
+    attachment_type: str = "auto",
+    text: str = "",
+    reply_to: Optional[Any] = None,
+    notify: bool = True,
+    max_parallel: int = 3,
+    on_partial_failure: str = "send",
+) -> str:
+    """Send several attachments as one album message."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.send_attachments(
+        chat_id, file_paths, attachment_type, text, reply_to, notify, max_parallel, on_partial_failure
+    )
     return json.dumps(result)
 
 
@@ -2230,10 +6608,298 @@ def leave_channel(chat_id: int) -> str:
     return json.dumps(result)
 
 
-def read_message(chat_id: int, message_id: Any) -> str:
+def read_message(chat_id: int, message_id: Any, coalesce: Optional[bool] = None) -> str:
     """Mark message as read."""
     global _wrapper_instance
     if _wrapper_instance is None:
         return json.dumps({"success": False, "error": "Wrapper not initialized"})
-    result = _wrapper_instance.read_message(chat_id, message_id)
+    result = _wrapper_instance.read_message(chat_id, message_id, coalesce)
+    return json.dumps(result)
+
+
+def flush_read_markers() -> str:
+    """Flush pending read markers now (e.g. when the app goes to background)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.flush_read_markers()
+    return json.dumps(result)
+
+
+def configure_read_coalescing(enabled: bool = True, window_ms: int = 300) -> str:
+    """Configure read-receipt coalescing."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_read_coalescing(enabled, window_ms)
+    return json.dumps(result)
+
+
+def get_read_marker_stats() -> str:
+    """Get read-receipt coalescing stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_read_marker_stats()
+    return json.dumps(result)
+
+
+def configure_uploads(config: Any) -> str:
+    """Configure chunked uploads."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_uploads(config)
+    return json.dumps(result)
+
+
+def get_upload_stats() -> str:
+    """Get upload settings and dedup cache stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_upload_stats()
+    return json.dumps(result)
+
+
+def download_attachment(
+    chat_id: int, message_id: Any, attach_id: Any, attachment_type: Optional[str] = None
+) -> str:
+    """Download attachment into the local media cache; returns local path."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.download_attachment(chat_id, message_id, attach_id, attachment_type)
+    return json.dumps(result)
+
+
+def configure_media_cache(budget_bytes: Optional[int] = None, connections: Optional[int] = None) -> str:
+    """Configure media cache byte budget / download connections."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_media_cache(budget_bytes, connections)
+    return json.dumps(result)
+
+
+def get_media_cache_stats() -> str:
+    """Get media cache stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_media_cache_stats()
+    return json.dumps(result)
+
+
+def configure_thumbnails(prefetch_count: Optional[int] = None, budget_bytes: Optional[int] = None) -> str:
+    """Configure chat-list avatar prefetch / thumbnail cache."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_thumbnails(prefetch_count, budget_bytes)
+    return json.dumps(result)
+
+
+def search_messages(query: str, chat_id: Optional[int] = None, limit: int = 50, cursor: Optional[str] = None) -> str:
+    """Full-text search over locally indexed messages."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.search_messages(query, chat_id, limit, cursor)
+    return json.dumps(result)
+
+
+def get_search_index_stats() -> str:
+    """Get message search index stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_search_index_stats()
+    return json.dumps(result)
+
+
+def start_history_indexer(
+    chat_ids: Optional[List[int]] = None,
+    rate_per_s: Optional[float] = None,
+    page_size: Optional[int] = None,
+    restart: bool = False,
+) -> str:
+    """Start background full-history indexing."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.start_history_indexer(chat_ids, rate_per_s, page_size, restart)
+    return json.dumps(result)
+
+
+def stop_history_indexer() -> str:
+    """Stop background full-history indexing (progress is kept)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.stop_history_indexer()
+    return json.dumps(result)
+
+
+def get_history_indexer_status() -> str:
+    """Get background history indexer progress."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_history_indexer_status()
+    return json.dumps(result)
+
+
+def configure_lookup_cache(
+    max_entries: Optional[int] = None,
+    ttl_s: Optional[float] = None,
+    negative_ttl_s: Optional[float] = None,
+    debounce_ms: Optional[int] = None,
+    clear: bool = False,
+) -> str:
+    """Configure the lookup cache (phone / channel name / join links)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_lookup_cache(max_entries, ttl_s, negative_ttl_s, debounce_ms, clear)
+    return json.dumps(result)
+
+
+def get_lookup_cache_stats() -> str:
+    """Get lookup cache stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_lookup_cache_stats()
+    return json.dumps(result)
+
+
+def filter_chats(query: str, limit: int = 50) -> str:
+    """Filter the chat list by title using the local index."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.filter_chats(query, limit)
+    return json.dumps(result)
+
+
+def get_metrics(reset: bool = False) -> str:
+    """Get per-operation latency/error metrics."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_metrics(reset)
+    return json.dumps(result)
+
+
+def reset_metrics() -> str:
+    """Reset metrics."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.reset_metrics()
+    return json.dumps(result)
+
+
+def configure_metrics(enabled: bool) -> str:
+    """Enable/disable metrics collection."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_metrics(enabled)
+    return json.dumps(result)
+
+
+def configure_tracing(
+    sample_rate: Optional[float] = None,
+    slow_ms: Optional[float] = None,
+    max_file_bytes: Optional[int] = None,
+    keep_files: Optional[int] = None,
+) -> str:
+    """Configure phase-level tracing (JSONL in work_dir/traces)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_tracing(sample_rate, slow_ms, max_file_bytes, keep_files)
+    return json.dumps(result)
+
+
+def configure_event_sink(
+    kind: str = "files",
+    window_ms: Optional[float] = None,
+    max_batch: Optional[int] = None,
+    capacity: Optional[int] = None,
+) -> str:
+    """Select how realtime events are delivered (files / batched / memory)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_event_sink(kind, window_ms, max_batch, capacity)
+    return json.dumps(result)
+
+
+def get_event_sink_stats() -> str:
+    """Get event sink counters (emitted / written / coalesced / lost)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_event_sink_stats()
+    return json.dumps(result)
+
+
+def poll_events(after_seq: int = 0, limit: int = 500) -> str:
+    """Fetch events from the memory sink."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.poll_events(after_seq, limit)
+    return json.dumps(result)
+
+
+def get_memory_report(top: int = 15, reset_baseline: bool = False) -> str:
+    """Get cache sizes and tracemalloc heap growth (first call starts tracking)."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_memory_report(top, reset_baseline)
+    return json.dumps(result)
+
+
+def stop_memory_tracking() -> str:
+    """Stop tracemalloc-based memory tracking."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.stop_memory_tracking()
+    return json.dumps(result)
+
+
+def configure_cache_limits(
+    users_max: Optional[int] = None,
+    attachments_max: Optional[int] = None,
+    lookup_max: Optional[int] = None,
+) -> str:
+    """Configure LRU bounds of in-memory caches."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_cache_limits(users_max, attachments_max, lookup_max)
+    return json.dumps(result)
+
+
+def configure_rate_limits(config: Any) -> str:
+    """Configure outgoing request rate limits."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.configure_rate_limits(config)
+    return json.dumps(result)
+
+
+def get_rate_limit_stats(reset: bool = False) -> str:
+    """Get rate limiter queueing stats."""
+    global _wrapper_instance
+    if _wrapper_instance is None:
+        return json.dumps({"success": False, "error": "Wrapper not initialized"})
+    result = _wrapper_instance.get_rate_limit_stats(reset)
     return json.dumps(result)